@@ -0,0 +1,97 @@
+"""価格計算のベンチマークと整合性チェック
+
+旧: 注文ごとに LINKS / FIXED_PRICES から割引を計算
+新: QuoteTable の前計算済み見積りを引く
+
+あわせて、商品 × 枚数 × 価格 × 割引種別の組み合わせ数千通りについて
+見積り表と純粋関数の結果が一致し、料金の性質（0円以上・まとめ買いより高くならない等）
+を満たすことを確認する。
+
+    python bench/pricing.py
+"""
+import itertools
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from pricing import QuoteTable, bulk_quote, quote, unit_prices
+
+N = 200_000
+
+FIXED_PRICES = {
+    "データ": {"normal": 1500, "discount": 1250},
+    "通話可能": {"normal": 3000, "discount": 2500},
+}
+LINKS = {
+    "データ": {"url": "https://example.com/d", "price": 1500, "discount_price": 1250},
+    "通話可能": {"url": "https://example.com/v", "price": 3000},
+}
+
+
+def legacy_bulk(choice: str, count: int, links: dict = LINKS, fixed: dict = FIXED_PRICES) -> int:
+    """旧 handle_count_input の計算"""
+    base_price = links[choice].get("price", 0) or fixed.get(choice, {}).get("normal", 0)
+    discount_rate = 0
+    if 10 <= count:
+        discount_rate = 0.10
+    elif 6 <= count <= 9:
+        discount_rate = 0.05
+    return int(base_price * count * (1 - discount_rate))
+
+
+def bench():
+    table = QuoteTable(LINKS, FIXED_PRICES)
+    table.get("データ", 1)
+    cases = [(c, n) for c in LINKS for n in range(1, 21)]
+
+    start = time.perf_counter()
+    for i in range(N):
+        legacy_bulk(*cases[i % len(cases)])
+    legacy = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for i in range(N):
+        table.get(*cases[i % len(cases)])
+    cached = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for _ in range(1000):
+        table.invalidate()
+        table.get("データ", 1)
+    rebuild = (time.perf_counter() - start) / 1000
+
+    print(f"見積り: {N:,}回")
+    print(f"旧計算        : {legacy / N * 1e6:.2f} µs/回")
+    print(f"QuoteTable    : {cached / N * 1e6:.2f} µs/回")
+    print(f"表の再構築    : {rebuild * 1000:.2f} ms（/config 変更時のみ）")
+
+
+def check() -> int:
+    checked = 0
+    prices = (0, 1, 99, 1250, 1500, 2500, 3000, 9999)
+    for base, discount in itertools.product(prices, repeat=2):
+        links = {"X": {"price": base, "discount_price": discount}}
+        table = QuoteTable(links, {})
+        unit_base, unit_discount = unit_prices("X", links, {})
+        for count in range(1, 31):
+            bulk = bulk_quote(unit_base, count)
+            assert bulk.total >= 0
+            assert bulk.total <= unit_base * count
+            for kind in ("bulk", "code"):
+                q = table.get("X", count, kind)
+                assert q == quote(unit_base, unit_discount, count, kind), (base, discount, count, kind)
+                assert 0 <= q.total <= bulk.total, (base, discount, count, kind)
+                checked += 1
+            for off in (0, 100, 5000, 10 ** 6):
+                q = table.get("X", count, "coupon", off=off)
+                assert q.total == max(0, bulk.total - off)
+                checked += 1
+            assert legacy_bulk("X", count, links, {}) == bulk.total, ("まとめ買いが旧計算と不一致", base, count)
+    return checked
+
+
+if __name__ == "__main__":
+    bench()
+    print(f"整合性チェック: {check():,}通り OK")
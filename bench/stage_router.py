@@ -0,0 +1,82 @@
+"""テキスト振り分けのマイクロベンチマーク
+
+旧: F.text の正規表現 / lower().contains / RKTN / reply_to_message を順に評価
+新: StageRouter の dict 1回引き
+
+    python bench/stage_router.py
+"""
+import asyncio
+import datetime
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from aiogram import F
+from aiogram.types import Chat, Message, User
+
+from stage_router import StageRouter
+
+N = 100_000
+
+LEGACY_FILTERS = [
+    F.text.regexp(r"^\d+$"),
+    F.text.lower().contains("完了"),
+    F.text.regexp(r"RKTN-[A-Z0-9]{6}"),
+    F.reply_to_message,
+]
+
+
+def make_message(text: str) -> Message:
+    return Message(
+        message_id=1, date=datetime.datetime.now(), text=text,
+        chat=Chat(id=1, type="private"), from_user=User(id=1, is_bot=False, first_name="bench"),
+    )
+
+
+def build_router() -> StageRouter:
+    router = StageRouter(entry_stages={"select", "input_count"}, transitions={"input_count": {"waiting_payment"}})
+
+    async def noop(message, state):
+        return None
+
+    for stage in ("input_count", "select_count", "waiting_payment", "awaiting_reason", "inquiry_waiting",
+                  "config_price", "config_link"):
+        router.route(stage)(noop)
+    router.on_idle(noop)
+    router.on_fallback(noop)
+    return router
+
+
+async def bench_legacy(messages) -> float:
+    start = time.perf_counter()
+    for i in range(N):
+        message = messages[i % len(messages)]
+        for flt in LEGACY_FILTERS:
+            if flt.resolve(message):
+                break
+    return time.perf_counter() - start
+
+
+async def bench_router(router, messages, states) -> float:
+    start = time.perf_counter()
+    for i in range(N):
+        await router.dispatch(messages[i % len(messages)], states[i % len(states)])
+    return time.perf_counter() - start
+
+
+async def main():
+    messages = [make_message(t) for t in ("こんにちは", "よろしくお願いします", "2", "完了しました", "RKTN-ABC123")]
+    states = [None, None, {"stage": "input_count"}, {"stage": "waiting_payment"}, {"stage": "waiting_payment"}]
+    router = build_router()
+
+    legacy = await bench_legacy(messages)
+    routed = await bench_router(router, messages, states)
+    print(f"updates: {N:,}")
+    print(f"旧フィルタ連鎖 : {legacy / N * 1e6:.2f} µs/update")
+    print(f"StageRouter    : {routed / N * 1e6:.2f} µs/update")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
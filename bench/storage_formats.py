@@ -0,0 +1,95 @@
+"""データファイル保存形式のベンチマーク
+
+在庫 1k / 10k / 100k 件の data.json 相当を、各形式で保存・読み込みした時間とファイルサイズ。
+旧形式（indent=4 の JSON）を基準に表示する。msgpack / zstandard は入っていれば計測する。
+
+    python bench/storage_formats.py
+"""
+import hashlib
+import json
+import os
+import random
+import string
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import storage
+
+SIZES = (1_000, 10_000, 100_000)
+REPEAT = 3
+
+
+def make_data(n: int) -> dict:
+    rnd = random.Random(n)
+    alphabet = string.ascii_letters + string.digits + "-_"
+    file_ids = ["AgACAgUAAxkBAAI" + "".join(rnd.choices(alphabet, k=56)) for _ in range(n)]
+    return {
+        "STOCK": {"通話可能": file_ids[: n // 3], "データ": file_ids[n // 3:]},
+        "LINKS": {"通話可能": {"url": "https://qr.paypay.ne.jp/p2p01_x", "price": 3000},
+                  "データ": {"url": "https://qr.paypay.ne.jp/p2p01_y", "price": 1500}},
+        "CODES": {f"RKTN-{i:06d}": {"type": "データ", "used": i % 2 == 0} for i in range(200)},
+        "HASHES": {f: hashlib.sha256(f.encode()).hexdigest() for f in file_ids},
+        "OUTBOX": [],
+    }
+
+
+def legacy_write(path: str, data):
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False, indent=4)
+
+
+def legacy_read(path: str):
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def available_formats() -> list[str]:
+    formats = []
+    for fmt in ("json", "compact", "compact+gzip", "compact+zstd", "msgpack", "msgpack+gzip", "msgpack+zstd"):
+        try:
+            storage.parse_format(fmt)
+        except ValueError:
+            continue
+        formats.append(fmt)
+    return formats
+
+
+def best_of(fn) -> float:
+    times = []
+    for _ in range(REPEAT):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def main():
+    formats = available_formats()
+    skipped = sorted({"msgpack", "zstd"} - {part for f in formats for part in f.split("+")})
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "data.json")
+        for n in SIZES:
+            data = make_data(n)
+            print(f"\n在庫 {n:,}件")
+            print(f"{'形式':<16}{'保存 ms':>10}{'読込 ms':>10}{'サイズ KB':>12}{'サイズ比':>9}")
+
+            save = best_of(lambda: legacy_write(path, data))
+            load = best_of(lambda: legacy_read(path))
+            base = os.path.getsize(path)
+            print(f"{'旧(indent=4)':<16}{save * 1000:>10.1f}{load * 1000:>10.1f}{base / 1024:>12.0f}{1:>9.2f}")
+
+            for fmt in formats:
+                save = best_of(lambda: storage.write(path, data, fmt))
+                load = best_of(lambda: storage.read(path))
+                assert storage.read(path) == data
+                size = os.path.getsize(path)
+                print(f"{fmt:<16}{save * 1000:>10.1f}{load * 1000:>10.1f}{size / 1024:>12.0f}{size / base:>9.2f}")
+    if skipped:
+        print(f"\n未インストールのため省略: {', '.join(skipped)}")
+
+
+if __name__ == "__main__":
+    main()
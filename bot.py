@@ -1,12 +1,39 @@
 import asyncio
 from aiogram import Bot, Dispatcher, types, F
 from aiogram.filters import Command
-from aiogram.types import InlineKeyboardButton, InlineKeyboardMarkup, ForceReply
+from aiogram.utils.token import validate_token
+from aiogram.types import InlineKeyboardButton, InlineKeyboardMarkup, ForceReply, BufferedInputFile
 import json
 import os
 import random
 import string
 import shutil
+import functools
+import hmac
+import html
+import hashlib
+import io
+import zipfile
+import time
+import re
+
+from tracing import (
+    Tracer, UpdateTraceMiddleware, HandlerNameMiddleware, TraceRequestMiddleware,
+    aiohttp_trace_middleware, span, timed,
+)
+from outbound import OutboundLimiter, outbound_priority, PRIO_DELIVERY, PRIO_NOTICE
+from stage_router import StageRouter
+from orders import OrderStore, ORDER_STATUSES, validate_orders
+from tickets import TicketStore
+from outbox import DeliveryOutbox
+from stock_health import StockHealth
+from scheduler import UserScheduler, ADMIT_ADMIN, ADMIT_PAYMENT, ADMIT_NORMAL, ADMIT_BROWSE
+from notify import AdminDigest
+from watcher import FileWatcher
+import storage
+from pricing import QuoteTable
+from paypay import PayPayClient, order_id_of
+from recorder import RECORD_TRAFFIC, TrafficRecorder, RecordMiddleware, aiohttp_record_middleware
 
 # =========================
 # 基本設定 / 永続ファイル準備
@@ -23,19 +50,81 @@ TELEGRAM_TOKEN = os.getenv("TELEGRAM_TOKEN", CONFIG.get("TELEGRAM_TOKEN", ""))
 if not TELEGRAM_TOKEN:
     raise RuntimeError("TELEGRAM_TOKEN が未設定です。環境変数または config.json で設定してください。")
 
-bot = Bot(token=TELEGRAM_TOKEN)
 dp = Dispatcher()
 
 ADMIN_ID = 5397061486  # あなたのTelegram ID（依頼者確認済み）
 STATE: dict[int, dict] = {}
 
-# 永続化パス
-DATA_DIR = "/app/data"
+# 永続化パス（保存形式は STORE_FORMAT。読み込みは形式を自動判別）
+storage.parse_format(storage.STORE_FORMAT)
+DATA_DIR = os.getenv("DATA_DIR", "/app/data")
 os.makedirs(DATA_DIR, exist_ok=True)
 DATA_FILE = os.path.join(DATA_DIR, "data.json")
 USERS_FILE = os.path.join(DATA_DIR, "users.json")
+ORDERS_FILE = os.path.join(DATA_DIR, "orders.json")
 BACKUP_DIR = os.path.join(DATA_DIR, "backup")
 os.makedirs(BACKUP_DIR, exist_ok=True)
+TRACE_FILE = os.path.join(DATA_DIR, "traces.jsonl")
+TRAFFIC_FILE = os.path.join(DATA_DIR, "traffic.jsonl")
+TICKETS_FILE = os.path.join(DATA_DIR, "tickets.jsonl")
+
+# 送信レート制御（先に登録した方が外側。待ち時間は network に含めない）
+OUTBOUND = OutboundLimiter()
+
+def _parallel_update(update) -> bool:
+    """一括追加中の管理者のアルバム/ZIPは並列に受ける（/bulkdone が受信完了を待つ）"""
+    msg = update.message
+    return (msg is not None and msg.from_user is not None and msg.from_user.id == ADMIN_ID
+            and bool(msg.photo or msg.document)
+            and STATE.get(ADMIN_ID, {}).get("stage") == "bulk_stock")
+
+# 受信記録（RECORD_TRAFFIC=1 のときだけ。最も外側なので混雑で見送った update も残る）
+RECORDER = TrafficRecorder(TRAFFIC_FILE, keep_ids=[ADMIN_ID]) if RECORD_TRAFFIC else None
+if RECORDER:
+    dp.update.outer_middleware(RecordMiddleware(RECORDER))
+    print(f"🎙️ 受信トラフィックを記録します: {TRAFFIC_FILE}")
+
+# 支払い途中のステージ（混雑時も後回しにしない）
+PAYMENT_STAGES = {"input_count", "select_count", "waiting_payment", "waiting_screenshot"}
+
+def _admission_priority(update) -> int:
+    """混雑時の受付優先度: 管理者 > 支払い中 > 通常 > 閲覧（状態なしの /start やメニュー操作）"""
+    user = getattr(update.event, "from_user", None)
+    if user is None:
+        return ADMIT_NORMAL
+    if user.id == ADMIN_ID:
+        return ADMIT_ADMIN
+    stage = STATE.get(user.id, {}).get("stage")
+    cq = update.callback_query
+    if stage in PAYMENT_STAGES or (cq is not None and (cq.data or "").startswith("ccpay_")):
+        return ADMIT_PAYMENT
+    if stage in (None, "select"):
+        return ADMIT_BROWSE
+    return ADMIT_NORMAL
+
+# ユーザー毎に update を直列化し、混雑時は優先度順に受け付ける
+# （トレースより外側なので待ち時間は計測に含めない）
+SCHEDULER = UserScheduler(priority=_admission_priority, bypass=_parallel_update)
+dp.update.outer_middleware(SCHEDULER)
+
+# トレース（update毎の network / persist / cpu 内訳。遅いものは必ず記録）
+TRACER = Tracer(TRACE_FILE)
+TRACE_REQUESTS = TraceRequestMiddleware()
+dp.update.outer_middleware(UpdateTraceMiddleware(TRACER))
+dp.message.middleware(HandlerNameMiddleware())
+dp.callback_query.middleware(HandlerNameMiddleware())
+
+def make_bot(token: str, session=None) -> Bot:
+    """Bot を作り、送信制御・トレースの request middleware を登録する（トークン差し替え・再生時も使う）"""
+    new_bot = Bot(token=token, session=session)
+    new_bot.session.middleware(OUTBOUND)
+    new_bot.session.middleware(TRACE_REQUESTS)
+    return new_bot
+
+bot = make_bot(TELEGRAM_TOKEN)
+
+# 設定・データファイルの外部変更を監視（登録はファイル末尾の「ホットリロード」）
+WATCHER = FileWatcher()
 
 DEFAULT_LINKS = {
     "通話可能": {"url": "https://qr.paypay.ne.jp/p2p01_uMrph5YFDveRCFmw", "price": 3000},
@@ -48,48 +137,92 @@ FIXED_PRICES = {
     "通話可能": {"normal": 3000, "discount": 2500}
 }
 
+# 在庫・リンク・コードの変更ごとに増えるバージョン（表示キャッシュのキー）
+STORE_VERSION = 0
+
+def bump_store_version():
+    global STORE_VERSION
+    STORE_VERSION += 1
+
+# 見積り表（商品 × 枚数 × 割引種別）。価格設定が変わったら PRICING.invalidate()
+PRICING = QuoteTable({}, FIXED_PRICES)
+
 def ensure_data_file():
     """data.json がない場合に初期化"""
     if not os.path.exists(DATA_FILE):
         data = {"STOCK": {"通話可能": [], "データ": []}, "LINKS": DEFAULT_LINKS, "CODES": {}}
-        with open(DATA_FILE, "w", encoding="utf-8") as f:
-            json.dump(data, f, ensure_ascii=False, indent=4)
+        storage.write(DATA_FILE, data)
         print("🆕 data.json を新規作成しました。")
         return data
-    with open(DATA_FILE, "r", encoding="utf-8") as f:
-        return json.load(f)
-
+    return storage.read(DATA_FILE)
+
+def validate_data(data):
+    """data.json の中身を検証（外部編集の再読み込み用）。不正なら ValueError"""
+    if not isinstance(data, dict):
+        raise ValueError("トップレベルがオブジェクトではありません")
+    stock = data.get("STOCK", {})
+    if not isinstance(stock, dict) or not all(isinstance(v, list) and all(isinstance(i, str) for i in v) for v in stock.values()):
+        raise ValueError("STOCK は {商品名: [file_id, ...]} の形式にしてください")
+    links = data.get("LINKS", {})
+    if not isinstance(links, dict):
+        raise ValueError("LINKS がオブジェクトではありません")
+    for name, link in links.items():
+        if not isinstance(link, dict) or not isinstance(link.get("price", 0), int):
+            raise ValueError(f"LINKS[{name}] の price が整数ではありません")
+    if not isinstance(data.get("CODES", {}), dict) or not isinstance(data.get("HASHES", {}), dict):
+        raise ValueError("CODES / HASHES がオブジェクトではありません")
+    if not isinstance(data.get("HEALTH", {}), dict) or not isinstance(data.get("QUARANTINE", {}), dict):
+        raise ValueError("HEALTH / QUARANTINE がオブジェクトではありません")
+
+def apply_data(data: dict):
+    """読み込んだ data.json をメモリに反映（表示キャッシュも無効化）"""
+    global STOCK, LINKS, CODES, STOCK_HASHES
+    STOCK = data.get("STOCK", {"通話可能": [], "データ": []})
+    LINKS = data.get("LINKS", DEFAULT_LINKS)
+    CODES = data.get("CODES", {})
+    STOCK_HASHES = data.get("HASHES", {})
+    STOCK_HEALTH.load(data.get("HEALTH", {}), data.get("QUARANTINE", {}))
+    PRICING.invalidate(LINKS)
+    # 復元時に送信済みの項目を再送しないよう、アウトボックスは起動時だけ読み込む
+    if not OUTBOX.loaded:
+        OUTBOX.load(data.get("OUTBOX", []))
+    bump_store_version()
+    return STOCK, LINKS, CODES
+
+@timed("persist")
 def load_data():
     """data.jsonをロードして3値を返す（STOCK, LINKS, CODES）"""
-    global STOCK, LINKS, CODES
+    global STOCK, LINKS, CODES, STOCK_HASHES
     try:
         if not os.path.exists(DATA_FILE):
             ensure_data_file()
 
-        with open(DATA_FILE, "r", encoding="utf-8") as f:
-            data = json.load(f)
-
-        STOCK = data.get("STOCK", {"通話可能": [], "データ": []})
-        LINKS = data.get("LINKS", DEFAULT_LINKS)
-        CODES = data.get("CODES", {})
-        return STOCK, LINKS, CODES
+        data = storage.read(DATA_FILE)
+        WATCHER.mark(DATA_FILE)
+        return apply_data(data)
 
     except Exception as e:
         print(f"⚠️ data.json読み込み失敗: {e}")
         STOCK, LINKS, CODES = {"通話可能": [], "データ": []}, DEFAULT_LINKS, {}
+        STOCK_HASHES = {}
+        STOCK_HEALTH.load({}, {})
+        PRICING.invalidate(LINKS)
+        bump_store_version()
         return STOCK, LINKS, CODES
 
+@timed("persist")
 def save_data():
+    bump_store_version()
     try:
-        data = {"STOCK": STOCK, "LINKS": LINKS, "CODES": CODES}
-        with open(DATA_FILE, "w", encoding="utf-8") as f:
-            json.dump(data, f, ensure_ascii=False, indent=4)
-            f.flush()
-            os.fsync(f.fileno())
+        data = {"STOCK": STOCK, "LINKS": LINKS, "CODES": CODES, "HASHES": STOCK_HASHES, "OUTBOX": OUTBOX.dump(),
+                "HEALTH": STOCK_HEALTH.verified, "QUARANTINE": STOCK_HEALTH.quarantine}
+        storage.write(DATA_FILE, data, fsync=True)
+        WATCHER.mark(DATA_FILE)
         print("💾 data.json 保存完了 ✅")
     except Exception as e:
         print(f"⚠️ data保存失敗: {e}")
 
+@timed("persist")
 def auto_backup():
     """在庫減少など重要操作後に自動バックアップ"""
     try:
@@ -104,6 +237,36 @@ def auto_backup():
     except Exception as e:
         print(f"⚠️ 自動バックアップ失敗: {e}")
 
+async def _send_outbox_item(item: dict):
+    with outbound_priority(PRIO_DELIVERY):
+        if item["file_id"]:
+            await bot.send_photo(item["chat_id"], item["file_id"], caption=item["caption"])
+        else:
+            await bot.send_message(item["chat_id"], item["caption"])
+
+async def _outbox_settled(order_id: str, ok: bool):
+    await settle_order(order_id, ok)
+
+# 在庫から取り出した画像の送信待ち（data.json に在庫と一緒に保存）
+OUTBOX = DeliveryOutbox(save=lambda: save_data(), send=_send_outbox_item, on_settled=_outbox_settled)
+
+HEALTH_SAVE_INTERVAL = 60
+_health_saved_at = 0.0
+
+def _stock_checked(quarantined: list):
+    """在庫チェックの結果を反映。隔離があれば即保存、確認済みの記録だけなら間隔を空けて保存"""
+    global _health_saved_at
+    for product, file_id, reason in quarantined:
+        DIGEST.add("🧪 在庫隔離", f"🧪 {product} の在庫を隔離: {reason}（/quarantine で確認）")
+    if quarantined or time.monotonic() - _health_saved_at >= HEALTH_SAVE_INTERVAL:
+        _health_saved_at = time.monotonic()
+        save_data()
+    else:
+        bump_store_version()
+
+# 在庫 file_id の事前確認（getFile / 重複検出 / 隔離）
+STOCK_HEALTH = StockHealth(stock=lambda: STOCK, get_file=lambda file_id: bot.get_file(file_id), on_change=_stock_checked)
+
 STOCK, LINKS, CODES = load_data()
 
 NOTICE = (
@@ -115,66 +278,168 @@ NOTICE = (
 def is_admin(uid: int) -> bool:
     return uid == ADMIN_ID
 
+async def _send_admin_notice(text: str):
+    with outbound_priority(PRIO_NOTICE):
+        await bot.send_message(ADMIN_ID, text)
+
+# 決済完了など確認のみの通知はまとめて送る（要操作の通知は即時）
+DIGEST = AdminDigest(_send_admin_notice)
+
+# =========================
+# 表示キャッシュ（/start /help /stock /status /stats）
+# =========================
+COMMANDS_TEXT_ADMIN = (
+    "🧭 <b>コマンド一覧</b>\n\n"
+    "【🧑‍💻 ユーザー向け】\n"
+    "/start - 購入メニューを開く\n"
+    "/保証 - 保証申請を行う\n"
+    "/問い合わせ - 管理者に直接メッセージを送る\n"
+    "/help - コマンド一覧を表示\n\n"
+    "【👑 管理者専用】\n"
+    "/addstock &lt;商品名&gt; - 在庫を追加\n"
+    "/bulkstock &lt;商品名&gt; - アルバム/ZIPで在庫を一括追加（/bulkdone で確定）\n"
+    "/addproduct &lt;商品名&gt; - 新しい商品カテゴリを追加\n"
+    "/stock - 在庫確認\n"
+    "/quarantine - 隔離した在庫を確認（restore で在庫に戻す / clear で削除）\n"
+    "/config - 設定変更（価格・リンク・割引）\n"
+    "/code &lt;タイプ&gt; - 割引コードを発行（通話可能 / データなど）\n"
+    "/codes - コード一覧を表示\n"
+    "/resetcodes - 割引コードをリセット（未使用に戻す / 全削除）\n"
+    "/backup - データをバックアップ保存\n"
+    "/restore - 手動バックアップから復元\n"
+    "/restore_auto - 自動バックアップから復元\n"
+    "/status - 現在のBotステータス確認\n"
+    "/stats - 販売統計レポートを表示\n"
+    "/history - 直近の購入履歴を表示\n"
+    "/orders [ステータス] - 注文一覧（既定: 入金済み・未配送）\n"
+    "/pending - 承認待ちの支払いを一覧・一括承認\n"
+    "/outbox - 送信失敗中の配送を確認（retry で再送）\n"
+    "/broadcast &lt;内容&gt; - 全ユーザーに一斉通知\n"
+    "/inbox [closed] - お問い合わせ一覧（ボタンで返信・クローズ）\n"
+    "/返信 &lt;#チケット番号 または ユーザーID&gt; &lt;内容&gt; - 問い合わせに返信を送信\n"
+    "/help - このコマンド一覧を再表示\n"
+)
+
+COMMANDS_TEXT_USER = (
+    "🧭 <b>コマンド一覧（ユーザー用）</b>\n\n"
+    "/start - 購入メニューを開く\n"
+    "/保証 - 保証申請を行う\n"
+    "/問い合わせ - 管理者に直接メッセージを送る\n"
+    "/help - コマンド一覧を表示\n\n"
+    "ℹ️ 一部コマンドは管理者専用です。"
+)
+
+PRODUCT_ICONS = {"通話可能": "📞", "データ": "💾"}
+
+_VIEW_CACHE: dict[str, tuple[int, object]] = {}
+
+def cached_view(fn):
+    """STORE_VERSION が変わるまで描画結果を使い回す"""
+    name = fn.__name__
+    @functools.wraps(fn)
+    def wrapper():
+        hit = _VIEW_CACHE.get(name)
+        if hit is not None and hit[0] == STORE_VERSION:
+            return hit[1]
+        payload = fn()
+        _VIEW_CACHE[name] = (STORE_VERSION, payload)
+        return payload
+    return wrapper
+
+@cached_view
+def stock_counts() -> list[tuple[str, int]]:
+    return [(k, len(v)) for k, v in STOCK.items()]
+
+@cached_view
+def menu_view() -> tuple[str, InlineKeyboardMarkup]:
+    counts = stock_counts()
+    stock_info = "📦 在庫状況\n" + "\n".join(f"{k}: {n}枚" for k, n in counts)
+    buttons = [[InlineKeyboardButton(text=f"{k} ({n}枚)", callback_data=f"type_{k}")] for k, n in counts]
+    text = "こんにちは！ eSIM半自販機Botです。\nどちらにしますか？\n\n" + stock_info
+    return text, InlineKeyboardMarkup(inline_keyboard=buttons)
+
+@cached_view
+def healthy_counts() -> dict[str, int]:
+    """商品ごとの確認済み在庫数（getFile で有効と分かったもの）"""
+    return {k: STOCK_HEALTH.healthy(v) for k, v in STOCK.items()}
+
+@cached_view
+def stock_view() -> str:
+    healthy = healthy_counts()
+    lines = [f"{k}: {n}枚（確認済み {healthy.get(k, 0)}枚）" for k, n in stock_counts()]
+    quarantined = STOCK_HEALTH.quarantined()
+    if quarantined:
+        lines.append(f"🧪 隔離中: {quarantined}枚（/quarantine）")
+    return "📦 在庫状況\n" + "\n".join(lines)
+
+@cached_view
+def status_view() -> str:
+    healthy = healthy_counts()
+    stock_line = " / ".join(f"{k}={n}(確認済み{healthy.get(k, 0)})" for k, n in stock_counts())
+    return (
+        f"📊 Botステータス\n"
+        f"在庫: {stock_line}\n"
+        f"隔離中の在庫: {STOCK_HEALTH.quarantined()}枚\n"
+        f"割引コード数: {len(CODES)}\n"
+        f"保存先: {DATA_FILE}\n"
+        f"稼働中: ✅ 正常"
+    )
+
+@cached_view
+def stats_view() -> str:
+    total_codes_used = sum(1 for v in CODES.values() if v["used"])
+    stock_lines = "".join(f"　{PRODUCT_ICONS.get(k, '📦')} {k}: {n}枚\n" for k, n in stock_counts())
+    return (
+        f"📊 **販売統計レポート**\n\n"
+        f"🎟️ 使用済み割引コード: {total_codes_used}件\n"
+        f"📦 在庫残数:\n"
+        f"{stock_lines}"
+    )
+
+# =========================
+# ステージ遷移 / テキストの振り分け先
+# =========================
+CONFIG_STAGES = ("config_price", "config_discount_price", "config_link", "config_discount_link")
+
+STAGE_ROUTER = StageRouter(
+    entry_stages={"select", "input_count", "adding_stock", "bulk_stock", "awaiting_reason", "inquiry_waiting",
+                  "ticket_reply", *CONFIG_STAGES},
+    transitions={
+        "input_count": {"waiting_payment"},
+        "select_count": {"waiting_payment"},
+        "waiting_payment": {"waiting_payment", "waiting_screenshot"},
+    },
+)
+
+CODE_PATTERN = re.compile(r"RKTN-[A-Z0-9]{6}")
+
+def set_stage(uid: int, stage: str, keep: bool = False, **fields) -> dict:
+    """STATE[uid] を次のステージへ（keep=True なら既存の項目を引き継ぐ）"""
+    prev = STATE.get(uid) or {}
+    if not STAGE_ROUTER.can_transition(prev.get("stage"), stage):
+        print(f"⚠️ 想定外のステージ遷移: {uid} {prev.get('stage')} → {stage}")
+    STATE[uid] = {**prev, **fields, "stage": stage} if keep else {"stage": stage, **fields}
+    return STATE[uid]
+
+@STAGE_ROUTER.on_idle
+@STAGE_ROUTER.on_fallback
+async def route_fallback(message: types.Message, state: dict | None):
+    if "完了" in message.text:
+        await message.answer("⚠️ まず /start から始めてください。")
+
 # ===============
 # コマンド: /start
 # ===============
 @dp.message(Command("start"))
 async def start_cmd(message: types.Message):
-    STATE[message.from_user.id] = {"stage": "select"}
-
-    # コマンド一覧
-    if is_admin(message.from_user.id):
-        commands_text = (
-            "🧭 <b>コマンド一覧</b>\n\n"
-            "【🧑‍💻 ユーザー向け】\n"
-            "/start - 購入メニューを開く\n"
-            "/保証 - 保証申請を行う\n"
-            "/問い合わせ - 管理者に直接メッセージを送る\n"
-            "/help - コマンド一覧を表示\n\n"
-            "【👑 管理者専用】\n"
-            "/addstock &lt;商品名&gt; - 在庫を追加\n"
-            "/addproduct &lt;商品名&gt; - 新しい商品カテゴリを追加\n"
-            "/stock - 在庫確認\n"
-            "/config - 設定変更（価格・リンク・割引）\n"
-            "/code &lt;タイプ&gt; - 割引コードを発行（通話可能 / データなど）\n"
-            "/codes - コード一覧を表示\n"
-            "/resetcodes - 割引コードをリセット（未使用に戻す / 全削除）\n"
-            "/backup - データをバックアップ保存\n"
-            "/restore - 手動バックアップから復元\n"
-            "/restore_auto - 自動バックアップから復元\n"
-            "/status - 現在のBotステータス確認\n"
-            "/stats - 販売統計レポートを表示\n"
-            "/history - 直近の購入履歴を表示\n"
-            "/broadcast &lt;内容&gt; - 全ユーザーに一斉通知\n"
-            "/返信 &lt;ユーザーID&gt; &lt;内容&gt; - 問い合わせに返信を送信\n"
-            "/help - このコマンド一覧を再表示\n"
-        )
-    else:
-        commands_text = (
-            "🧭 <b>コマンド一覧（ユーザー用）</b>\n\n"
-            "/start - 購入メニューを開く\n"
-            "/保証 - 保証申請を行う\n"
-            "/問い合わせ - 管理者に直接メッセージを送る\n"
-            "/help - コマンド一覧を表示\n\n"
-            "ℹ️ 一部コマンドは管理者専用です。"
-        )
+    set_stage(message.from_user.id, "select")
 
+    commands_text = COMMANDS_TEXT_ADMIN if is_admin(message.from_user.id) else COMMANDS_TEXT_USER
     await message.answer(commands_text, parse_mode="HTML")
 
     # 商品選択メニュー
-    stock_info_lines = [f"{k}: {len(v)}枚" for k, v in STOCK.items()]
-    stock_info = "📦 在庫状況\n" + "\n".join(stock_info_lines)
-
-    buttons = [
-        [InlineKeyboardButton(text=f"{k} ({len(v)}枚)", callback_data=f"type_{k}")]
-        for k, v in STOCK.items()
-    ]
-    kb = InlineKeyboardMarkup(inline_keyboard=buttons)
-
-    await message.answer(
-        "こんにちは！ eSIM半自販機Botです。\nどちらにしますか？\n\n" + stock_info,
-        reply_markup=kb
-    )
+    text, kb = menu_view()
+    await message.answer(text, reply_markup=kb)
 
 # ================================
 # 商品タイプ選択 → 枚数入力ステップ
@@ -184,7 +449,7 @@ async def select_type(callback: types.CallbackQuery):
     uid = callback.from_user.id
     type_name = callback.data.split("_", 1)[1]
 
-    STATE[uid] = {"stage": "input_count", "type": type_name}
+    set_stage(uid, "input_count", type=type_name)
 
     stock_len = len(STOCK.get(type_name, []))
     if stock_len == 0:
@@ -198,14 +463,14 @@ async def select_type(callback: types.CallbackQuery):
     )
     await callback.answer()
 
-@dp.message(F.text.regexp(r"^\d+$"))
-async def handle_count_input(message: types.Message):
+@STAGE_ROUTER.route("input_count", "select_count")
+async def handle_count_input(message: types.Message, state: dict):
     uid = message.from_user.id
-    state = STATE.get(uid)
-    if not state or state.get("stage") not in ["input_count", "select_count"]:
-        return
+    text = message.text.strip()
+    if not text.isdecimal():
+        return await route_fallback(message, state)
 
-    count = int(message.text.strip())
+    count = int(text)
     choice = state["type"]
 
     available_stock = STOCK.get(choice, [])
@@ -220,25 +485,22 @@ async def handle_count_input(message: types.Message):
     if not link_info:
         return await message.answer(f"⚠️ 「{choice}」のリンク情報が未設定です。\n/config で設定してください。")
 
-    base_price = link_info.get("price", 0) or FIXED_PRICES.get(choice, {}).get("normal", 0)
-
-    # まとめ買い割引
-    discount_rate = 0
-    discount_type = None
-    if 10 <= count:
-        discount_rate = 0.10; discount_type = "10%"
-    elif 6 <= count <= 9:
-        discount_rate = 0.05; discount_type = "5%"
-    total_price = int(base_price * count * (1 - discount_rate))
-
-    STATE[uid] = {
-        "stage": "waiting_payment",
-        "type": choice,
-        "count": count,
-        "final_price": total_price,
-        "discount_rate": discount_rate,
-        "discount_type": discount_type
-    }
+    # まとめ買い割引（6〜9枚 5% / 10枚以上 10%）
+    total_price, discount_type = PRICING.get(choice, count, "bulk")
+
+    # 注文ID = PayPay の merchantPaymentId（コールバックで O(1) 照合）
+    order_id = ORDERS.create(
+        uid, name=message.from_user.full_name, type=choice, count=count,
+        price=total_price, code=None, discount_type=discount_type
+    )["id"]
+    set_stage(
+        uid, "waiting_payment",
+        type=choice,
+        count=count,
+        final_price=total_price,
+        discount_type=discount_type,
+        order_id=order_id
+    )
 
     msg = f"🧾 {choice} を {count} 枚購入ですね。\n💴 合計金額: {total_price:,} 円"
     if discount_type:
@@ -246,28 +508,38 @@ async def handle_count_input(message: types.Message):
     else:
         msg += (
             "\n🎟️ 割引コードをお持ちの場合は今入力できます。\n"
-            "⚠️ 2〜5枚の購入時は1枚分のみ割引価格（1250/2500円）になります。"
+            f"⚠️ 2〜5枚の購入時は1枚分のみ割引価格（{PRICING.unit(choice)[1]:,}円）になります。"
         )
 
-    pay_url = link_info.get("url") or DEFAULT_LINKS.get(choice, {}).get("url", "未設定")
+    static_url = link_info.get("url") or DEFAULT_LINKS.get(choice, {}).get("url", "未設定")
+    pay_url = await paypay_pay_url(order_id, total_price, static_url)
     msg += f"\n\nこちらのPayPayリンク👇\n{pay_url}\n\n支払い後に『完了』と送ってください。"
+    msg += f"\n🧾 注文番号: {order_id}"
 
     await message.answer(msg)
 
     # 💳 ここでカード決済を提案
-    await _send_card_pay_offer(uid, choice, count, total_price)
+    await _send_card_pay_offer(uid, order_id)
+
+# =====================
+# 支払い待ち（完了 / 割引コード）
+# =====================
+@STAGE_ROUTER.route("waiting_payment")
+async def route_waiting_payment(message: types.Message, state: dict):
+    text = message.text
+    if text.strip().isdecimal():
+        return
+    if "完了" in text:
+        return await handle_done(message, state)
+    if CODE_PATTERN.match(text):
+        return await check_code(message, state)
 
 # =====================
 # 支払い完了 → スクショ待ち
 # =====================
-@dp.message(F.text.lower().contains("完了"))
-async def handle_done(message: types.Message):
+async def handle_done(message: types.Message, state: dict):
     uid = message.from_user.id
-    state = STATE.get(uid)
-    if not state or state.get("stage") != "waiting_payment":
-        return await message.answer("⚠️ まず /start から始めてください。")
-
-    STATE[uid]["stage"] = "waiting_screenshot"
+    set_stage(uid, "waiting_screenshot", keep=True)
 
     discount_price = state.get("final_price")
     price_text = f"（支払金額 {discount_price}円）" if discount_price else ""
@@ -276,13 +548,8 @@ async def handle_done(message: types.Message):
 # =====================
 # 割引コード認証
 # =====================
-@dp.message(F.text.regexp(r"RKTN-[A-Z0-9]{6}"))
-async def check_code(message: types.Message):
+async def check_code(message: types.Message, state: dict):
     uid = message.from_user.id
-    state = STATE.get(uid)
-    if not state or state.get("stage") != "waiting_payment":
-        return
-
     code = message.text.strip().upper()
     if code not in CODES:
         return await message.answer("⚠️ 無効なコードです。")
@@ -296,51 +563,74 @@ async def check_code(message: types.Message):
     if code_data["type"] != choice:
         return await message.answer("⚠️ このコードは別タイプ用です。")
 
-    base_price = FIXED_PRICES[choice]["normal"]
-    discount_price = FIXED_PRICES[choice]["discount"]
-    total_price = base_price * count
-
     if "discount_value" in code_data:
         off = code_data["discount_value"]
-        total_price = max(0, total_price - off)
+        total_price, applied = PRICING.get(choice, count, "coupon", off=off)
         msg = f"🎟️ クーポンコードが適用されました！\n💸 {off:,}円引き\n💴 支払金額: {total_price:,}円"
     else:
-        if count == 1:
-            total_price = discount_price
-        elif 2 <= count <= 5:
-            total_price = discount_price + base_price * (count - 1)
+        total_price, applied = PRICING.get(choice, count, "code")
+        if applied == "code":
+            msg = (
+                f"🎉 割引コードが承認されました！\n"
+                f"⚠️ 2〜5枚購入時は1枚分のみ割引適用です。\n\n"
+                f"💸 支払金額: {total_price:,}円\n"
+                f"💴 割引価格: {PRICING.unit(choice)[1]:,}円（1枚目のみ）"
+            )
+        elif applied is None:
+            # 割引価格が通常価格以上の商品ではコードを使っても安くならない（コードは消費しない）
+            return await message.answer(
+                f"ℹ️ このコードは「{choice}」では割引になりません。コードは使用されていません。\n"
+                f"💴 支払金額: {total_price:,}円\n\n支払い後に『完了』と送ってください。"
+            )
         else:
-            total_price = base_price * count
-        msg = (
-            f"🎉 割引コードが承認されました！\n"
-            f"⚠️ 2〜5枚購入時は1枚分のみ割引適用です。\n\n"
-            f"💸 支払金額: {total_price:,}円\n"
-            f"💴 割引価格: {discount_price}円（1枚目のみ）"
-        )
+            # まとめ買いの方が安い場合はコードを消費しない
+            return await message.answer(
+                f"ℹ️ まとめ買い割引（{applied}OFF）の方がお得なため、割引コードは使用せずにそのままの金額です。\n"
+                f"💴 支払金額: {total_price:,}円\n\n支払い後に『完了』と送ってください。"
+            )
 
     CODES[code]["used"] = True
     save_data()
 
     STATE[uid]["discount_code"] = code
     STATE[uid]["final_price"] = total_price
+    if state.get("order_id") in ORDERS:
+        ORDERS.update(state["order_id"], price=total_price, code=code, discount_type=applied)
 
     link_info = LINKS.get(choice, {})
     pay_link = link_info.get("discount_link") or link_info.get("url", "リンク未設定")
+    if state.get("order_id") in ORDERS:
+        pay_link = await paypay_pay_url(state["order_id"], total_price, pay_link)
 
     await message.answer(f"{msg}\n\nこちらのリンク👇\n{pay_link}\n\n支払い後に『完了』と送ってください。")
 
 # ==========================
 # 支払いスクショ → 管理者へ送信
 # ==========================
+# 注文は ORDERS に保存。承認待ち = status "paid" の索引
+ORDERS = OrderStore(ORDERS_FILE)
+ORDERS.after_save = WATCHER.mark
+ORDERS.load()
+PENDING_SELECTED: set[str] = set()
+PENDING_PAGE_SIZE = 5
+
 @dp.message(F.photo)
 async def handle_payment_photo(message: types.Message):
     uid = message.from_user.id
     state = STATE.get(uid)
 
+    # 一括在庫追加時（アルバム含む）
+    if state and state.get("stage") == "bulk_stock":
+        return await bulk_add_photo(state, message.photo[-1].file_id)
+
     # 在庫追加時
     if state and state.get("stage") == "adding_stock":
         choice = state["type"]
-        STOCK[choice].append(message.photo[-1].file_id)
+        photo = message.photo[-1]
+        if STOCK_HEALTH.admit(photo.file_id, photo.file_unique_id):
+            STATE.pop(uid, None)
+            return await message.answer("♻️ 同じ画像がすでに在庫にあるため追加しませんでした。")
+        STOCK[choice].append(photo.file_id)
         save_data()
         await message.answer(f"✅ {choice} に在庫追加（{len(STOCK[choice])}枚）")
         STATE.pop(uid, None)
@@ -352,7 +642,7 @@ async def handle_payment_photo(message: types.Message):
 
     choice = state["type"]
     count = state.get("count", 1)
-    price = state.get("final_price") or state.get("discount_price") or (LINKS[choice]["price"] * count)
+    price = state["final_price"] if "final_price" in state else PRICING.get(choice, count).total
     discount_code = state.get("discount_code")
 
     caption = (
@@ -366,9 +656,21 @@ async def handle_payment_photo(message: types.Message):
     if discount_code:
         caption += f"\n🎟️ 割引コード: {discount_code}"
 
+    order = ORDERS.get(state.get("order_id"))
+    if order is None:
+        order = ORDERS.create(uid, name=message.from_user.full_name, type=choice, count=count,
+                              price=price, code=discount_code)
+        STATE[uid]["order_id"] = order["id"]
+    if order["status"] != "quoted":
+        return await message.answer("🕐 この注文はすでに確認中です。")
+    order_id = order["id"]
+    ORDERS.set_status(order_id, "paid", name=message.from_user.full_name, price=price, code=discount_code,
+                      photo=message.photo[-1].file_id, channel="paypay")
+    caption += f"\n🧾 注文ID: {order_id}"
+
     kb = InlineKeyboardMarkup(inline_keyboard=[[
-        InlineKeyboardButton(text="✅ 承認", callback_data=f"confirm_{uid}"),
-        InlineKeyboardButton(text="❌ 拒否", callback_data=f"deny_{uid}")
+        InlineKeyboardButton(text="✅ 承認", callback_data=f"confirm_{order_id}"),
+        InlineKeyboardButton(text="❌ 拒否", callback_data=f"deny_{order_id}")
     ]])
 
     await bot.send_photo(ADMIN_ID, message.photo[-1].file_id, caption=caption, reply_markup=kb)
@@ -377,55 +679,202 @@ async def handle_payment_photo(message: types.Message):
 # ============
 # 手動 承認/拒否
 # ============
+async def fulfil_order(order_id: str) -> str:
+    """入金済み（paid）の注文を配送し、管理者向けの結果を返す"""
+    order = ORDERS.get(order_id)
+    if not order or order["status"] != "paid":
+        return "⚠️ 処理済みまたは存在しない注文です"
+    queued = OUTBOX.for_order(order_id)
+    if queued:
+        # 在庫とアウトボックスは保存済みで、orders.json への approved の書き込み前に落ちた注文。
+        # もう一度在庫を取ると二重配送になるので、配送待ちとして扱う
+        _recover_approved(order_id, [i["file_id"] for i in queued if i["file_id"]])
+        OUTBOX.wake()
+        return "⚠️ この注文はすでに配送待ちです"
+    uid, choice, count = order["uid"], order["type"], order["count"]
+
+    stock = STOCK.get(choice, [])
+    if not stock:
+        await bot.send_message(uid, "⚠️ 在庫なし。後ほど送信します。")
+        return "在庫なし"
+    if len(stock) < count:
+        await bot.send_message(uid, f"⚠️ 在庫が不足しています（{len(stock)}枚しか残っていません）。")
+        return "在庫不足"
+
+    # 送信前にまとめて確保し、在庫の減少とアウトボックスを同じ保存で書き出す
+    # （並列承認でも同じ在庫を取り合わず、送信途中で落ちても画像を失わない）
+    PENDING_SELECTED.discard(order_id)
+    items = STOCK_HEALTH.take(stock, count)  # 確認済みの在庫から優先して使う
+    for i, file_id in enumerate(items):
+        OUTBOX.enqueue(order_id, uid, file_id, f"✅ {choice} #{i+1}/{count} を送信しました！")
+    OUTBOX.enqueue(order_id, uid, None, NOTICE)
+    save_data()
+    ORDERS.set_status(order_id, "approved", items=items)
+    auto_backup()
+
+    left = await OUTBOX.deliver(order_id)
+    order = ORDERS.get(order_id)
+    if order["status"] == "delivered":
+        return "完了"
+    if order["status"] == "failed":
+        return f"❌ {order.get('note', '送信失敗')}"
+    return f"⚠️ 一部送信失敗（再送待ち {left}件）"
+
+def _recover_approved(order_id: str, items: list | None = None):
+    """アウトボックスに項目があるのに paid のままの注文を approved に進める"""
+    PENDING_SELECTED.discard(order_id)
+    fields = {"items": items} if items else {}
+    ORDERS.set_status(order_id, "approved", note="配送待ちから復旧", **fields)
+    print(f"♻️ 注文 {order_id}: 配送待ちの項目があるため approved に復旧")
+
+async def settle_order(order_id: str, ok: bool):
+    """アウトボックスの項目が片付いた注文を配送済み / 失敗にする"""
+    order = ORDERS.get(order_id)
+    if not order:
+        return
+    if order["status"] == "paid":
+        _recover_approved(order_id)
+    if ok:
+        if order["status"] == "failed":
+            ORDERS.set_status(order_id, "approved")
+        if order["status"] == "approved":
+            ORDERS.set_status(order_id, "delivered")
+        if STATE.get(order["uid"], {}).get("order_id") == order_id:
+            STATE.pop(order["uid"], None)
+    elif order["status"] == "approved":
+        errors = {i["error"] for i in OUTBOX.for_order(order_id) if i["error"]}
+        ORDERS.set_status(order_id, "failed", note="送信失敗: " + " / ".join(errors))
+        print(f"❌ 配送失敗 {order_id}: {errors}")
+        with outbound_priority(PRIO_NOTICE):
+            await bot.send_message(ADMIN_ID, f"❌ 注文 {order_id} の配送が打ち切られました。/outbox で確認してください。")
+
 @dp.callback_query(F.data.startswith("confirm_"))
 async def confirm_send(callback: types.CallbackQuery):
     if callback.from_user.id != ADMIN_ID:
         return await callback.answer("権限なし", show_alert=True)
-    target_id = int(callback.data.split("_")[1])
-    state = STATE.get(target_id)
-    if not state:
-        return await callback.message.answer("⚠️ ユーザーデータなし")
-
-    choice = state["type"]
-    if not STOCK.get(choice):
-        await bot.send_message(target_id, "⚠️ 在庫なし。後ほど送信します。")
-        return await callback.answer("在庫なし")
-
-    count = state.get("count", 1)
-    if len(STOCK[choice]) < count:
-        await bot.send_message(target_id, f"⚠️ 在庫が不足しています（{len(STOCK[choice])}枚しか残っていません）。")
-        return await callback.answer("在庫不足")
-
-    for i in range(count):
-        file_id = STOCK[choice].pop(0)
-        await bot.send_photo(target_id, file_id, caption=f"✅ {choice} #{i+1}/{count} を送信しました！")
-        await log_purchase(target_id, callback.from_user.full_name, choice, state.get("count", 1), state.get("final_price") or LINKS[choice]["price"], state.get("discount_code"))
-
-    save_data(); auto_backup()
-    await bot.send_message(target_id, NOTICE)
-    STATE.pop(target_id, None)
-    await callback.answer("完了")
+    order_id = callback.data.split("_", 1)[1]
+    await callback.answer(await fulfil_order(order_id))
 
 @dp.callback_query(F.data.startswith("deny_"))
 async def deny_payment(callback: types.CallbackQuery):
     if callback.from_user.id != ADMIN_ID:
         return await callback.answer("権限なし", show_alert=True)
-    target_id = int(callback.data.split("_")[1])
-    STATE[callback.from_user.id] = {"stage": "awaiting_reason", "target": target_id}
+    order_id = callback.data.split("_", 1)[1]
+    order = ORDERS.get(order_id)
+    if not order or order["status"] != "paid":
+        return await callback.answer("⚠️ 処理済みまたは存在しない注文です", show_alert=True)
+    set_stage(callback.from_user.id, "awaiting_reason", target=order["uid"], order_id=order_id)
     await callback.message.answer("💬 拒否理由を入力してください。", reply_markup=ForceReply(selective=True))
     await callback.answer("入力待機")
 
-@dp.message(F.reply_to_message)
-async def handle_reason_reply(message: types.Message):
-    admin_state = STATE.get(message.from_user.id)
-    if not admin_state or admin_state.get("stage") != "awaiting_reason": 
+@STAGE_ROUTER.route("awaiting_reason")
+async def handle_reason_reply(message: types.Message, admin_state: dict):
+    if not message.reply_to_message:
         return
     target_id = admin_state["target"]
+    order_id = admin_state.get("order_id")
     reason = message.text.strip()
     await bot.send_message(target_id, f"⚠️ 支払い確認できませんでした。\n理由：{reason}\n\n再度『完了』と送ってください。")
     await message.answer("❌ 拒否理由送信完了")
     STATE.pop(message.from_user.id, None)
-    STATE.pop(target_id, None)
+    PENDING_SELECTED.discard(order_id)
+
+    # 注文を見積り状態に戻し、ユーザーが『完了』から再開できるようにする
+    order = ORDERS.get(order_id)
+    if order and order["status"] == "paid":
+        ORDERS.set_status(order_id, "quoted", note=f"拒否: {reason}")
+        user_state = STATE.get(target_id)
+        if not user_state or user_state.get("order_id") == order_id:
+            STATE[target_id] = {
+                "stage": "waiting_payment", "type": order["type"], "count": order["count"],
+                "final_price": order["price"], "discount_code": order.get("code"), "order_id": order_id,
+            }
+
+# =========================
+# 承認待ち一覧（/pending）: まとめて承認
+# =========================
+def pending_view(page: int) -> tuple[str, InlineKeyboardMarkup]:
+    """承認待ちの1ページ分を描画する。『表示中を全承認』は、このページの注文IDをボタンに埋め込む"""
+    ids = [o["id"] for o in ORDERS.with_status("paid")]
+    pages = max(1, -(-len(ids) // PENDING_PAGE_SIZE))
+    page = min(max(page, 0), pages - 1)
+    visible = ids[page * PENDING_PAGE_SIZE:(page + 1) * PENDING_PAGE_SIZE]
+
+    if not visible:
+        return "✅ 承認待ちはありません。", InlineKeyboardMarkup(inline_keyboard=[])
+
+    lines = [f"🕐 <b>承認待ち {len(ids)}件</b>（{page + 1}/{pages}ページ）\n"]
+    rows = []
+    for oid in visible:
+        o = ORDERS.get(oid)
+        mark = "☑️" if oid in PENDING_SELECTED else "⬜"
+        lines.append(f"{mark} <code>{oid}</code> {o['name']} | {o['type']} x{o['count']} | 💴{o['price']}円"
+                     + (f" | 🎟️{o['code']}" if o["code"] else "")
+                     + (f" | 💰PayPay入金 {o['paid_amount']}円" if "paid_amount" in o else ""))
+        rows.append([
+            InlineKeyboardButton(text=f"{mark} {oid}", callback_data=f"pending_sel_{page}_{oid}"),
+            InlineKeyboardButton(text="🖼 スクショ", callback_data=f"pending_view_{page}_{oid}"),
+        ])
+    nav = []
+    if page > 0:
+        nav.append(InlineKeyboardButton(text="◀️ 前へ", callback_data=f"pending_page_{page - 1}"))
+    if page < pages - 1:
+        nav.append(InlineKeyboardButton(text="次へ ▶️", callback_data=f"pending_page_{page + 1}"))
+    if nav:
+        rows.append(nav)
+    rows.append([
+        InlineKeyboardButton(text=f"✅ 選択分を承認（{len(PENDING_SELECTED)}）", callback_data=f"pending_oksel_{page}"),
+        # 古いメッセージや複数の /pending から押されても、そのメッセージに表示した注文だけを承認する
+        # （8文字 × 5件 + 区切りで callback_data の64バイトに収まる）
+        InlineKeyboardButton(text="✅ 表示中を全承認", callback_data=f"pending_okpage_{page}_{'.'.join(visible)}"),
+    ])
+    return "\n".join(lines), InlineKeyboardMarkup(inline_keyboard=rows)
+
+@dp.message(Command("pending"))
+async def pending_cmd(message: types.Message):
+    if not is_admin(message.from_user.id):
+        return await message.answer("権限なし")
+    text, kb = pending_view(0)
+    await message.answer(text, reply_markup=kb, parse_mode="HTML")
+
+@dp.callback_query(F.data.startswith("pending_"))
+async def pending_action(callback: types.CallbackQuery):
+    if callback.from_user.id != ADMIN_ID:
+        return await callback.answer("権限なし", show_alert=True)
+    _, action, rest = callback.data.split("_", 2)
+    page_str, _, oid = rest.partition("_")
+    page = int(page_str)
+
+    if action == "sel":
+        if oid in PENDING_SELECTED:
+            PENDING_SELECTED.discard(oid)
+        elif oid in ORDERS.by_status["paid"]:
+            PENDING_SELECTED.add(oid)
+    elif action == "view":
+        order = ORDERS.get(oid)
+        if not order or order["status"] != "paid":
+            return await callback.answer("⚠️ 処理済みです", show_alert=True)
+        if not order.get("photo"):
+            return await callback.answer(order.get("note") or "スクショなし", show_alert=True)
+        await bot.send_photo(ADMIN_ID, order["photo"], caption=f"🧾 {oid} | {order['name']} ({order['uid']})")
+        return await callback.answer()
+    elif action in ("oksel", "okpage"):
+        shown = PENDING_SELECTED if action == "oksel" else oid.split(".")
+        targets = [o for o in shown if o in ORDERS.by_status["paid"]]
+        if not targets:
+            return await callback.answer("対象がありません")
+        await callback.answer(f"{len(targets)}件を承認中…")
+        results = await asyncio.gather(*(fulfil_order(o) for o in targets), return_exceptions=True)
+        summary = [f"{o}: {r if isinstance(r, str) else f'❌ {r}'}" for o, r in zip(targets, results)]
+        await callback.message.answer("📦 一括承認の結果\n" + "\n".join(summary))
+
+    text, kb = pending_view(page)
+    try:
+        await callback.message.edit_text(text, reply_markup=kb, parse_mode="HTML")
+    except Exception:
+        pass
+    if action not in ("oksel", "okpage"):
+        await callback.answer()
 
 # ============
 # 各種ユーティリティ
@@ -445,15 +894,250 @@ async def addstock(message: types.Message):
     product_type = parts[1].strip()
     if product_type not in STOCK:
         return await message.answer(f"⚠️ 『{product_type}』 は存在しません。まず /addproduct で作成してください。")
-    STATE[message.from_user.id] = {"stage": "adding_stock", "type": product_type}
+    set_stage(message.from_user.id, "adding_stock", type=product_type)
     await message.answer(f"📸 {product_type} の在庫画像を送ってください。")
 
+# =========================
+# 在庫の一括追加（アルバム / ZIP）
+# =========================
+# 画像は内容の sha256 で重複判定し、/bulkdone でまとめて1回だけ保存する。
+# ハッシュは常に Telegram に保存された写真（再圧縮後）をダウンロードして計算する。
+# ZIP の画像もアップロード後の写真で計算するので、アルバムとZIPで同じ画像が来ても重複と分かる。
+# STOCK_HASHES: file_id → sha256（既存在庫の分は確定時に不足分だけ計算）
+# inflight は処理中の画像の件数（ZIP は読み込み中は1件、展開後は画像の枚数）。
+# /bulkdone は inflight が0になるまで確定しない（途中で確定すると残りの画像が失われる）。
+BULK_CONCURRENCY = 4
+BULK_DONE_WAIT = 5.0  # /bulkdone 時に処理中の画像を待つ秒数（過ぎたら確定せずに知らせる）
+BULK_IMAGE_EXTS = (".png", ".jpg", ".jpeg", ".webp")
+ZIP_MAX_ENTRIES = 500
+ZIP_MAX_BYTES = 200 * 1024 * 1024  # 展開後の合計
+
+async def _download_bytes(file_id: str) -> bytes:
+    buf = await bot.download(file_id)
+    return buf.getvalue()
+
+def _read_zip_images(data: bytes) -> list[tuple[str, bytes, str]]:
+    """ZIP内の画像を (名前, 中身, 元ファイルの sha256) で返す（スレッドで実行）。
+    元ファイルの sha256 は ZIP 内の重複を除くためだけに使う"""
+    images = []
+    with zipfile.ZipFile(io.BytesIO(data)) as zf:
+        entries = [i for i in zf.infolist()
+                   if not i.is_dir() and i.filename.lower().endswith(BULK_IMAGE_EXTS)
+                   and not os.path.basename(i.filename).startswith(".")]
+        if len(entries) > ZIP_MAX_ENTRIES:
+            raise ValueError(f"画像が多すぎます（{len(entries)}件 / 上限 {ZIP_MAX_ENTRIES}件）")
+        # file_size は展開後のサイズ。ZipFile はこれを超えて展開しないので合計で上限を見る
+        total = sum(i.file_size for i in entries)
+        if total > ZIP_MAX_BYTES:
+            raise ValueError(f"展開後のサイズが大きすぎます（{total // 1024 // 1024}MB / 上限 {ZIP_MAX_BYTES // 1024 // 1024}MB）")
+        for info in sorted(entries, key=lambda i: i.filename):
+            content = zf.read(info)
+            images.append((os.path.basename(info.filename), content, hashlib.sha256(content).hexdigest()))
+    return images
+
+async def _bulk_progress(state: dict, final: bool = False):
+    """進捗メッセージを更新（2秒に1回まで）"""
+    now = time.monotonic()
+    if not final and now - state.get("progress_at", 0) < 2:
+        return
+    state["progress_at"] = now
+    text = (f"📥 {state['type']} 一括追加中\n"
+            f"受付: {len(state['batch'])}件 / 重複: {state['dups'] + state['dup_stock']}件 / 失敗: {state['failed']}件"
+            + (f" / 処理中: {state['inflight']}件" if state["inflight"] else ""))
+    try:
+        await bot.edit_message_text(text, chat_id=ADMIN_ID, message_id=state["progress"])
+    except Exception:
+        pass
+
+def _bulk_accept(state: dict, sha: str, file_id: str):
+    if sha in state["batch"]:
+        state["dups"] += 1
+    else:
+        state["batch"][sha] = file_id
+
+async def bulk_add_photo(state: dict, file_id: str):
+    state["inflight"] += 1
+    try:
+        sha = hashlib.sha256(await _download_bytes(file_id)).hexdigest()
+        _bulk_accept(state, sha, file_id)
+    except Exception as e:
+        state["failed"] += 1
+        print(f"⚠️ 一括追加: 画像取得失敗 {e}")
+    finally:
+        state["inflight"] -= 1
+    await _bulk_progress(state)
+
+async def _upload_image(name: str, content: bytes) -> str:
+    """画像をアップロードして file_id を得る（管理者チャットに送って即削除）"""
+    sent = await bot.send_photo(ADMIN_ID, BufferedInputFile(content, filename=name), disable_notification=True)
+    try:
+        await bot.delete_message(ADMIN_ID, sent.message_id)
+    except Exception:
+        pass
+    return sent.photo[-1].file_id
+
+async def bulk_add_zip(state: dict, file_id: str):
+    state["inflight"] += 1
+    try:
+        images = await asyncio.to_thread(_read_zip_images, await _download_bytes(file_id))
+    except Exception as e:
+        state["failed"] += 1
+        state["inflight"] -= 1
+        return await bot.send_message(ADMIN_ID, f"⚠️ ZIPを読み込めませんでした: {e}")
+    state["inflight"] += len(images) - 1  # ZIP 1件分 → 画像の枚数分
+
+    sem = asyncio.Semaphore(BULK_CONCURRENCY)
+    known = set(STOCK_HASHES.values())
+    seen_raw = set()
+
+    async def one(name, content, raw_sha):
+        try:
+            if raw_sha in seen_raw:  # ZIP内の同一ファイルは1回だけアップロード
+                state["dups"] += 1
+                return
+            seen_raw.add(raw_sha)
+            async with sem:
+                try:
+                    file_id = await _upload_image(name, content)
+                    sha = hashlib.sha256(await _download_bytes(file_id)).hexdigest()
+                except Exception as e:
+                    state["failed"] += 1
+                    print(f"⚠️ 一括追加: {name} のアップロード失敗 {e}")
+                    return
+            if sha in known:
+                state["dup_stock"] += 1
+            else:
+                _bulk_accept(state, sha, file_id)
+        finally:
+            state["inflight"] -= 1
+        await _bulk_progress(state)
+
+    await asyncio.gather(*(one(*img) for img in images))
+    await _bulk_progress(state, final=True)
+
+@dp.message(Command("bulkstock"))
+async def bulkstock(message: types.Message):
+    if not is_admin(message.from_user.id):
+        return await message.answer("権限なし")
+    parts = message.text.split(maxsplit=1)
+    if len(parts) < 2:
+        available = " / ".join(STOCK.keys())
+        return await message.answer(f"⚙️ 使い方: /bulkstock <商品名>\n利用可能カテゴリ: {available}")
+    product_type = parts[1].strip()
+    if product_type not in STOCK:
+        return await message.answer(f"⚠️ 『{product_type}』 は存在しません。まず /addproduct で作成してください。")
+    progress = await message.answer(
+        f"📥 {product_type} の一括追加を開始しました。\n"
+        f"画像（アルバム可）またはZIPファイルを送り、最後に /bulkdone で確定してください。"
+    )
+    set_stage(message.from_user.id, "bulk_stock", type=product_type, batch={}, dups=0, dup_stock=0, failed=0, inflight=0,
+              progress=progress.message_id)
+
+@dp.message(F.document)
+async def handle_document(message: types.Message):
+    state = STATE.get(message.from_user.id)
+    if not is_admin(message.from_user.id) or not state or state.get("stage") != "bulk_stock":
+        return
+    if not (message.document.file_name or "").lower().endswith(".zip"):
+        return await message.answer("⚠️ ZIPファイル（画像入り）を送ってください。")
+    await bulk_add_zip(state, message.document.file_id)
+
+@dp.message(Command("bulkdone"))
+async def bulkdone(message: types.Message):
+    uid = message.from_user.id
+    if not is_admin(uid):
+        return await message.answer("権限なし")
+    state = STATE.get(uid)
+    if not state or state.get("stage") != "bulk_stock":
+        return await message.answer("⚠️ 一括追加中ではありません。/bulkstock から始めてください。")
+
+    # 受信中のアルバム/ZIPを少しだけ待つ。終わらなければ確定せず、段階もバッチもそのまま残す
+    deadline = time.monotonic() + BULK_DONE_WAIT
+    while state["inflight"] and time.monotonic() < deadline:
+        await asyncio.sleep(0.2)
+    if state["inflight"]:
+        await _bulk_progress(state, final=True)
+        return await message.answer(
+            f"⏳ まだ {state['inflight']}件 処理中です（受付済み: {len(state['batch'])}件）。\n"
+            f"進捗メッセージの『処理中』が消えてから、もう一度 /bulkdone を送ってください。"
+        )
+
+    # 既存在庫のハッシュ（未計算分だけ取得）
+    in_stock = [f for items in STOCK.values() for f in items]
+    missing = [f for f in in_stock if f not in STOCK_HASHES]
+    if missing:
+        sem = asyncio.Semaphore(BULK_CONCURRENCY)
+        async def fill(f):
+            async with sem:
+                try:
+                    STOCK_HASHES[f] = hashlib.sha256(await _download_bytes(f)).hexdigest()
+                except Exception as e:
+                    print(f"⚠️ 既存在庫のハッシュ取得失敗 {f}: {e}")
+        await asyncio.gather(*(fill(f) for f in missing))
+    alive = set(in_stock)
+    for f in [f for f in STOCK_HASHES if f not in alive]:
+        STOCK_HASHES.pop(f)
+    existing = set(STOCK_HASHES.values())
+
+    choice = state["type"]
+    added, dup_stock = 0, state["dup_stock"]
+    for sha, file_id in state["batch"].items():
+        if sha in existing or file_id in alive:
+            dup_stock += 1
+            continue
+        STOCK[choice].append(file_id)
+        STOCK_HASHES[file_id] = sha
+        existing.add(sha)
+        alive.add(file_id)
+        added += 1
+    save_data()
+    STATE.pop(uid, None)
+    STOCK_HEALTH.wake()
+
+    await _bulk_progress(state, final=True)
+    await message.answer(
+        f"✅ {choice} に {added}件 追加しました（在庫 {len(STOCK[choice])}枚）\n"
+        f"♻️ 重複スキップ: バッチ内 {state['dups']}件 / 既存在庫 {dup_stock}件\n"
+        f"⚠️ 失敗: {state['failed']}件"
+    )
+
 @dp.message(Command("stock"))
 async def stock_cmd(message: types.Message):
     if not is_admin(message.from_user.id): 
         return await message.answer("権限なし")
-    info = "\n".join([f"{k}: {len(v)}枚" for k, v in STOCK.items()])
-    await message.answer(f"📦 在庫状況\n{info}")
+    await message.answer(stock_view())
+
+@dp.message(Command("quarantine"))
+async def quarantine_cmd(message: types.Message):
+    """在庫チェックで隔離した在庫（/quarantine restore [商品] で戻す、clear [商品] で削除）"""
+    if not is_admin(message.from_user.id):
+        return await message.answer("権限なし")
+    args = message.text.split()[1:]
+    if args and args[0] in ("restore", "clear"):
+        product = args[1] if len(args) > 1 else None
+        if product and product not in STOCK:
+            return await message.answer(f"⚠️ 『{product}』 は存在しません。")
+        released = STOCK_HEALTH.release(product)
+        n = sum(len(v) for v in released.values())
+        if args[0] == "restore":
+            for p, file_ids in released.items():
+                STOCK.setdefault(p, []).extend(file_ids)
+            STOCK_HEALTH.wake()
+            save_data()
+            return await message.answer(f"↩️ {n}枚を在庫に戻しました（再チェックされます）。")
+        save_data()
+        return await message.answer(f"🗑️ 隔離中の {n}枚を削除しました。")
+
+    if not STOCK_HEALTH.quarantined():
+        return await message.answer("✅ 隔離中の在庫はありません。")
+    lines = [f"🧪 <b>隔離中の在庫 {STOCK_HEALTH.quarantined()}枚</b>\n"]
+    for product, entries in STOCK_HEALTH.quarantine.items():
+        lines.append(f"<b>{html.escape(product)}</b>: {len(entries)}枚")
+        for q in entries[-10:]:
+            when = time.strftime("%m/%d %H:%M", time.localtime(q["at"]))
+            lines.append(f"　{when} <code>{q['file_id'][:20]}…</code> {html.escape(q['reason'])}")
+    lines.append("\n/quarantine restore [商品] で在庫に戻す / clear [商品] で削除")
+    await message.answer("\n".join(lines), parse_mode="HTML")
 
 @dp.message(Command("code"))
 async def create_code(message: types.Message):
@@ -497,6 +1181,7 @@ async def add_product(message: types.Message):
         return await message.answer(f"⚠️ 「{new_type}」はすでに登録済みです。")
     STOCK[new_type] = []
     LINKS[new_type] = {"url": "未設定", "price": 0, "discount_link": "未設定", "discount_price": 0}
+    PRICING.invalidate()
     save_data()
     await message.answer(
         f"✅ 新しい商品カテゴリ「{new_type}」を追加しました。\n"
@@ -586,7 +1271,7 @@ async def cfgsel_type(callback: types.CallbackQuery):
         await callback.answer()
         return
     mode, target = parts[1], parts[2]
-    STATE[uid] = {"stage": f"config_{mode}", "target": target}
+    set_stage(uid, f"config_{mode}", target=target)
     if "price" in mode:
         await callback.message.answer(f"💴 新しい価格を入力してください。\n対象: {target}")
     elif "link" in mode:
@@ -649,64 +1334,217 @@ async def restore_auto_backup(message: types.Message):
 async def status_cmd(message: types.Message):
     if not is_admin(message.from_user.id): 
         return await message.answer("権限なし")
-    info = (
-        f"📊 Botステータス\n"
-        f"在庫: 通話可能={len(STOCK.get('通話可能', []))} / データ={len(STOCK.get('データ', []))}\n"
-        f"割引コード数: {len(CODES)}\n"
-        f"保存先: {DATA_FILE}\n"
-        f"稼働中: ✅ 正常"
-    )
+    info = status_view() + f"\n\n📤 {OUTBOUND.summary()}\n📮 配送待ち: {len(OUTBOX)}件（失敗中 {len(OUTBOX.stuck())}件）"
+    info += f"\n🧵 {SCHEDULER.summary()}\n📩 未対応のお問い合わせ: {TICKETS.count('open')}件"
     await message.answer(info)
 
+@dp.message(Command("outbox"))
+async def outbox_cmd(message: types.Message):
+    """送信に失敗している配送の一覧（/outbox retry で即時再送）"""
+    if not is_admin(message.from_user.id):
+        return await message.answer("権限なし")
+    args = message.text.split()[1:]
+    if args and args[0] == "retry":
+        for oid in {i["order_id"] for i in OUTBOX.stuck()}:
+            if ORDERS.get(oid) and ORDERS.get(oid)["status"] == "failed":
+                ORDERS.set_status(oid, "approved")
+        n = OUTBOX.retry_all()
+        return await message.answer(f"🔁 {n}件を再送キューに戻しました。")
+
+    stuck = OUTBOX.stuck()
+    if not stuck:
+        return await message.answer(f"✅ 送信失敗中の配送はありません。（送信待ち {len(OUTBOX)}件）")
+    lines = [f"📮 <b>送信失敗中の配送 {len(stuck)}件</b>（送信待ち 計{len(OUTBOX)}件）\n"]
+    for item in stuck[:30]:
+        if item["dead"]:
+            when = "打ち切り"
+        else:
+            when = f"{max(0, int(item['next_at'] - time.time()))}秒後に再送"
+        kind = "画像" if item["file_id"] else "テキスト"
+        lines.append(f"<code>{item['order_id']}</code> → {item['chat_id']} | {kind} | {item['attempts']}回失敗 | {when}\n"
+                     f"　{html.escape(item['error'] or '')}")
+    lines.append("\n/outbox retry で全件を即時再送")
+    await message.answer("\n".join(lines), parse_mode="HTML")
+
 @dp.message(Command("stats"))
 async def stats_cmd(message: types.Message):
     if not is_admin(message.from_user.id):
         return await message.answer("権限なし")
-    total_codes_used = sum(1 for v in CODES.values() if v["used"])
-    text = (
-        f"📊 **販売統計レポート**\n\n"
-        f"🎟️ 使用済み割引コード: {total_codes_used}件\n"
-        f"📦 在庫残数:\n"
-        f"　📞 通話可能: {len(STOCK.get('通話可能', []))}枚\n"
-        f"　💾 データ: {len(STOCK.get('データ', []))}枚\n"
-    )
+    text = stats_view()
     await message.answer(text, parse_mode="HTML")
 
-PURCHASE_LOG = []
-async def log_purchase(uid, username, choice, count, price, code=None):
-    PURCHASE_LOG.append({"uid": uid, "name": username, "type": choice, "count": count, "price": price, "code": code})
-
 @dp.message(Command("history"))
 async def show_history(message: types.Message):
     if not is_admin(message.from_user.id):
         return await message.answer("権限なし")
-    if not PURCHASE_LOG:
+    delivered = ORDERS.with_status("delivered")
+    if not delivered:
         return await message.answer("📄 購入履歴はまだありません。")
     lines = [
-        f"👤 {p['name']} ({p['uid']})\n📦 {p['type']} x{p['count']}枚 | 💴 {p['price']}円" + (f" | 🎟️ {p['code']}" if p['code'] else "")
-        for p in PURCHASE_LOG[-10:]
+        f"👤 {p['name']} ({p['uid']})\n📦 {p['type']} x{p['count']}枚 | 💴 {p['price']}円" + (f" | 🎟️ {p['code']}" if p.get('code') else "")
+        for p in delivered[-10:]
     ]
     await message.answer("🧾 <b>直近の購入履歴（最大10件）</b>\n\n" + "\n\n".join(lines), parse_mode="HTML")
 
+ORDER_STATUS_LABELS = {"quoted": "見積り", "paid": "入金済み", "approved": "配送中", "delivered": "配送済み", "failed": "失敗"}
+
+@dp.message(Command("orders"))
+async def orders_cmd(message: types.Message):
+    """/orders [ステータス…] — 索引から注文を一覧（既定は 入金済みだが未配送）"""
+    if not is_admin(message.from_user.id):
+        return await message.answer("権限なし")
+    statuses = [p for p in message.text.split()[1:] if p in ORDER_STATUSES] or ["paid", "approved"]
+    counts = " / ".join(f"{ORDER_STATUS_LABELS[s]} {ORDERS.count(s)}" for s in ORDER_STATUSES)
+    found = ORDERS.with_status(*statuses)
+    lines = [
+        f"<code>{o['id']}</code> {ORDER_STATUS_LABELS[o['status']]} | {o['name']} ({o['uid']}) | {o['type']} x{o['count']} | 💴{o['price']}円"
+        + (f"\n　📝 {o['note']}" if o.get("note") else "")
+        for o in found[-20:]
+    ]
+    title = "・".join(ORDER_STATUS_LABELS[s] for s in statuses)
+    await message.answer(
+        f"📋 <b>注文一覧（{title}: {len(found)}件）</b>\n{counts}\n\n" + ("\n".join(lines) or "該当なし"),
+        parse_mode="HTML"
+    )
+
+# =========================
+# お問い合わせチケット（/問い合わせ → /inbox で返信・クローズ）
+# =========================
+TICKETS = TicketStore(TICKETS_FILE)
+TICKETS.load()
+INBOX_PAGE_SIZE = 5
+
+def _ticket_buttons(ticket: dict) -> list[InlineKeyboardButton]:
+    tid = ticket["id"]
+    if ticket["status"] == "closed":
+        return [InlineKeyboardButton(text=f"↩️ #{tid} を再開", callback_data=f"treopen_{tid}")]
+    return [
+        InlineKeyboardButton(text=f"💬 #{tid} に返信", callback_data=f"treply_{tid}"),
+        InlineKeyboardButton(text="✅ クローズ", callback_data=f"tclose_{tid}"),
+    ]
+
+def inbox_view(status: str, page: int) -> tuple[str, InlineKeyboardMarkup]:
+    found, pages = TICKETS.page(status, page, INBOX_PAGE_SIZE)
+    page = min(max(page, 0), pages - 1)
+    title = "未対応" if status == "open" else "クローズ済み"
+    if not found:
+        return f"✅ {title}のお問い合わせはありません。", InlineKeyboardMarkup(inline_keyboard=[])
+
+    lines = [f"📩 <b>{title}のお問い合わせ {TICKETS.count(status)}件</b>（{page + 1}/{pages}ページ）\n"]
+    rows = []
+    for t in found:
+        last = t["messages"][-1]
+        waiting = "🔴" if last["from"] == "user" and t["status"] == "open" else "⚪"
+        when = time.strftime("%m/%d %H:%M", time.localtime(t["updated"]))
+        preview = last["text"].replace("\n", " ")
+        preview = preview[:40] + ("…" if len(preview) > 40 else "")
+        lines.append(f"{waiting} <b>#{t['id']}</b> {html.escape(t['name'])} (<code>{t['uid']}</code>) | {len(t['messages'])}件 | {when}\n"
+                     f"　{'👑' if last['from'] == 'admin' else '👤'} {html.escape(preview)}")
+        rows.append(_ticket_buttons(t))
+    nav = []
+    if page > 0:
+        nav.append(InlineKeyboardButton(text="◀️ 前へ", callback_data=f"inbox_{status}_{page - 1}"))
+    if page < pages - 1:
+        nav.append(InlineKeyboardButton(text="次へ ▶️", callback_data=f"inbox_{status}_{page + 1}"))
+    if nav:
+        rows.append(nav)
+    return "\n".join(lines), InlineKeyboardMarkup(inline_keyboard=rows)
+
+async def send_ticket_reply(ticket: dict, text: str):
+    await bot.send_message(ticket["uid"], f"💬 管理者からの返信（お問い合わせ #{ticket['id']}）:\n\n{text}", parse_mode="HTML")
+    TICKETS.reply(ticket["id"], text)
+
 @dp.message(Command("問い合わせ"))
 async def inquiry_start(message: types.Message):
-    STATE[message.from_user.id] = {"stage": "inquiry_waiting"}
+    set_stage(message.from_user.id, "inquiry_waiting")
     await message.answer("💬 お問い合わせ内容を入力してください。\n（送信後、管理者に転送されます）")
 
+@dp.message(Command("inbox"))
+async def inbox_cmd(message: types.Message):
+    """/inbox [closed] — 未対応（既定）またはクローズ済みのお問い合わせ一覧"""
+    if not is_admin(message.from_user.id):
+        return await message.answer("権限なし")
+    status = "closed" if message.text.split()[1:2] == ["closed"] else "open"
+    text, kb = inbox_view(status, 0)
+    await message.answer(text, reply_markup=kb, parse_mode="HTML")
+
+@dp.callback_query(F.data.startswith("inbox_"))
+async def inbox_page(callback: types.CallbackQuery):
+    if callback.from_user.id != ADMIN_ID:
+        return await callback.answer("権限なし", show_alert=True)
+    _, status, page = callback.data.split("_")
+    text, kb = inbox_view(status, int(page))
+    try:
+        await callback.message.edit_text(text, reply_markup=kb, parse_mode="HTML")
+    except Exception:
+        pass
+    await callback.answer()
+
+@dp.callback_query(F.data.startswith(("treply_", "tclose_", "treopen_")))
+async def ticket_action(callback: types.CallbackQuery):
+    if callback.from_user.id != ADMIN_ID:
+        return await callback.answer("権限なし", show_alert=True)
+    action, tid = callback.data.split("_", 1)
+    ticket = TICKETS.get(int(tid))
+    if ticket is None:
+        return await callback.answer("⚠️ 存在しないお問い合わせです", show_alert=True)
+
+    if action == "treply":
+        set_stage(callback.from_user.id, "ticket_reply", ticket=ticket["id"])
+        history = "\n".join(f"{'👑' if m['from'] == 'admin' else '👤'} {m['text']}" for m in ticket["messages"][-5:])
+        await callback.message.answer(f"💬 #{ticket['id']} {ticket['name']} への返信を入力してください。\n\n{history}",
+                                      reply_markup=ForceReply(selective=True))
+        return await callback.answer("入力待機")
+    if action == "tclose":
+        TICKETS.close(ticket["id"])
+        await callback.answer(f"✅ #{ticket['id']} をクローズしました")
+    else:
+        TICKETS.reopen(ticket["id"])
+        await callback.answer(f"↩️ #{ticket['id']} を再開しました")
+    try:
+        await callback.message.edit_reply_markup(reply_markup=InlineKeyboardMarkup(inline_keyboard=[_ticket_buttons(ticket)]))
+    except Exception:
+        pass
+
+@STAGE_ROUTER.route("ticket_reply")
+async def handle_ticket_reply(message: types.Message, admin_state: dict):
+    if not message.reply_to_message:
+        return
+    ticket = TICKETS.get(admin_state["ticket"])
+    STATE.pop(message.from_user.id, None)
+    try:
+        await send_ticket_reply(ticket, message.text.strip())
+    except Exception as e:
+        return await message.answer(f"⚠️ 返信に失敗しました。\nエラー内容: {e}")
+    await message.answer(f"✅ #{ticket['id']} に返信しました。",
+                         reply_markup=InlineKeyboardMarkup(inline_keyboard=[_ticket_buttons(ticket)]))
+
 @dp.message(Command("返信"))
 async def reply_to_user(message: types.Message):
+    """/返信 #12 内容 または /返信 <ユーザーID> 内容（未対応チケットがあればそこに記録）"""
     if not is_admin(message.from_user.id):
         return await message.answer("権限なし")
     try:
         parts = message.text.split(maxsplit=2)
         if len(parts) < 3:
-            return await message.answer("⚙️ 使い方: /返信 <ユーザーID> <内容>\n例: /返信 5397061486 こんにちは！")
-        target_id_str = parts[1].strip()
+            return await message.answer("⚙️ 使い方: /返信 <#チケット番号 または ユーザーID> <内容>\n"
+                                        "例: /返信 #12 こんにちは！ / /返信 5397061486 こんにちは！")
+        target = parts[1].strip()
         reply_text = parts[2].strip()
-        if not target_id_str.isdigit():
-            return await message.answer("⚠️ ユーザーIDは数字で指定してください。")
-        target_id = int(target_id_str)
-        await bot.send_message(target_id, f"💬 管理者からのお知らせ:\n\n{reply_text}", parse_mode="HTML")
+        if target.startswith("#") and target[1:].isdigit():
+            ticket = TICKETS.get(int(target[1:]))
+            if ticket is None:
+                return await message.answer(f"⚠️ お問い合わせ {target} は存在しません。")
+            await send_ticket_reply(ticket, reply_text)
+            return await message.answer(f"✅ #{ticket['id']}（ユーザー {ticket['uid']}）に返信を送信しました。")
+        if not target.isdigit():
+            return await message.answer("⚠️ ユーザーIDは数字、チケットは #番号 で指定してください。")
+        target_id = int(target)
+        ticket = TICKETS.open_for(target_id)
+        if ticket is not None:
+            await send_ticket_reply(ticket, reply_text)
+        else:
+            await bot.send_message(target_id, f"💬 管理者からのお知らせ:\n\n{reply_text}", parse_mode="HTML")
         await message.answer(f"✅ ユーザー {target_id} に返信を送信しました。")
     except Exception as e:
         await message.answer(f"⚠️ 返信に失敗しました。\nエラー内容: {e}")
@@ -714,60 +1552,71 @@ async def reply_to_user(message: types.Message):
 # ユーザー記録 & 設定入力
 def load_users():
     if os.path.exists(USERS_FILE):
-        with open(USERS_FILE, "r", encoding="utf-8") as f:
-            return set(json.load(f))
+        return set(storage.read(USERS_FILE))
     return set()
 
+@timed("persist")
 def save_users(users):
-    with open(USERS_FILE, "w", encoding="utf-8") as f:
-        json.dump(list(users), f, ensure_ascii=False, indent=2)
+    storage.write(USERS_FILE, list(users))
+    WATCHER.mark(USERS_FILE)
 
 USERS = load_users()
 
-@dp.message(F.text)
-async def handle_text_input(message: types.Message):
+@STAGE_ROUTER.route(*CONFIG_STAGES)
+async def handle_config_input(message: types.Message, state: dict):
     uid = message.from_user.id
-    text = message.text.strip()
-    state = STATE.get(uid)
-
-    # 管理者設定（価格/リンク）
-    if is_admin(uid) and state and "config_" in state.get("stage", ""):
-        stage = state["stage"]; target = state["target"]; new_value = text
-        LINKS.setdefault(target, {"url": "未設定", "price": 0, "discount_link": "未設定", "discount_price": 0})
-
-        if "price" in stage and "link" not in stage:
-            if not new_value.isdigit():
-                return await message.answer("⚠️ 数値を入力してください（例: 1500）")
-            val = int(new_value)
-            if "discount" in stage:
-                LINKS[target]["discount_price"] = val; msg = f"💴 {target} の割引価格を {val} 円に更新しました。"
-            else:
-                LINKS[target]["price"] = val; msg = f"💴 {target} の通常価格を {val} 円に更新しました。"
-        elif "link" in stage:
-            if not (new_value.startswith("http://") or new_value.startswith("https://")):
-                return await message.answer("⚠️ 有効なURLを入力してください。")
-            if "discount" in stage:
-                LINKS[target]["discount_link"] = new_value; msg = f"🔗 {target} の割引リンクを更新しました。"
-            else:
-                LINKS[target]["url"] = new_value; msg = f"🔗 {target} の通常リンクを更新しました。"
+    if not is_admin(uid):
+        return
+    stage = state["stage"]; target = state["target"]; new_value = message.text.strip()
+    LINKS.setdefault(target, {"url": "未設定", "price": 0, "discount_link": "未設定", "discount_price": 0})
+
+    if "price" in stage and "link" not in stage:
+        if not new_value.isdigit():
+            return await message.answer("⚠️ 数値を入力してください（例: 1500）")
+        val = int(new_value)
+        if "discount" in stage:
+            LINKS[target]["discount_price"] = val; msg = f"💴 {target} の割引価格を {val} 円に更新しました。"
+        else:
+            LINKS[target]["price"] = val; msg = f"💴 {target} の通常価格を {val} 円に更新しました。"
+    elif "link" in stage:
+        if not (new_value.startswith("http://") or new_value.startswith("https://")):
+            return await message.answer("⚠️ 有効なURLを入力してください。")
+        if "discount" in stage:
+            LINKS[target]["discount_link"] = new_value; msg = f"🔗 {target} の割引リンクを更新しました。"
         else:
-            return await message.answer("⚠️ 不明な設定モードです。")
+            LINKS[target]["url"] = new_value; msg = f"🔗 {target} の通常リンクを更新しました。"
+    else:
+        return await message.answer("⚠️ 不明な設定モードです。")
 
-        save_data()
-        STATE.pop(uid, None)
-        return await message.answer(f"✅ {msg}")
+    PRICING.invalidate()
+    save_data()
+    STATE.pop(uid, None)
+    return await message.answer(f"✅ {msg}")
 
-    if state and state.get("stage") == "inquiry_waiting":
-        await bot.send_message(ADMIN_ID, f"📩 新しいお問い合わせ\n👤 {message.from_user.full_name}\n🆔 {uid}\n\n📝 内容:\n{text}")
-        await message.answer("✅ お問い合わせを送信しました。返信までお待ちください。")
-        STATE.pop(uid, None)
-        return
+@STAGE_ROUTER.route("inquiry_waiting")
+async def handle_inquiry(message: types.Message, state: dict):
+    uid = message.from_user.id
+    text = message.text.strip()
+    ticket, new = TICKETS.submit(uid, message.from_user.full_name, text)
+    head = "📩 新しいお問い合わせ" if new else "📩 お問い合わせの追記"
+    with outbound_priority(PRIO_NOTICE):
+        await bot.send_message(ADMIN_ID, f"{head} #{ticket['id']}\n👤 {message.from_user.full_name}\n🆔 {uid}\n\n📝 内容:\n{text}",
+                               reply_markup=InlineKeyboardMarkup(inline_keyboard=[_ticket_buttons(ticket)]))
+    await message.answer("✅ お問い合わせを送信しました。返信までお待ちください。")
+    STATE.pop(uid, None)
+
+# テキストはすべてここに集約し、ステージで1回だけ振り分ける
+@dp.message(F.text, ~F.text.startswith("/"))
+async def handle_text_input(message: types.Message):
+    uid = message.from_user.id
 
     # ユーザー登録
     if uid not in USERS:
         USERS.add(uid); save_users(USERS)
         print(f"👤 新規ユーザー登録: {uid} ({message.from_user.full_name})")
 
+    await STAGE_ROUTER.dispatch(message, STATE.get(uid))
+
 # =========================
 # 💳 Stripe Checkout 連携
 # =========================
@@ -789,29 +1638,75 @@ else:
     print("⚠️ Stripeの秘密鍵(STRIPE_SECRET_KEY)が未設定です。カード決済機能は無効。")
 
 SESS_FILE = os.path.join(DATA_DIR, "sessions.json")
+
+# Checkout セッションの有効期限（Stripe の expires_at は作成から30分〜24時間）
+# expires_at は API 呼び出しの前に計算するので、下限は通信の遅れを見込んで 31分にする
+STRIPE_SESSION_TTL = min(max(int(os.getenv("STRIPE_SESSION_TTL", "3600")), 1860), 86400)
+# 残り時間がこれ未満のセッションは再利用しない（支払い途中で切れないように）
+STRIPE_SESSION_MIN_LEFT = 300
+STRIPE_SWEEP_INTERVAL = 300
+
 def load_sessions():
     try:
         if os.path.exists(SESS_FILE):
-            with open(SESS_FILE, "r", encoding="utf-8") as f:
-                return json.load(f)
+            sessions = storage.read(SESS_FILE)
+            # 旧形式（expires_at なし）は1TTL後に掃除されるようにする
+            now = int(time.time())
+            for info in sessions.values():
+                info.setdefault("expires_at", now + STRIPE_SESSION_TTL)
+            return {sid: info for sid, info in sessions.items() if info["expires_at"] > now}
     except Exception as e:
         print(f"⚠️ セッション読み込み失敗: {e}")
     return {}
 
+@timed("persist")
 def save_sessions():
     try:
-        with open(SESS_FILE, "w", encoding="utf-8") as f:
-            json.dump(SESSIONS, f, ensure_ascii=False, indent=2)
+        storage.write(SESS_FILE, SESSIONS)
     except Exception as e:
         print(f"⚠️ セッション保存失敗: {e}")
 
 SESSIONS = load_sessions()
 
-async def _send_card_pay_offer(chat_id: int, choice: str, count: int, amount: int):
+def _session_key(uid, choice, count, amount) -> tuple:
+    return (int(uid), choice, int(count), int(amount))
+
+# (uid, 商品, 枚数, 金額) → セッションID。同じ内容の再タップは既存URLを返す
+SESSION_INDEX = {_session_key(i["uid"], i["choice"], i["count"], i["amount"]): sid for sid, i in SESSIONS.items()}
+
+def _forget_session(session_id: str):
+    info = SESSIONS.pop(session_id, None)
+    if info is None:
+        return
+    key = _session_key(info["uid"], info["choice"], info["count"], info["amount"])
+    if SESSION_INDEX.get(key) == session_id:
+        del SESSION_INDEX[key]
+
+def sweep_sessions() -> int:
+    """期限切れのセッションを削除して件数を返す"""
+    now = time.time()
+    expired = [sid for sid, info in SESSIONS.items() if info["expires_at"] <= now]
+    for sid in expired:
+        _forget_session(sid)
+    if expired:
+        save_sessions()
+    return len(expired)
+
+async def session_sweeper():
+    while True:
+        await asyncio.sleep(STRIPE_SWEEP_INTERVAL)
+        removed = sweep_sessions()
+        if removed:
+            print(f"🧹 期限切れStripeセッションを削除: {removed}件（残り {len(SESSIONS)}件）")
+        pruned = ORDERS.prune_quotes()
+        if pruned:
+            print(f"🧹 支払いに進まなかった見積りを削除: {pruned}件（残り {len(ORDERS)}件）")
+
+async def _send_card_pay_offer(chat_id: int, order_id: str):
     """合計金額表示後にカード決済ボタンを提示"""
     try:
         kb = InlineKeyboardMarkup(inline_keyboard=[[
-            InlineKeyboardButton(text="💳 カードで支払う（Stripe）", callback_data=f"ccpay_{choice}_{count}_{amount}")
+            InlineKeyboardButton(text="💳 カードで支払う（Stripe）", callback_data=f"ccpay_{order_id}")
         ]])
         await bot.send_message(chat_id, "💳 クレジットカード決済をご希望の方はこちら👇", reply_markup=kb)
     except Exception as e:
@@ -824,34 +1719,57 @@ async def create_checkout(callback: types.CallbackQuery):
         return await callback.answer()
 
     try:
-        _, choice, count_str, amount_str = callback.data.split("_", 3)
-        count = int(count_str); amount = int(amount_str)
+        order = ORDERS.get(callback.data.split("_", 1)[1])
         uid = callback.from_user.id
+        if not order or order["uid"] != uid or order["status"] != "quoted":
+            await callback.message.answer("⚠️ この注文は期限切れです。/start からやり直してください。")
+            return await callback.answer()
+        choice, count, amount = order["type"], order["count"], order["price"]
+
+        # 同じ内容で有効なセッションがあれば作り直さずにURLを返す
+        key = _session_key(uid, choice, count, amount)
+        cached = SESSIONS.get(SESSION_INDEX.get(key))
+        if cached and cached.get("url") and cached["expires_at"] - time.time() >= STRIPE_SESSION_MIN_LEFT:
+            if cached.get("order_id") != order["id"]:
+                cached["order_id"] = order["id"]
+                save_sessions()
+            await callback.message.answer("✅ カード決済ページを開いてお支払いください👇\n" + cached["url"])
+            return await callback.answer()
 
         success_url = f"{PUBLIC_BASE_URL}/stripe/success?session_id={{CHECKOUT_SESSION_ID}}"
         cancel_url = f"{PUBLIC_BASE_URL}/stripe/cancel"
 
-        session = stripe.checkout.Session.create(
-            mode="payment",
-            success_url=success_url,
-            cancel_url=cancel_url,
-            line_items=[{
-                "price_data": {
-                    "currency": "jpy",
-                    "product_data": {"name": f"{choice} x{count}"},
-                    "unit_amount": amount
-                },
-                "quantity": 1
-            }],
-            metadata={
-                "tg_uid": str(uid),
-                "choice": choice,
-                "count": str(count),
-                "amount": str(amount)
-            }
-        )
-
-        SESSIONS[session.id] = {"uid": uid, "choice": choice, "count": count, "amount": amount}
+        expires_at = int(time.time()) + STRIPE_SESSION_TTL
+        with span("network"):
+            session = await asyncio.to_thread(
+                stripe.checkout.Session.create,
+                mode="payment",
+                expires_at=expires_at,
+                success_url=success_url,
+                cancel_url=cancel_url,
+                line_items=[{
+                    "price_data": {
+                        "currency": "jpy",
+                        "product_data": {"name": f"{choice} x{count}"},
+                        "unit_amount": amount
+                    },
+                    "quantity": 1
+                }],
+                metadata={
+                    "tg_uid": str(uid),
+                    "order_id": order["id"],
+                    "choice": choice,
+                    "count": str(count),
+                    "amount": str(amount)
+                }
+            )
+
+        old = SESSION_INDEX.get(key)
+        if old:
+            _forget_session(old)
+        SESSIONS[session.id] = {"uid": uid, "order_id": order["id"], "choice": choice, "count": count,
+                                "amount": amount, "url": session.url, "expires_at": expires_at}
+        SESSION_INDEX[key] = session.id
         save_sessions()
 
         await callback.message.answer("✅ カード決済ページを開いてお支払いください👇\n" + session.url)
@@ -899,39 +1817,40 @@ async def stripe_webhook(request):
                 print(f"⚠️ セッション情報不備: {session_id}")
                 return web.Response(text="ok")
 
-            # 管理者へ決済通知（何枚・いくら・誰）
-            try:
-                await bot.send_message(
-                    ADMIN_ID,
-                    ("💳 Stripe 決済完了通知\n"
-                     f"🆔 Telegram ID: {uid}\n"
-                     f"📦 タイプ: {choice}\n"
-                     f"🧾 枚数: {count}\n"
-                     f"💴 支払金額: {amount}円\n"
-                     f"🪪 セッションID: {session_id}")
-                )
-            except Exception as e:
-                print("⚠️ 管理者通知失敗:", e)
-
-            # 在庫チェック & 自動送付
+            # 注文を入金済みにして自動送付（在庫不足なら /pending に残る）
+            result = None
             try:
-                if len(STOCK.get(choice, [])) < count:
-                    await bot.send_message(uid, "⚠️ 決済完了しましたが在庫不足のため、後ほどお送りいたします。")
+                order = ORDERS.get(info.get("order_id") or meta.get("order_id"))
+                if order is None:
+                    order = ORDERS.create(uid, name="Stripe-Checkout", type=choice, count=count, price=amount, code=None)
+                if order["status"] == "quoted":
+                    ORDERS.set_status(order["id"], "paid", price=amount, channel="stripe", session_id=session_id)
+                    result = await fulfil_order(order["id"])
+                    print(f"💳 Stripe 注文 {order['id']}: {result}")
                 else:
-                    for i in range(count):
-                        file_id = STOCK[choice].pop(0)
-                        await bot.send_photo(uid, file_id, caption=f"✅ {choice} #{i+1}/{count} を送信しました！（カード決済）")
-                    save_data(); auto_backup()
-                    await bot.send_message(uid, NOTICE)
-                    try:
-                        await log_purchase(uid, "Stripe-Checkout", choice, count, amount, code=None)
-                    except Exception:
-                        pass
+                    print(f"ℹ️ Stripe: 注文 {order['id']} は処理済み（{order['status']}）")
             except Exception as e:
+                result = f"❌ {e}"
                 print(f"❌ 自動承認・送付エラー: {e}")
 
+            # 管理者へ決済通知（何枚・いくら・誰）。配送済みならまとめ送信、要対応なら即時
+            line = f"💳 Stripe 決済完了 | 🆔 {uid} | 📦 {choice} x{count} | 💴 {amount:,}円 | 結果: {result or '処理済み'}"
+            if result in (None, "完了"):
+                DIGEST.add("💳 Stripe", line, amount)
+            else:
+                try:
+                    await _send_admin_notice(line + f"\n🪪 セッションID: {session_id}")
+                except Exception as e:
+                    print("⚠️ 管理者通知失敗:", e)
+
             if session_id in SESSIONS:
-                SESSIONS.pop(session_id, None)
+                _forget_session(session_id)
+                save_sessions()
+
+        elif etype == "checkout.session.expired":
+            session_id = event["data"]["object"]["id"]
+            if session_id in SESSIONS:
+                _forget_session(session_id)
                 save_sessions()
 
         return web.Response(text="ok")
@@ -946,14 +1865,138 @@ async def stripe_success(request):
 async def stripe_cancel(request):
     return web.Response(text="❌ 決済がキャンセルされました。再度お試しください。")
 
+# =========================
+# PayPay コールバック → 自動照合・自動配送
+# =========================
+# URL は {PUBLIC_BASE_URL}/paypay/callback?token=<PAYPAY_WEBHOOK_TOKEN> を登録する。
+# トークン未設定なら自動配送はせず、従来どおり管理者へ通知のみ。
+PAYPAY_WEBHOOK_TOKEN = os.getenv("PAYPAY_WEBHOOK_TOKEN", CONFIG.get("PAYPAY_WEBHOOK_TOKEN", ""))
+
+def make_paypay(cfg: dict) -> PayPayClient:
+    return PayPayClient(
+        os.getenv("PAYPAY_API_KEY", cfg.get("PAYPAY_API_KEY", "")),
+        os.getenv("PAYPAY_API_SECRET", cfg.get("PAYPAY_API_SECRET", "")),
+        os.getenv("PAYPAY_MERCHANT_ID", cfg.get("PAYPAY_MERCHANT_ID", "")),
+    )
+
+PAYPAY = make_paypay(CONFIG)
+if not PAYPAY.enabled:
+    print("⚠️ PayPay API（PAYPAY_API_KEY / SECRET / MERCHANT_ID）が未設定です。固定リンクで案内し、自動照合は無効。")
+
+async def paypay_pay_url(order_id: str, amount: int, static_url: str) -> str:
+    """注文用の PayPay 動的QR を作って URL を返す（金額が変わったら作り直す）。使えなければ固定リンク"""
+    if not PAYPAY.enabled:
+        return static_url
+    order = ORDERS.get(order_id)
+    seq = order.get("paypay_seq", 0) + 1
+    merchant_payment_id = order_id if seq == 1 else f"{order_id}-{seq}"
+    try:
+        if order.get("paypay_code"):
+            await PAYPAY.delete_qr(order["paypay_code"])  # 古い金額の QR で払われないように
+        qr = await PAYPAY.create_qr(merchant_payment_id, amount, f"{order['type']} x{order['count']}（注文 {order_id}）")
+    except Exception as e:
+        print(f"⚠️ PayPay QR作成失敗 {order_id}: {e}")
+        return static_url
+    ORDERS.update(order_id, paypay_code=qr.get("codeId"), paypay_payment_id=merchant_payment_id, paypay_seq=seq)
+    return qr.get("url") or static_url
+
+async def reconcile_paypay(merchant_payment_id: str, amount: int) -> str:
+    """PAYMENT_COMPLETED を注文に照合し、金額一致なら配送まで行う"""
+    order = ORDERS.get(order_id_of(merchant_payment_id))
+    if not order:
+        await bot.send_message(ADMIN_ID, f"⚠️ PayPay入金を照合できませんでした\n注文ID: {merchant_payment_id}\n💴 {amount}円")
+        return "unmatched"
+    merchant_payment_id = order["id"]
+    status = order["status"]
+    # paid で paid_amount があるのは、照合済みで在庫待ち・金額不一致の確認待ちのもの
+    if status in ("approved", "delivered", "failed") or (status == "paid" and "paid_amount" in order):
+        return "duplicate"
+    if status == "paid" and order.get("channel") != "paypay":
+        await bot.send_message(ADMIN_ID, f"⚠️ 支払い済みの注文にPayPay入金がありました（二重払いの可能性）\n"
+                                         f"🧾 注文ID: {merchant_payment_id}\n💴 {amount}円")
+        return "duplicate"
+
+    uid = order["uid"]
+    expected = order["price"]
+    note = f"PayPay入金 {amount}円（請求 {expected}円）"
+    if status == "quoted":
+        ORDERS.set_status(merchant_payment_id, "paid", channel="paypay", paid_amount=amount, note=note)
+        state = STATE.get(uid)
+        if state and state.get("order_id") == merchant_payment_id and state.get("stage") == "waiting_payment":
+            set_stage(uid, "waiting_screenshot", keep=True)
+    else:
+        # 『完了』→ スクショ送信で承認待ちになった注文。スクショの確認を待たずに入金で照合する
+        ORDERS.update(merchant_payment_id, paid_amount=amount, note=note)
+        ORDERS.flush()
+
+    if amount != expected:
+        # 金額不一致は手動承認キューへ
+        kb = InlineKeyboardMarkup(inline_keyboard=[[
+            InlineKeyboardButton(text="✅ 承認", callback_data=f"confirm_{merchant_payment_id}"),
+            InlineKeyboardButton(text="❌ 拒否", callback_data=f"deny_{merchant_payment_id}")
+        ]])
+        await bot.send_message(
+            ADMIN_ID,
+            f"⚠️ PayPay 金額不一致（手動確認）\n🆔 {uid}\n📦 {order['type']} x{order['count']}\n"
+            f"💴 入金 {amount}円 / 請求 {expected}円\n🧾 注文ID: {merchant_payment_id}",
+            reply_markup=kb
+        )
+        if status == "quoted":
+            await bot.send_message(uid, "🕐 お支払いを確認中です。管理者の確認後にお送りします。")
+        return "mismatch"
+
+    result = await fulfil_order(merchant_payment_id)
+    line = (f"✅ PayPay 自動照合 | 🆔 {uid} | 📦 {order['type']} x{order['count']} | 💴 {amount:,}円 | "
+            f"🧾 {merchant_payment_id} | 結果: {result}")
+    if result == "完了":
+        DIGEST.add("✅ PayPay", line, amount)
+    else:
+        await _send_admin_notice(line)
+    return "fulfilled" if result == "完了" else "pending"
+
+async def paypay_callback(request):
+    try:
+        data = await request.json()
+        event = data.get("eventType")
+        body = data.get("data", {}) or {}
+        payment_id = body.get("merchantPaymentId")
+        amount = int((body.get("amount") or {}).get("amount", 0) or 0)
+        print(f"💰 PayPay Webhook受信: {event} {payment_id} {amount}円")
+
+        if event != "PAYMENT_COMPLETED" or not payment_id:
+            return web.Response(text="OK")
+
+        token = request.query.get("token", "")
+        if not PAYPAY_WEBHOOK_TOKEN or not hmac.compare_digest(token, PAYPAY_WEBHOOK_TOKEN):
+            if PAYPAY_WEBHOOK_TOKEN:
+                print("⚠️ PayPayコールバックのトークン不一致")
+                return web.Response(status=403, text="forbidden")
+            DIGEST.add("✅ PayPay", f"✅ PayPay支払い完了 | 注文ID: {payment_id} | 💴 {amount:,}円", amount)
+            return web.Response(text="OK")
+
+        result = await reconcile_paypay(payment_id, amount)
+        return web.Response(text=result)
+
+    except Exception as e:
+        print(f"❌ PayPayコールバックエラー: {e}")
+        return web.Response(status=400, text="error")
+
+def make_web_app():
+    middlewares = [aiohttp_trace_middleware(TRACER)]
+    if RECORDER:
+        middlewares.insert(0, aiohttp_record_middleware(RECORDER))
+    app = web.Application(middlewares=middlewares)
+    app.router.add_post("/stripe/webhook", stripe_webhook)
+    app.router.add_get("/stripe/success", stripe_success)
+    app.router.add_get("/stripe/cancel", stripe_cancel)
+    app.router.add_post("/paypay/callback", paypay_callback)
+    return app
+
 async def start_web_app():
     if not web:
         print("⚠️ aiohttp が無いためWebhookサーバを起動できません。requirements.txt に 'aiohttp' を追加してください。")
         return
-    app = web.Application()
-    app.router.add_post("/stripe/webhook", stripe_webhook)
-    app.router.add_get("/stripe/success", stripe_success)
-    app.router.add_get("/stripe/cancel", stripe_cancel)
+    app = make_web_app()
 
     port = int(os.getenv("PORT", "8080"))
     runner = web.AppRunner(app)
@@ -962,18 +2005,95 @@ async def start_web_app():
     await site.start()
     print(f"🌐 Web server started at http://0.0.0.0:{port}")
 
+# =========================
+# ホットリロード（config.json / data.json / users.json / orders.json）
+# =========================
+# 環境変数で指定された値は常に環境変数が優先（config.json の変更は無視される）。
+RESTART_POLLING = False
+
+def validate_config(cfg):
+    if not isinstance(cfg, dict):
+        raise ValueError("トップレベルがオブジェクトではありません")
+    token = os.getenv("TELEGRAM_TOKEN", cfg.get("TELEGRAM_TOKEN", ""))
+    if not token:
+        raise ValueError("TELEGRAM_TOKEN が未設定です")
+    validate_token(token)
+
+async def apply_config(cfg: dict):
+    global CONFIG, TELEGRAM_TOKEN, STRIPE_SECRET_KEY, STRIPE_WEBHOOK_SECRET, PUBLIC_BASE_URL, PAYPAY_WEBHOOK_TOKEN
+    global bot, RESTART_POLLING, PAYPAY
+    CONFIG = cfg
+    STRIPE_SECRET_KEY = os.getenv("STRIPE_SECRET_KEY", cfg.get("STRIPE_SECRET_KEY", ""))
+    STRIPE_WEBHOOK_SECRET = os.getenv("STRIPE_WEBHOOK_SECRET", cfg.get("STRIPE_WEBHOOK_SECRET", ""))
+    PUBLIC_BASE_URL = os.getenv("PUBLIC_BASE_URL", cfg.get("PUBLIC_BASE_URL", "https://esim.zeabur.app"))
+    PAYPAY_WEBHOOK_TOKEN = os.getenv("PAYPAY_WEBHOOK_TOKEN", cfg.get("PAYPAY_WEBHOOK_TOKEN", ""))
+    PAYPAY = make_paypay(cfg)
+    if stripe and STRIPE_SECRET_KEY:
+        stripe.api_key = STRIPE_SECRET_KEY
+
+    token = os.getenv("TELEGRAM_TOKEN", cfg.get("TELEGRAM_TOKEN", ""))
+    if token != TELEGRAM_TOKEN:
+        # 新しい Bot に差し替えてポーリングをやり直す（STATE などはそのまま）
+        TELEGRAM_TOKEN = token
+        bot = make_bot(token)
+        print("🔑 TELEGRAM_TOKEN が変更されたため Bot を切り替えます")
+        try:
+            RESTART_POLLING = True
+            await dp.stop_polling()
+        except RuntimeError:
+            pass  # まだポーリング開始前
+
+def apply_users(users: list):
+    global USERS
+    USERS = {int(u) for u in users}
+
+async def _reload_failed(path: str, error: str):
+    try:
+        await _send_admin_notice(f"⚠️ {os.path.basename(path)} の再読み込みに失敗しました（現在の内容を維持）\n{error}")
+    except Exception as e:
+        print("⚠️ 管理者通知失敗:", e)
+
+WATCHER.on_error = _reload_failed
+WATCHER.watch(CONFIG_PATH, apply_config, validate_config)
+WATCHER.watch(DATA_FILE, apply_data, validate_data)
+WATCHER.watch(USERS_FILE, apply_users, lambda users: {int(u) for u in users})
+WATCHER.watch(ORDERS_FILE, ORDERS.replace, validate_orders)
+
 # ==============
 # アプリ起動部
 # ==============
 async def telegram_polling():
+    global RESTART_POLLING
     print("🤖 eSIM自販機Bot 起動中...")
-    await dp.start_polling(bot)
+    while True:
+        RESTART_POLLING = False
+        await dp.start_polling(bot)
+        if not RESTART_POLLING:
+            break
+        print("🤖 新しいトークンでポーリングを再開します")
 
 async def main():
     # Telegram と Webhook を並列起動
-    web_task = asyncio.create_task(start_web_app())
+    await start_web_app()
     tg_task = asyncio.create_task(telegram_polling())
-    await asyncio.gather(web_task, tg_task)
+    background = [
+        asyncio.create_task(session_sweeper()),
+        asyncio.create_task(OUTBOX.run()),
+        asyncio.create_task(WATCHER.run()),
+        asyncio.create_task(STOCK_HEALTH.run()),
+    ]
+    # SIGTERM / Ctrl+C は aiogram が受けてポーリングだけを止めるので、
+    # ポーリングが終わったら常駐タスクも止めて、書き込み待ちの注文を保存してから終了する
+    try:
+        done, _ = await asyncio.wait([tg_task, *background], return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        for task in [tg_task, *background]:
+            task.cancel()
+        await asyncio.gather(tg_task, *background, return_exceptions=True)
+        ORDERS.flush()
+        print("👋 停止しました")
+    for task in done:
+        task.result()  # 常駐タスクが例外で落ちた場合はそのまま伝える
 
 if __name__ == "__main__":
     asyncio.run(main())
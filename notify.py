@@ -0,0 +1,67 @@
+import asyncio
+import os
+import time
+
+# =========================
+# 管理者通知のまとめ送信（ダイジェスト）
+# =========================
+# 決済完了のような「見るだけ」の通知は1件ずつ送らず、一定間隔で
+# 件数・合計金額つきの1通にまとめる。販売開始直後に通知が殺到しても
+# 送信枠を配送に残せる。承認待ちスクショや照合失敗など、管理者の
+# 操作が必要なものは従来どおり即時に送る（こちらでは扱わない）。
+
+DIGEST_INTERVAL = float(os.getenv("ADMIN_DIGEST_INTERVAL", "30"))
+DIGEST_MAX_LINES = 15
+
+
+class AdminDigest:
+    def __init__(self, send, interval: float = DIGEST_INTERVAL):
+        # send(text): 管理者へ1通送るコルーチン
+        self.send = send
+        self.interval = interval
+        self.entries: list[tuple[str, int, str]] = []
+        self.since = 0.0
+        self._task: asyncio.Task | None = None
+
+    def add(self, kind: str, line: str, amount: int = 0):
+        """通知を溜める。最初の1件から interval 秒後にまとめて送る"""
+        if not self.entries:
+            self.since = time.time()
+        self.entries.append((kind, amount, line))
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._flush_later())
+
+    async def _flush_later(self):
+        # 送信中に溜まった分も次の間隔で送る
+        while self.entries:
+            await asyncio.sleep(self.interval)
+            await self.flush()
+
+    def render(self, entries: list) -> str:
+        totals: dict[str, list[int]] = {}
+        for kind, amount, _ in entries:
+            t = totals.setdefault(kind, [0, 0])
+            t[0] += 1
+            t[1] += amount
+        elapsed = max(1, int(time.time() - self.since))
+        lines = [f"📬 通知まとめ（{elapsed}秒間 / {len(entries)}件）"]
+        for kind, (count, amount) in totals.items():
+            lines.append(f"　{kind}: {count}件" + (f" / 💴 {amount:,}円" if amount else ""))
+        lines.append("")
+        lines.extend(line for _, _, line in entries[-DIGEST_MAX_LINES:])
+        if len(entries) > DIGEST_MAX_LINES:
+            lines.append(f"…ほか {len(entries) - DIGEST_MAX_LINES}件")
+        return "\n".join(lines)
+
+    async def flush(self):
+        if not self.entries:
+            return
+        entries, self.entries = self.entries, []
+        if len(entries) == 1:
+            text = entries[0][2]
+        else:
+            text = self.render(entries)
+        try:
+            await self.send(text)
+        except Exception as e:
+            print(f"⚠️ 通知まとめの送信失敗（{len(entries)}件）: {e}")
@@ -0,0 +1,208 @@
+import asyncio
+import os
+import random
+import string
+import time
+
+import storage
+from tracing import timed
+
+# =========================
+# 注文レコード（ID / ユーザー / ステータスで索引）
+# =========================
+# quoted(見積り) → paid(入金・スクショ受領) → approved(在庫確保) → delivered(配送済み)
+#                                          ↘ failed
+# 拒否された paid は quoted に戻り、ユーザーは再度『完了』から進められる。
+# 見積り（quoted）は枚数入力のたびに作られるので、支払いに進まないまま
+# ORDER_QUOTE_TTL_HOURS を過ぎたものは prune_quotes() で捨てる。
+# 見積りの作成・更新は ORDER_SAVE_DELAY 秒まとめて1回で書き、ステータス遷移は即座に書く。
+
+ORDER_STATUSES = ("quoted", "paid", "approved", "delivered", "failed")
+
+ORDER_TRANSITIONS = {
+    "quoted": {"paid", "failed"},
+    "paid": {"approved", "quoted", "failed"},
+    "approved": {"delivered", "failed", "paid"},
+    "failed": {"approved"},
+    "delivered": set(),
+}
+
+# 完了済み（delivered / failed）の注文を保持する日数
+ORDER_RETENTION_DAYS = int(os.getenv("ORDER_RETENTION_DAYS", "90"))
+# 支払いに進まなかった見積りを保持する時間（Stripe セッションの最長 24時間より長くする）
+ORDER_QUOTE_TTL_HOURS = float(os.getenv("ORDER_QUOTE_TTL_HOURS", "48"))
+# 見積りの作成・更新をまとめて書き込むまでの待ち時間
+ORDER_SAVE_DELAY = float(os.getenv("ORDER_SAVE_DELAY", "2"))
+
+
+def validate_orders(orders):
+    """orders.json の中身を検証（外部編集の再読み込み用）。不正なら ValueError"""
+    if not isinstance(orders, list):
+        raise ValueError("注文データが配列ではありません")
+    seen = set()
+    for order in orders:
+        if not isinstance(order, dict) or not {"id", "uid", "status", "updated"} <= order.keys():
+            raise ValueError(f"注文に id / uid / status / updated がありません: {order!r:.80}")
+        if order["status"] not in ORDER_STATUSES:
+            raise ValueError(f"注文 {order['id']}: 不明なステータス {order['status']}")
+        if order["id"] in seen:
+            raise ValueError(f"注文IDが重複しています: {order['id']}")
+        seen.add(order["id"])
+
+
+class OrderStore:
+    def __init__(self, path: str):
+        self.path = path
+        self.orders: dict[str, dict] = {}
+        # 索引は「挿入順を保つ集合」として dict[id, None] を使う
+        self.by_user: dict[int, dict[str, None]] = {}
+        self.by_status: dict[str, dict[str, None]] = {s: {} for s in ORDER_STATUSES}
+        self.after_save = None  # 保存後に呼ぶ（ファイル監視に自分の書き込みを伝える）
+        self.save_delay = ORDER_SAVE_DELAY
+        self._dirty = False
+        self._save_task: asyncio.Task | None = None
+
+    def __contains__(self, order_id) -> bool:
+        return order_id in self.orders
+
+    def __len__(self) -> int:
+        return len(self.orders)
+
+    def get(self, order_id: str) -> dict | None:
+        return self.orders.get(order_id)
+
+    def new_id(self) -> str:
+        while True:
+            oid = "".join(random.choices(string.ascii_uppercase + string.digits, k=8))
+            if oid not in self.orders:
+                return oid
+
+    def _index(self, order: dict):
+        self.by_user.setdefault(order["uid"], {})[order["id"]] = None
+        self.by_status[order["status"]][order["id"]] = None
+
+    def _unindex(self, order: dict):
+        self.by_status[order["status"]].pop(order["id"], None)
+        user = self.by_user.get(order["uid"], {})
+        user.pop(order["id"], None)
+        if not user:
+            self.by_user.pop(order["uid"], None)
+
+    def create(self, uid: int, status: str = "quoted", **fields) -> dict:
+        now = time.time()
+        order = {"id": self.new_id(), "uid": uid, "status": status, "created": now, "updated": now,
+                 "history": [[status, now]], **fields}
+        self.orders[order["id"]] = order
+        self._index(order)
+        if status == "quoted":
+            self.save_soon()
+        else:
+            self.save()
+        return order
+
+    def update(self, order_id: str, **fields) -> dict:
+        order = self.orders[order_id]
+        order.update(fields)
+        order["updated"] = time.time()
+        self.save_soon()
+        return order
+
+    def set_status(self, order_id: str, status: str, **fields) -> dict:
+        """ステータスを遷移させる（遷移表にないものは ValueError）"""
+        order = self.orders[order_id]
+        prev = order["status"]
+        if status not in ORDER_TRANSITIONS[prev]:
+            raise ValueError(f"注文 {order_id}: {prev} → {status} は無効な遷移です")
+        self.by_status[prev].pop(order_id, None)
+        order.update(fields)
+        order["status"] = status
+        order["updated"] = time.time()
+        order["history"].append([status, order["updated"]])
+        self.by_status[status][order_id] = None
+        self.save()
+        return order
+
+    def with_status(self, *statuses: str) -> list[dict]:
+        """指定ステータスの注文（作成順）。索引だけを見るので全件走査しない"""
+        found = [self.orders[oid] for s in statuses for oid in self.by_status[s]]
+        if len(statuses) > 1:
+            found.sort(key=lambda o: o["created"])
+        return found
+
+    def count(self, status: str) -> int:
+        return len(self.by_status[status])
+
+    def for_user(self, uid: int) -> list[dict]:
+        return [self.orders[oid] for oid in self.by_user.get(uid, ())]
+
+    def prune_quotes(self, ttl_hours: float = ORDER_QUOTE_TTL_HOURS) -> int:
+        """支払いに進まないまま古くなった見積りを捨てる。捨てた件数を返す"""
+        cutoff = time.time() - ttl_hours * 3600
+        expired = [oid for oid in self.by_status["quoted"] if self.orders[oid]["updated"] < cutoff]
+        for oid in expired:
+            self._unindex(self.orders.pop(oid))
+        if expired:
+            self.save()
+        return len(expired)
+
+    def replace(self, orders: list):
+        """注文一覧を丸ごと差し替えて索引を作り直す"""
+        self.orders.clear()
+        self.by_user.clear()
+        for index in self.by_status.values():
+            index.clear()
+        self._dirty = False  # 書き込み待ちの変更は差し替えで失われる
+        now = time.time()
+        cutoff = now - ORDER_RETENTION_DAYS * 86400
+        quote_cutoff = now - ORDER_QUOTE_TTL_HOURS * 3600
+        for order in orders:
+            if order["status"] in ("delivered", "failed") and order["updated"] < cutoff:
+                continue
+            if order["status"] == "quoted" and order["updated"] < quote_cutoff:
+                continue
+            self.orders[order["id"]] = order
+            self._index(order)
+
+    def load(self):
+        try:
+            if os.path.exists(self.path):
+                orders = storage.read(self.path)
+            else:
+                orders = []
+        except Exception as e:
+            print(f"⚠️ 注文データ読み込み失敗: {e}")
+            orders = []
+        self.replace(orders)
+
+    def save_soon(self):
+        """save_delay 秒後にまとめて保存する（イベントループ外では即座に保存）"""
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            return self.save()
+        self._dirty = True
+        if self._save_task is None or self._save_task.done():
+            self._save_task = asyncio.create_task(self._save_later())
+
+    async def _save_later(self):
+        try:
+            await asyncio.sleep(self.save_delay)
+        finally:
+            # 終了時にキャンセルされても、溜まった変更は書いておく
+            if self._dirty:
+                self.save()
+
+    def flush(self):
+        """書き込み待ちの変更があれば今すぐ保存する"""
+        if self._dirty:
+            self.save()
+
+    @timed("persist")
+    def save(self):
+        self._dirty = False
+        try:
+            storage.write(self.path, list(self.orders.values()))
+            if self.after_save is not None:
+                self.after_save(self.path)
+        except Exception as e:
+            print(f"⚠️ 注文データ保存失敗: {e}")
@@ -0,0 +1,171 @@
+import asyncio
+import contextvars
+import heapq
+import itertools
+import time
+from collections import deque
+from contextlib import contextmanager
+
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.exceptions import TelegramRetryAfter
+
+from tracing import span
+
+# =========================
+# 送信レート制御（Telegram flood 対策）
+# =========================
+# Bot セッションの request middleware として全API呼び出しを通す。
+#   - 全体: 25件/秒
+#   - 個別チャット: 1件/秒（短いバーストは許可）
+#   - グループ: 20件/分
+# 全体枠は優先度順（配送 > 通常返信 > 管理者通知 > バックグラウンド）に払い出す。
+# 429 (TelegramRetryAfter) は retry_after 秒そのチャットを止めてから再送する。
+
+PRIO_DELIVERY = 0
+PRIO_REPLY = 1
+PRIO_NOTICE = 2
+PRIO_BACKGROUND = 3
+PRIO_NAMES = {PRIO_DELIVERY: "配送", PRIO_REPLY: "返信", PRIO_NOTICE: "通知", PRIO_BACKGROUND: "BG"}
+
+_PRIORITY: contextvars.ContextVar[int] = contextvars.ContextVar("esim_out_priority", default=PRIO_REPLY)
+
+
+@contextmanager
+def outbound_priority(priority: int):
+    """with 内の送信を指定優先度で行う"""
+    token = _PRIORITY.set(priority)
+    try:
+        yield
+    finally:
+        _PRIORITY.reset(token)
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+
+    def delay(self, now: float) -> float:
+        """トークン1個が使えるまでの秒数（0なら即時）"""
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if now < self.blocked_until:
+            return self.blocked_until - now
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def consume(self):
+        self.tokens -= 1
+
+    def block(self, seconds: float):
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+    def idle(self, now: float) -> bool:
+        return now >= self.blocked_until and self.tokens + (now - self.updated) * self.rate >= self.capacity
+
+
+class OutboundLimiter(BaseRequestMiddleware):
+    """全送信をトークンバケットで整列させる request middleware"""
+
+    def __init__(self, global_rate: float = 25, chat_rate: float = 1, chat_burst: float = 3,
+                 group_rate: float = 20 / 60, group_burst: float = 3, max_retries: int = 3):
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.chat_rate, self.chat_burst = chat_rate, chat_burst
+        self.group_rate, self.group_burst = group_rate, group_burst
+        self.max_retries = max_retries
+        self.chats: dict = {}
+        self._waiters: list = []
+        self._seq = itertools.count()
+        self._pump: asyncio.Task | None = None
+        self.waits = {p: deque(maxlen=200) for p in PRIO_NAMES}
+        self.sent = {p: 0 for p in PRIO_NAMES}
+        self.retried = 0
+
+    def _chat_bucket(self, chat_id) -> TokenBucket:
+        bucket = self.chats.get(chat_id)
+        if bucket is None:
+            if len(self.chats) > 10_000:
+                now = time.monotonic()
+                self.chats = {k: b for k, b in self.chats.items() if not b.idle(now)}
+            is_group = isinstance(chat_id, str) or chat_id < 0
+            if is_group:
+                bucket = TokenBucket(self.group_rate, self.group_burst)
+            else:
+                bucket = TokenBucket(self.chat_rate, self.chat_burst)
+            self.chats[chat_id] = bucket
+        return bucket
+
+    async def _acquire(self, chat_id, priority: int):
+        if chat_id is not None:
+            bucket = self._chat_bucket(chat_id)
+            while (wait := bucket.delay(time.monotonic())) > 0:
+                await asyncio.sleep(wait)
+            bucket.consume()
+
+        fut = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._seq), fut))
+        if self._pump is None or self._pump.done():
+            self._pump = asyncio.create_task(self._run_pump())
+        await fut
+
+    async def _run_pump(self):
+        # 全体枠を優先度順に払い出す（待機中に高優先度が来たら先に通す）
+        while self._waiters:
+            wait = self.global_bucket.delay(time.monotonic())
+            if wait > 0:
+                await asyncio.sleep(wait)
+                continue
+            _, _, fut = heapq.heappop(self._waiters)
+            if fut.done():
+                continue
+            self.global_bucket.consume()
+            fut.set_result(None)
+
+    async def __call__(self, make_request, bot, method):
+        chat_id = getattr(method, "chat_id", None)
+        priority = _PRIORITY.get()
+        enqueued = time.monotonic()
+        for attempt in range(self.max_retries + 1):
+            with span("throttle"):
+                await self._acquire(chat_id, priority)
+            if attempt == 0:
+                self.waits[priority].append(time.monotonic() - enqueued)
+                self.sent[priority] += 1
+            try:
+                return await make_request(bot, method)
+            except TelegramRetryAfter as e:
+                if attempt >= self.max_retries:
+                    raise
+                self.retried += 1
+                print(f"⏳ 送信制限(429): {type(method).__name__} chat={chat_id} {e.retry_after}秒待機して再送します")
+                if chat_id is not None:
+                    self._chat_bucket(chat_id).block(e.retry_after)
+                else:
+                    self.global_bucket.block(e.retry_after)
+
+    def queue_depth(self) -> int:
+        return sum(1 for _, _, fut in self._waiters if not fut.done())
+
+    def snapshot(self) -> dict:
+        """優先度ごとの待ち時間統計（ms）"""
+        result = {}
+        for prio, name in PRIO_NAMES.items():
+            samples = sorted(self.waits[prio])
+            if samples:
+                result[name] = {
+                    "sent": self.sent[prio],
+                    "avg_ms": round(sum(samples) / len(samples) * 1000, 1),
+                    "p95_ms": round(samples[min(len(samples) - 1, int(len(samples) * 0.95))] * 1000, 1),
+                    "max_ms": round(samples[-1] * 1000, 1),
+                }
+        return result
+
+    def summary(self) -> str:
+        lines = [f"送信待ち: {self.queue_depth()}件 / 429再送: {self.retried}回"]
+        for name, s in self.snapshot().items():
+            lines.append(f"　{name}: {s['sent']}件 平均{s['avg_ms']}ms p95 {s['p95_ms']}ms 最大{s['max_ms']}ms")
+        return "\n".join(lines)
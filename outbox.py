@@ -0,0 +1,142 @@
+import asyncio
+import os
+import random
+import string
+import time
+
+# =========================
+# 配送アウトボックス（送信前に書き出し → 送信 → 確認で削除）
+# =========================
+# 在庫から取り出した画像は、送信する前に (chat_id, file_id, caption) として
+# アウトボックスに積み、在庫の減少と同じ保存で data.json に書き込む。
+# 送信に成功した項目だけを削除するので、途中で Telegram が失敗しても
+# 残りは失われず、バックオフを挟んで（再起動後も）再送される。
+# 保存は送信パスごとにまとめるため、保存前に落ちた場合は重複送信になりうる（欠落はしない）。
+
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", "8"))
+OUTBOX_BACKOFF_BASE = 5
+OUTBOX_BACKOFF_MAX = 3600
+
+
+class DeliveryOutbox:
+    def __init__(self, save, send, on_settled):
+        # save(): 永続化 / send(item): 1件送信 / on_settled(order_id, ok): 注文の全項目が片付いた時
+        self.save = save
+        self.send = send
+        self.on_settled = on_settled
+        self.items: dict[str, dict] = {}
+        self.loaded = False
+        self._busy: set[str] = set()  # 送信中の注文（同じ注文を並行して送らない）
+        self._wake = asyncio.Event()
+
+    def __len__(self) -> int:
+        return len(self.items)
+
+    def load(self, items: list):
+        self.items = {item["id"]: item for item in items}
+        self.loaded = True
+
+    def dump(self) -> list:
+        return list(self.items.values())
+
+    def enqueue(self, order_id: str, chat_id: int, file_id: str | None, caption: str) -> dict:
+        """送信予定を積む（file_id が None ならテキスト送信）。保存は呼び出し側で行う"""
+        while True:
+            item_id = "".join(random.choices(string.ascii_lowercase + string.digits, k=10))
+            if item_id not in self.items:
+                break
+        item = {"id": item_id, "order_id": order_id, "chat_id": chat_id, "file_id": file_id,
+                "caption": caption, "attempts": 0, "next_at": 0.0, "error": None, "dead": False}
+        self.items[item_id] = item
+        return item
+
+    def wake(self):
+        """待たずに次の送信パスを始めさせる"""
+        self._wake.set()
+
+    def for_order(self, order_id: str) -> list[dict]:
+        return [i for i in self.items.values() if i["order_id"] == order_id]
+
+    def stuck(self) -> list[dict]:
+        """一度以上失敗している項目"""
+        return [i for i in self.items.values() if i["attempts"] > 0]
+
+    def retry_all(self) -> int:
+        """失敗中・打ち切り済みの項目を即時再送の対象に戻す"""
+        stuck = self.stuck()
+        orders = {i["order_id"] for i in stuck}
+        for item in self.items.values():
+            if item["order_id"] in orders:
+                item["dead"] = False
+                item["next_at"] = 0.0
+        if stuck:
+            self.save()
+            self._wake.set()
+        return len(stuck)
+
+    async def deliver(self, order_id: str | None = None) -> int:
+        """期限の来た項目を順に送る（order_id 指定時はその注文のみ）。残件数を返す"""
+        now = time.time()
+        due = [i for i in self.items.values()
+               if not i["dead"] and i["next_at"] <= now and i["order_id"] not in self._busy
+               and (order_id is None or i["order_id"] == order_id)]
+        touched = {i["order_id"] for i in due}
+        self._busy |= touched
+        blocked: dict[str, float] = {}
+        for item in due:
+            oid = item["order_id"]
+            if oid in blocked:
+                # 同じ注文の残りは順番を保つため、失敗した項目と一緒に後回し
+                item["next_at"] = max(item["next_at"], blocked[oid])
+                continue
+            try:
+                await self.send(item)
+            except Exception as e:
+                item["attempts"] += 1
+                item["error"] = str(e)[:200]
+                if item["attempts"] >= OUTBOX_MAX_ATTEMPTS:
+                    item["dead"] = True
+                    print(f"❌ 配送打ち切り {oid} → {item['chat_id']}: {e}")
+                else:
+                    delay = min(OUTBOX_BACKOFF_MAX, OUTBOX_BACKOFF_BASE * 2 ** (item["attempts"] - 1))
+                    item["next_at"] = time.time() + delay
+                    print(f"⚠️ 配送失敗 {oid} → {item['chat_id']}（{item['attempts']}回目, {delay}秒後に再送）: {e}")
+                blocked[oid] = float("inf") if item["dead"] else item["next_at"]
+            else:
+                self.items.pop(item["id"], None)
+        self._busy -= touched
+
+        if due:
+            self.save()
+            self._wake.set()
+        for oid in touched:
+            left = self.for_order(oid)
+            if not left:
+                await self.on_settled(oid, True)
+            elif any(i["dead"] for i in left):
+                await self.on_settled(oid, False)
+
+        if order_id is None:
+            return len(self.items)
+        return len(self.for_order(order_id))
+
+    def next_due(self) -> float | None:
+        times = [i["next_at"] for i in self.items.values() if not i["dead"] and i["order_id"] not in self._busy and i["next_at"] != float("inf")]
+        return min(times) if times else None
+
+    async def run(self):
+        """バックグラウンドの再送ワーカー"""
+        while True:
+            nxt = self.next_due()
+            timeout = None if nxt is None else max(0.0, nxt - time.time())
+            self._wake.clear()
+            if timeout is None or timeout > 0:
+                try:
+                    await asyncio.wait_for(self._wake.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+            try:
+                await self.deliver()
+            except Exception as e:
+                print(f"⚠️ アウトボックス処理エラー: {e}")
+                await asyncio.sleep(OUTBOX_BACKOFF_BASE)
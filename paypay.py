@@ -0,0 +1,91 @@
+import base64
+import hashlib
+import hmac
+import json
+import os
+import time
+import uuid
+
+import aiohttp
+
+from tracing import span
+
+# =========================
+# PayPay 動的QR（注文ごとの支払いコード）
+# =========================
+# 固定の P2P リンクでは入金と注文を結び付けられないので、注文ごとに
+# POST /v2/codes で金額固定の QR を作り、merchantPaymentId に注文IDを入れる。
+# PAYMENT_COMPLETED の merchantPaymentId から注文を O(1) で引ける。
+# 割引コードで金額が変わった時は古い QR を削除し、"注文ID-2" のように枝番を付けて作り直す
+# （merchantPaymentId は再利用できないため）。照合時は "-" より前を注文IDとして扱う。
+#
+# PAYPAY_API_KEY / PAYPAY_API_SECRET / PAYPAY_MERCHANT_ID が未設定なら使わず、従来の固定リンクを案内する。
+# 検証環境は PAYPAY_API_BASE=https://stg-api.sandbox.paypay.ne.jp
+
+PAYPAY_API_BASE = os.getenv("PAYPAY_API_BASE", "https://api.paypay.ne.jp")
+PAYPAY_TIMEOUT = 10
+
+
+class PayPayError(Exception):
+    pass
+
+
+def order_id_of(merchant_payment_id: str) -> str:
+    """merchantPaymentId（"注文ID" または "注文ID-枝番"）から注文IDを取り出す"""
+    return merchant_payment_id.partition("-")[0]
+
+
+class PayPayClient:
+    def __init__(self, api_key: str, api_secret: str, merchant_id: str, base_url: str = PAYPAY_API_BASE):
+        self.api_key = api_key
+        self.api_secret = api_secret
+        self.merchant_id = merchant_id
+        self.base_url = base_url.rstrip("/")
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.api_key and self.api_secret and self.merchant_id)
+
+    def auth_header(self, method: str, path: str, body: str) -> str:
+        """OPA の HMAC 認証ヘッダ（本文は content-type と合わせた MD5 を署名に含める）"""
+        nonce = uuid.uuid4().hex[:8]
+        epoch = str(int(time.time()))
+        if body:
+            content_type = "application/json;charset=UTF-8"
+            body_hash = base64.b64encode(hashlib.md5((content_type + body).encode()).digest()).decode()
+        else:
+            content_type = body_hash = "empty"
+        message = "\n".join([path, method, nonce, epoch, content_type, body_hash])
+        mac = base64.b64encode(hmac.new(self.api_secret.encode(), message.encode(), hashlib.sha256).digest()).decode()
+        return f"hmac OPA-Auth:{self.api_key}:{mac}:{nonce}:{epoch}:{body_hash}"
+
+    async def _request(self, method: str, path: str, payload: dict | None = None) -> dict:
+        body = json.dumps(payload, ensure_ascii=False) if payload is not None else ""
+        headers = {"Authorization": self.auth_header(method, path, body), "X-ASSUME-MERCHANT": self.merchant_id}
+        if body:
+            headers["Content-Type"] = "application/json;charset=UTF-8"
+        # 呼ぶのは注文ごとに1〜2回なので、セッションは使い回さない（設定の再読み込みで作り直しても漏れない）
+        with span("network"):
+            async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=PAYPAY_TIMEOUT)) as session:
+                async with session.request(method, self.base_url + path, data=body.encode() or None,
+                                           headers=headers) as resp:
+                    data = await resp.json(content_type=None)
+        code = (data.get("resultInfo") or {}).get("code")
+        if code != "SUCCESS" and not (method == "DELETE" and resp.status == 404):
+            raise PayPayError(f"{method} {path}: {code} {(data.get('resultInfo') or {}).get('message', '')}".strip())
+        return data.get("data") or {}
+
+    async def create_qr(self, merchant_payment_id: str, amount: int, description: str) -> dict:
+        """金額固定の支払いQRを作成し、{"codeId", "url", "deeplink", ...} を返す"""
+        payload = {
+            "merchantPaymentId": merchant_payment_id,
+            "amount": {"amount": amount, "currency": "JPY"},
+            "codeType": "ORDER_QR",
+            "orderDescription": description,
+            "isAuthorization": False,
+            "requestedAt": int(time.time()),
+        }
+        return await self._request("POST", "/v2/codes", payload)
+
+    async def delete_qr(self, code_id: str):
+        await self._request("DELETE", f"/v2/codes/{code_id}")
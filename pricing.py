@@ -0,0 +1,106 @@
+from typing import NamedTuple
+
+# =========================
+# 価格計算（まとめ買い / 割引コード / 金額クーポン）
+# =========================
+# 料金は全てここで決める。関数は純粋関数（同じ入力なら同じ結果）で、
+# QuoteTable は商品 × 枚数 × 割引種別の結果を前もって計算しておく表。
+# /config で価格が変わったら invalidate() で作り直す。
+#
+#   bulk   : 6〜9枚 5%OFF / 10枚以上 10%OFF
+#   code   : 割引コード。1枚目だけ割引価格（2〜5枚は残りを通常価格）。
+#            まとめ買いの方が安ければそちらを採用
+#   coupon : 金額クーポン。まとめ買い適用後の合計から差し引く（0円未満にはしない）
+
+BULK_TIERS = ((10, 0.10, "10%"), (6, 0.05, "5%"))
+CODE_MAX_COUNT = 5
+KINDS = ("bulk", "code")
+TABLE_MAX_COUNT = 100
+
+
+class Quote(NamedTuple):
+    total: int
+    discount_type: str | None  # "5%" / "10%" / "code" / "coupon" / None
+
+
+def unit_prices(choice: str, links: dict, fallback: dict) -> tuple[int, int]:
+    """(通常価格, 割引価格)。LINKS に無ければ固定価格、割引価格も無ければ通常価格"""
+    link = links.get(choice, {})
+    fixed = fallback.get(choice, {})
+    base = link.get("price") or fixed.get("normal", 0)
+    discount = link.get("discount_price") or fixed.get("discount") or base
+    return base, discount
+
+
+def bulk_quote(base: int, count: int) -> Quote:
+    for min_count, rate, label in BULK_TIERS:
+        if count >= min_count:
+            return Quote(int(base * count * (1 - rate)), label)
+    return Quote(base * count, None)
+
+
+def code_quote(base: int, discount: int, count: int) -> Quote:
+    bulk = bulk_quote(base, count)
+    if count > CODE_MAX_COUNT:
+        return bulk
+    total = discount + base * (count - 1)
+    if bulk.total <= total:
+        return bulk
+    return Quote(total, "code")
+
+
+def coupon_quote(base: int, count: int, off: int) -> Quote:
+    return Quote(max(0, bulk_quote(base, count).total - off), "coupon")
+
+
+def quote(base: int, discount: int, count: int, kind: str = "bulk", off: int = 0) -> Quote:
+    if count <= 0:
+        raise ValueError("枚数は1以上にしてください")
+    if kind == "bulk":
+        return bulk_quote(base, count)
+    if kind == "code":
+        return code_quote(base, discount, count)
+    if kind == "coupon":
+        return coupon_quote(base, count, off)
+    raise ValueError(f"不明な割引種別です: {kind}")
+
+
+class QuoteTable:
+    """商品 × 枚数(1〜max_count) × 割引種別 の見積りを前計算して引く"""
+
+    def __init__(self, links: dict, fallback: dict, max_count: int = TABLE_MAX_COUNT):
+        self.links = links
+        self.fallback = fallback
+        self.max_count = max_count
+        self.table: dict[tuple[str, int, str], Quote] | None = None
+        self.units: dict[str, tuple[int, int]] = {}
+
+    def invalidate(self, links: dict | None = None):
+        if links is not None:
+            self.links = links
+        self.table = None
+
+    def build(self):
+        self.units = {c: unit_prices(c, self.links, self.fallback) for c in {*self.links, *self.fallback}}
+        self.table = {
+            (choice, count, kind): quote(base, discount, count, kind)
+            for choice, (base, discount) in self.units.items()
+            for count in range(1, self.max_count + 1)
+            for kind in KINDS
+        }
+
+    def unit(self, choice: str) -> tuple[int, int]:
+        if self.table is None:
+            self.build()
+        return self.units.get(choice) or unit_prices(choice, self.links, self.fallback)
+
+    def get(self, choice: str, count: int, kind: str = "bulk", off: int = 0) -> Quote:
+        if self.table is None:
+            self.build()
+        if kind == "coupon":
+            return Quote(max(0, self.get(choice, count, "bulk").total - off), "coupon")
+        hit = self.table.get((choice, count, kind))
+        if hit is not None:
+            return hit
+        base, discount = self.unit(choice)
+        return quote(base, discount, count, kind, off)
@@ -0,0 +1,140 @@
+import hashlib
+import json
+import os
+import re
+import time
+
+from aiogram import BaseMiddleware
+
+from tracing import rotating_jsonl_logger
+
+# =========================
+# 受信トラフィックの記録（replay.py で再生する）
+# =========================
+# RECORD_TRAFFIC=1 のときだけ有効。Telegram の update と Webhook の本文を
+# 1行1JSONでローテーション付きファイルに書き出す。
+# 個人情報は伏せる:
+#   - ユーザーID / チャットID は記録ごとの salt で別の数値に置き換え（同じ人は同じ番号、管理者はそのまま）
+#   - 名前・ユーザー名・電話番号・メールアドレス・住所は "REDACTED"
+#   - Stripe の customer_details / shipping_details など連絡先をまとめたオブジェクトは丸ごと "REDACTED"
+#   - 自由入力の文章は長さだけ残して伏せ字（コマンドと短い引数・数字・『完了』・割引コードの形は残す）
+#   - Webhook の署名ヘッダ・トークンは記録しない
+
+RECORD_TRAFFIC = os.getenv("RECORD_TRAFFIC", "") in ("1", "true", "yes")
+RECORD_MAX_BYTES = int(os.getenv("RECORD_MAX_BYTES", "20000000"))
+RECORD_BACKUPS = int(os.getenv("RECORD_BACKUPS", "5"))
+
+_SECRET_KEYS = {"first_name", "last_name", "username", "phone_number", "email", "name", "address",
+                "title", "vcard", "bio", "customer_email", "receipt_email",
+                "phone", "line1", "line2", "postal_code", "city", "state", "country",
+                "street_line1", "street_line2", "post_code", "country_code",
+                # 中身ごと伏せる（連絡先・住所・税番号などをまとめたもの）
+                "customer_details", "shipping_details", "shipping", "billing_details",
+                "shipping_address", "order_info", "contact"}
+_TEXT_KEYS = {"text", "caption"}
+_ID_KEYS = {"id", "user_id", "chat_id", "tg_uid", "uid"}
+_CODE = re.compile(r"RKTN-[A-Z0-9]{6}")
+_KEEP_TEXT = re.compile(r"^\d+$")
+
+
+class Redactor:
+    def __init__(self, keep_ids=(), salt: str | None = None):
+        self.keep_ids = {int(i) for i in keep_ids}
+        self.salt = salt if salt is not None else os.urandom(8).hex()
+
+    def user_id(self, value):
+        try:
+            uid = int(value)
+        except (TypeError, ValueError):
+            return value
+        if uid in self.keep_ids or uid == 0:
+            return value
+        digest = hashlib.sha256(f"{self.salt}:{uid}".encode()).digest()
+        alias = 100_000_000 + int.from_bytes(digest[:4], "big") % 900_000_000
+        alias = alias if uid > 0 else -alias
+        return str(alias) if isinstance(value, str) else alias
+
+    def text(self, value: str) -> str:
+        stripped = value.strip()
+        if stripped.startswith("/"):
+            # コマンド名と短い1語の引数（商品名など）は残し、文章の引数は伏せる
+            command, _, arg = stripped.partition(" ")
+            if not arg or (" " not in arg and len(arg) <= 20):
+                return value
+            return f"{command} " + "＊" * len(arg)
+        if _KEEP_TEXT.match(stripped) or (len(stripped) <= 10 and "完了" in stripped):
+            return value
+        if _CODE.fullmatch(stripped):
+            return "RKTN-" + "0" * 6
+        return "＊" * len(value)
+
+    def redact(self, obj, parent: str | None = None):
+        if isinstance(obj, dict):
+            out = {}
+            for key, value in obj.items():
+                if key in _SECRET_KEYS and value is not None:
+                    out[key] = "REDACTED"
+                elif key in _TEXT_KEYS and isinstance(value, str):
+                    out[key] = self.text(value)
+                elif key in _ID_KEYS and parent in ("from", "chat", "user", "metadata", "sender_chat") \
+                        and isinstance(value, (int, str)):
+                    out[key] = self.user_id(value)
+                elif key == "entities":
+                    out[key] = value  # offset/length だけなので伏せない
+                else:
+                    out[key] = self.redact(value, key)
+            return out
+        if isinstance(obj, list):
+            return [self.redact(v, parent) for v in obj]
+        return obj
+
+
+class TrafficRecorder:
+    def __init__(self, path: str, keep_ids=(), max_bytes: int = RECORD_MAX_BYTES, backups: int = RECORD_BACKUPS):
+        self.logger = rotating_jsonl_logger("esim.record", path, max_bytes, backups)
+        self.redactor = Redactor(keep_ids)
+        self.count = 0
+
+    def write(self, kind: str, **fields):
+        entry = {"ts": round(time.time(), 3), "kind": kind, **fields}
+        try:
+            self.logger.info(json.dumps(entry, ensure_ascii=False))
+            self.count += 1
+        except Exception as e:
+            print(f"⚠️ トラフィック記録失敗: {e}")
+
+    def record_update(self, update):
+        data = update.model_dump(mode="json", by_alias=True, exclude_none=True, exclude_unset=True)
+        self.write("update", update=self.redactor.redact(data))
+
+    def record_http(self, method: str, path: str, query: dict, body: bytes):
+        try:
+            payload = self.redactor.redact(json.loads(body.decode("utf-8")))
+        except (ValueError, UnicodeDecodeError):
+            payload = None
+        self.write("http", method=method, path=path,
+                   query={k: v for k, v in query.items() if k != "token"},
+                   authed="token" in query, body=payload)
+
+
+class RecordMiddleware(BaseMiddleware):
+    """dp.update の outer middleware（最も外側に登録して、見送られた update も記録する）"""
+
+    def __init__(self, recorder: TrafficRecorder):
+        self.recorder = recorder
+
+    async def __call__(self, handler, event, data):
+        self.recorder.record_update(event)
+        return await handler(event, data)
+
+
+def aiohttp_record_middleware(recorder: TrafficRecorder):
+    from aiohttp import web
+
+    @web.middleware
+    async def middleware(request, handler):
+        if request.method == "POST":
+            recorder.record_http(request.method, request.path, dict(request.query), await request.read())
+        return await handler(request)
+
+    return middleware
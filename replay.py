@@ -0,0 +1,192 @@
+"""記録したトラフィック（traffic.jsonl）の再生
+
+RECORD_TRAFFIC=1 で記録した update / Webhook を、Telegram API をスタブにした
+Bot に流し込み、処理時間を集計する。データは一時ディレクトリで扱うので本番データは変わらない。
+
+    python replay.py /app/data/traffic.jsonl                 # 記録どおりの間隔で再生
+    python replay.py traffic.jsonl --speed 20                # 20倍速
+    python replay.py traffic.jsonl --speed 0 --api-ms 80     # 間隔なし・API応答 80ms
+    python replay.py traffic.jsonl --data /path/to/snapshot  # data.json などの初期状態を指定
+
+トレース（traces.jsonl）は一時ディレクトリに出力され、遅い update は通常どおり 🐢 で表示される。
+"""
+import argparse
+import asyncio
+import datetime
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+from collections import Counter, defaultdict
+
+REPLAY_TOKEN = "123456:REPLAY"
+
+
+def load_records(path: str, limit: int | None) -> list[dict]:
+    records = []
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                records.append(json.loads(line))
+            if limit and len(records) >= limit:
+                break
+    records.sort(key=lambda r: r["ts"])
+    return records
+
+
+def prepare_env(data_dir: str | None) -> str:
+    """bot.py を読み込む前に、一時データディレクトリとスタブ用の設定を用意する"""
+    tmp = tempfile.mkdtemp(prefix="esim_replay_")
+    if data_dir:
+        for name in os.listdir(data_dir):
+            src = os.path.join(data_dir, name)
+            if os.path.isfile(src) and not name.startswith("traffic"):
+                shutil.copy(src, tmp)
+    os.environ["DATA_DIR"] = tmp
+    os.environ["TELEGRAM_TOKEN"] = REPLAY_TOKEN
+    os.environ["STRIPE_WEBHOOK_SECRET"] = ""  # 署名は記録していない
+    os.environ["PAYPAY_WEBHOOK_TOKEN"] = "replay"
+    os.environ["PAYPAY_API_KEY"] = ""  # 本物の PayPay に QR を作らない
+    os.environ["RECORD_TRAFFIC"] = "0"
+    return tmp
+
+
+def make_stub_session(api_ms: float):
+    from aiogram.client.session.base import BaseSession
+    from aiogram.types import Chat, File, Message, PhotoSize
+
+    class StubSession(BaseSession):
+        """Telegram API を呼ばずに、それらしい応答を返すセッション"""
+
+        def __init__(self):
+            super().__init__()
+            self.calls = Counter()
+            self._seq = 0
+
+        async def make_request(self, bot, method, timeout=None):
+            self._seq += 1
+            self.calls[type(method).__name__] += 1
+            if api_ms:
+                await asyncio.sleep(api_ms / 1000)
+            returning = method.__returning__
+            if returning is Message:
+                chat_id = getattr(method, "chat_id", 0)
+                chat = Chat(id=chat_id if isinstance(chat_id, int) else 0, type="private")
+                photo = None
+                if type(method).__name__ == "SendPhoto":
+                    file_id = method.photo if isinstance(method.photo, str) else f"stub{self._seq}"
+                    photo = [PhotoSize(file_id=file_id, file_unique_id=f"u{self._seq}", width=1, height=1)]
+                return Message(message_id=self._seq, date=datetime.datetime.now(), chat=chat, photo=photo)
+            if returning is File:
+                return File(file_id=method.file_id, file_unique_id=f"u{self._seq}", file_path=f"stub/{method.file_id}")
+            return True
+
+        async def stream_content(self, url, headers=None, timeout=30, chunk_size=65536, raise_for_status=True):
+            yield f"stub-content:{url.rsplit('/', 1)[-1]}".encode()
+
+        async def close(self):
+            pass
+
+    return StubSession()
+
+
+def percentile(values: list[float], q: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * q))]
+
+
+async def replay(records: list[dict], speed: float, api_ms: float, no_throttle: bool):
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))  # config.json を読むため
+    import bot as B
+    from aiogram.types import Update
+    from aiohttp.test_utils import TestClient, TestServer
+
+    from tracing import describe_update
+
+    session = make_stub_session(api_ms)
+    B.bot = B.make_bot(REPLAY_TOKEN, session=session)
+    if no_throttle:
+        B.OUTBOUND.global_bucket.rate = B.OUTBOUND.global_bucket.capacity = 1e9
+        B.OUTBOUND.chat_rate = B.OUTBOUND.chat_burst = 1e9
+        B.OUTBOUND.group_rate = B.OUTBOUND.group_burst = 1e9
+        B.OUTBOUND.chats.clear()
+
+    latencies: dict[str, list[float]] = defaultdict(list)
+    errors = Counter()
+
+    async def run_update(record):
+        update = Update.model_validate(record["update"], context={"bot": B.bot})
+        key = "update:" + describe_update(update)
+        start = time.perf_counter()
+        try:
+            await B.dp.feed_update(B.bot, update)
+        except Exception as e:
+            errors[f"{key}: {type(e).__name__}"] += 1
+        latencies[key].append(time.perf_counter() - start)
+
+    async def run_http(client, record):
+        key = f"http:{record['method']} {record['path']}"
+        params = dict(record.get("query") or {})
+        if record.get("authed") and record["path"] == "/paypay/callback":
+            params["token"] = os.environ["PAYPAY_WEBHOOK_TOKEN"]
+        start = time.perf_counter()
+        resp = await client.request(record["method"], record["path"], params=params,
+                                    data=json.dumps(record.get("body")).encode())
+        await resp.read()
+        if resp.status >= 400:
+            errors[f"{key}: HTTP {resp.status}"] += 1
+        latencies[key].append(time.perf_counter() - start)
+
+    async with TestClient(TestServer(B.make_web_app())) as client:
+        t0 = records[0]["ts"] if records else 0
+        wall = time.perf_counter()
+        tasks = []
+        for record in records:
+            if speed > 0:
+                delay = (record["ts"] - t0) / speed - (time.perf_counter() - wall)
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            if record["kind"] == "update":
+                tasks.append(asyncio.create_task(run_update(record)))
+            elif record["kind"] == "http":
+                tasks.append(asyncio.create_task(run_http(client, record)))
+        await asyncio.gather(*tasks)
+        wall = time.perf_counter() - wall
+
+    print(f"\n▶️ 再生: {len(records):,}件 / {wall:.2f}秒（speed={speed or '最速'}, API応答 {api_ms}ms）")
+    print(f"{'種別':<40}{'件数':>6}{'p50 ms':>9}{'p95 ms':>9}{'最大 ms':>9}")
+    for key in sorted(latencies, key=lambda k: -len(latencies[k])):
+        values = latencies[key]
+        print(f"{key:<40}{len(values):>6}{percentile(values, 0.5) * 1000:>9.1f}"
+              f"{percentile(values, 0.95) * 1000:>9.1f}{max(values) * 1000:>9.1f}")
+    print("\nAPI呼び出し: " + ", ".join(f"{k} {v}" for k, v in session.calls.most_common()))
+    if errors:
+        print("エラー: " + ", ".join(f"{k} ×{v}" for k, v in errors.most_common()))
+    print(f"スケジューラ: {B.SCHEDULER.summary()}")
+    print(f"送信: {B.OUTBOUND.summary()}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="記録したトラフィックを再生する")
+    parser.add_argument("path", help="traffic.jsonl")
+    parser.add_argument("--speed", type=float, default=1.0, help="再生速度（0 なら間隔なし）")
+    parser.add_argument("--api-ms", type=float, default=0.0, help="スタブAPIの応答時間（ms）")
+    parser.add_argument("--data", help="初期データのディレクトリ（data.json / orders.json など）")
+    parser.add_argument("--limit", type=int, help="先頭から何件再生するか")
+    parser.add_argument("--no-throttle", action="store_true", help="送信レート制御を外す")
+    args = parser.parse_args()
+
+    records = load_records(args.path, args.limit)
+    tmp = prepare_env(args.data)
+    try:
+        asyncio.run(replay(records, args.speed, args.api_ms, args.no_throttle))
+    finally:
+        print(f"一時データ: {tmp}")
+
+
+if __name__ == "__main__":
+    main()
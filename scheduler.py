@@ -0,0 +1,215 @@
+import asyncio
+import heapq
+import itertools
+import os
+import time
+
+from aiogram import BaseMiddleware
+
+from outbound import outbound_priority, PRIO_BACKGROUND
+
+# =========================
+# update スケジューラ（ユーザー毎に直列・ユーザー間は並列）
+# =========================
+# aiogram は update ごとにタスクを作るので、同じユーザーの連打
+# （type_ の二度押し直後の枚数入力、『完了』の連投など）が並行に走り、
+# STATE[uid] を取り合う。dp.update の outer middleware として
+#   - 同じユーザーの update は到着順に1件ずつ処理（待ち行列は上限付き）
+#   - 別ユーザーとは並列（全体の同時実行数は上限まで）
+#   - 処理中・待機中と同じボタン（callback_data）の再押下は捨てる
+# を行う。asyncio.Lock は待ち順が FIFO なので到着順が保たれる。
+#
+# 受付制御（混雑時）:
+#   同時実行枠が埋まったら、空き待ちは優先度順（管理者 > 支払い中 > 通常 > 閲覧）に通す。
+#   待ちが SCHED_SHED_DEPTH 件を超えたら、通常・閲覧の update は処理せずに
+#   「混雑中」とだけ返す（管理者と支払い中のユーザーは必ず待って処理する）。
+
+SCHED_CONCURRENCY = int(os.getenv("SCHED_CONCURRENCY", "32"))
+SCHED_USER_QUEUE = int(os.getenv("SCHED_USER_QUEUE", "5"))
+SCHED_SHED_DEPTH = int(os.getenv("SCHED_SHED_DEPTH", "64"))
+BUSY_REPLY_INTERVAL = 30
+
+ADMIT_ADMIN = 0
+ADMIT_PAYMENT = 1
+ADMIT_NORMAL = 2
+ADMIT_BROWSE = 3
+ADMIT_NAMES = {ADMIT_ADMIN: "管理者", ADMIT_PAYMENT: "支払い", ADMIT_NORMAL: "通常", ADMIT_BROWSE: "閲覧"}
+
+BUSY_TEXT = "⏳ ただいま混雑しています。少し時間をおいてからもう一度お試しください。"
+
+
+class _Lane:
+    __slots__ = ("lock", "size", "callbacks")
+
+    def __init__(self):
+        self.lock = asyncio.Lock()
+        self.size = 0  # 処理中 + 待機中
+        self.callbacks: set[str] = set()
+
+
+class _PriorityGate:
+    """同時実行数の枠。空き待ちは優先度 → 到着順で払い出す"""
+
+    def __init__(self, budget: int):
+        self.budget = budget
+        self.active = 0
+        self.waiters: list = []
+        self._seq = itertools.count()
+
+    async def acquire(self, priority: int):
+        if self.active < self.budget and not self.waiters:
+            self.active += 1
+            return
+        fut = asyncio.get_running_loop().create_future()
+        heapq.heappush(self.waiters, (priority, next(self._seq), fut))
+        try:
+            await fut
+        except asyncio.CancelledError:
+            if fut.done() and not fut.cancelled():
+                self.release()  # 枠を受け取った直後にキャンセルされた
+            raise
+
+    def release(self):
+        while self.waiters:
+            _, _, fut = heapq.heappop(self.waiters)
+            if not fut.done():
+                fut.set_result(None)  # 枠をそのまま引き渡す
+                return
+        self.active -= 1
+
+    def depth(self) -> dict[int, int]:
+        counts = {p: 0 for p in ADMIT_NAMES}
+        for prio, _, fut in self.waiters:
+            if not fut.done():
+                counts[prio] += 1
+        return counts
+
+
+def _update_user(update):
+    event = update.event
+    user = getattr(event, "from_user", None)
+    return user.id if user else None
+
+
+class UserScheduler(BaseMiddleware):
+    """dp.update の outer middleware。
+
+    priority(update) で受付優先度（ADMIT_*）を決め、bypass(update) が真の update は直列化しない。
+    """
+
+    def __init__(self, concurrency: int = SCHED_CONCURRENCY, user_queue: int = SCHED_USER_QUEUE,
+                 shed_depth: int = SCHED_SHED_DEPTH, priority=None, bypass=None):
+        self.gate = _PriorityGate(concurrency)
+        self.concurrency = concurrency
+        self.user_queue = user_queue
+        self.shed_depth = shed_depth
+        self.priority = priority
+        self.bypass = bypass
+        self.lanes: dict[int, _Lane] = {}
+        self.queued = 0  # 受付済みで未開始（ユーザー待ち + 枠待ち）
+        self.max_queued = 0
+        self.dropped_full = 0
+        self.dropped_dup = 0
+        self.shed = {p: 0 for p in ADMIT_NAMES}
+        self.busy_replied: dict[int, float] = {}
+
+    async def _run(self, handler, event, data, priority: int):
+        try:
+            await self.gate.acquire(priority)
+        finally:
+            self.queued -= 1
+        try:
+            return await handler(event, data)
+        finally:
+            self.gate.release()
+
+    async def _reject(self, event, data, text: str):
+        cq = event.callback_query
+        if cq is not None:
+            try:
+                await data["bot"].answer_callback_query(cq.id, text)
+            except Exception:
+                pass
+
+    async def _shed(self, event, data, uid: int, priority: int):
+        self.shed[priority] += 1
+        if event.callback_query is not None:
+            return await self._reject(event, data, BUSY_TEXT)
+        # 混雑中の返信自体が送信枠を使うので、同じユーザーには一定間隔でだけ返す
+        now = time.monotonic()
+        if now - self.busy_replied.get(uid, 0.0) < BUSY_REPLY_INTERVAL:
+            return
+        if len(self.busy_replied) > 10_000:
+            self.busy_replied = {u: t for u, t in self.busy_replied.items() if now - t < BUSY_REPLY_INTERVAL}
+        self.busy_replied[uid] = now
+        try:
+            with outbound_priority(PRIO_BACKGROUND):
+                await data["bot"].send_message(uid, BUSY_TEXT)
+        except Exception:
+            pass
+
+    async def __call__(self, handler, event, data):
+        uid = _update_user(event)
+        priority = self.priority(event) if self.priority is not None else ADMIT_NORMAL
+        if self.queued >= self.shed_depth and priority >= ADMIT_NORMAL and uid is not None:
+            return await self._shed(event, data, uid, priority)
+
+        if uid is None or (self.bypass is not None and self.bypass(event)):
+            self._enqueued()
+            return await self._run(handler, event, data, priority)
+
+        lane = self.lanes.get(uid)
+        if lane is None:
+            lane = self.lanes[uid] = _Lane()
+
+        cb_data = event.callback_query.data if event.callback_query else None
+        if cb_data is not None and cb_data in lane.callbacks:
+            self.dropped_dup += 1
+            return await self._reject(event, data, "⏳ 処理中です…")
+        if lane.size >= self.user_queue:
+            self.dropped_full += 1
+            print(f"⚠️ 受信過多のため破棄: user={uid} ({event.event_type})")
+            return await self._reject(event, data, "⏳ 処理中です。少し待ってから操作してください。")
+
+        lane.size += 1
+        if cb_data is not None:
+            lane.callbacks.add(cb_data)
+        self._enqueued()
+        entered = False
+        try:
+            async with lane.lock:
+                entered = True
+                return await self._run(handler, event, data, priority)
+        finally:
+            if not entered:
+                self.queued -= 1
+            lane.size -= 1
+            if cb_data is not None:
+                lane.callbacks.discard(cb_data)
+            if lane.size == 0:
+                self.lanes.pop(uid, None)
+
+    def _enqueued(self):
+        self.queued += 1
+        self.max_queued = max(self.max_queued, self.queued)
+
+    def snapshot(self) -> dict:
+        return {
+            "running": self.gate.active,
+            "concurrency": self.concurrency,
+            "queued": self.queued,
+            "max_queued": self.max_queued,
+            "waiting": {ADMIT_NAMES[p]: n for p, n in self.gate.depth().items()},
+            "shed": {ADMIT_NAMES[p]: n for p, n in self.shed.items()},
+            "dropped_dup": self.dropped_dup,
+            "dropped_full": self.dropped_full,
+        }
+
+    def summary(self) -> str:
+        s = self.snapshot()
+        waiting = " / ".join(f"{k} {v}" for k, v in s["waiting"].items())
+        shed = " / ".join(f"{k} {v}" for k, v in s["shed"].items() if v) or "なし"
+        return (f"処理中: {s['running']}/{s['concurrency']} / 待ち: {s['queued']}件（最大 {s['max_queued']}件）\n"
+                f"　枠待ち: {waiting}\n"
+                f"　混雑で見送り: {shed}\n"
+                f"　破棄: 重複ボタン {s['dropped_dup']}件 / 受信過多 {s['dropped_full']}件")
@@ -0,0 +1,53 @@
+# =========================
+# ステージ別ルーター（テキスト入力の振り分け）
+# =========================
+# STATE[uid]["stage"] をキーに dict 1回引きでハンドラを選ぶ。
+# 状態を持たないユーザーのテキストは idle ハンドラへ直行するので、
+# 正規表現や lower() を毎回全部試す必要がない。
+#
+# 遷移表:
+#   entry_stages … コマンドやボタンから、どの状態からでも入れるステージ
+#   transitions  … それ以外の「前ステージ → 次ステージ」の許可リスト
+# 表にない遷移は警告を出す（動作は止めない）。
+
+
+class StageRouter:
+    def __init__(self, entry_stages=(), transitions=None):
+        self.routes: dict = {}
+        self.entry_stages = set(entry_stages)
+        self.transitions: dict = {k: set(v) for k, v in (transitions or {}).items()}
+        self.idle = None
+        self.fallback = None
+
+    def route(self, *stages):
+        """ステージ名に対するハンドラを登録するデコレータ"""
+        def deco(fn):
+            for stage in stages:
+                self.routes[stage] = fn
+            return fn
+        return deco
+
+    def on_idle(self, fn):
+        """状態なし（STATE 未登録）のユーザー用"""
+        self.idle = fn
+        return fn
+
+    def on_fallback(self, fn):
+        """ルート未登録のステージ用"""
+        self.fallback = fn
+        return fn
+
+    def can_transition(self, src, dst) -> bool:
+        if dst is None or dst in self.entry_stages:
+            return True
+        return dst in self.transitions.get(src, ())
+
+    def resolve(self, state):
+        if not state:
+            return self.idle
+        return self.routes.get(state.get("stage"), self.fallback)
+
+    async def dispatch(self, message, state):
+        handler = self.resolve(state)
+        if handler is not None:
+            return await handler(message, state)
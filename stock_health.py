@@ -0,0 +1,147 @@
+import asyncio
+import itertools
+import os
+import time
+
+from aiogram.exceptions import TelegramBadRequest
+
+from outbound import outbound_priority, PRIO_BACKGROUND
+
+# =========================
+# 在庫の健全性チェック（バックグラウンド）
+# =========================
+# 在庫は /addstock 時の file_id なので、配送の途中まで壊れていることに気付けない。
+# 空いている時間に getFile で少しずつ確認し、
+#   - file_id が無効（BadRequest）→ 隔離
+#   - 既存在庫と同じ file_unique_id（同じ画像の二重登録）→ 後から見つかった方を隔離
+# 隔離した在庫は STOCK から外して QUARANTINE に移すので、販売・配送には使われない。
+# 確認済みの在庫は HEALTH（file_id → file_unique_id, 確認時刻）に記録し、配送時に優先して使う。
+# getFile は PRIO_BACKGROUND で送信レート制御を通すので、配送や返信の枠は奪わない。
+# ネットワークエラーなど一時的な失敗は隔離せず、次の周回で確認し直す。
+
+STOCK_CHECK_BATCH = int(os.getenv("STOCK_CHECK_BATCH", "20"))
+STOCK_CHECK_INTERVAL = float(os.getenv("STOCK_CHECK_INTERVAL", "600"))  # 未確認がない時の巡回間隔
+STOCK_CHECK_PAUSE = 1.0  # 未確認が残っている時のバッチ間隔
+STOCK_RECHECK_HOURS = float(os.getenv("STOCK_RECHECK_HOURS", "168"))
+
+
+class StockHealth:
+    def __init__(self, stock, get_file, on_change, batch: int = STOCK_CHECK_BATCH,
+                 interval: float = STOCK_CHECK_INTERVAL, recheck_hours: float = STOCK_RECHECK_HOURS):
+        # stock(): 現在の STOCK / get_file(file_id): file_unique_id を持つ File を返すコルーチン
+        # on_change(quarantined): 確認結果が変わった時（quarantined は [(商品, file_id, 理由), ...]）
+        self.stock = stock
+        self.get_file = get_file
+        self.on_change = on_change
+        self.batch = batch
+        self.interval = interval
+        self.recheck = recheck_hours * 3600
+        self.verified: dict[str, dict] = {}  # file_id → {"u": file_unique_id, "at": 確認時刻}
+        self.quarantine: dict[str, list[dict]] = {}  # 商品 → [{"file_id", "reason", "at"}]
+        self.transient_errors = 0
+        self._wake = asyncio.Event()
+
+    def load(self, verified: dict, quarantine: dict):
+        self.verified = verified
+        self.quarantine = quarantine
+
+    def wake(self):
+        """在庫追加の直後などに、待たずに次のバッチを始めさせる"""
+        self._wake.set()
+
+    def quarantined(self) -> int:
+        return sum(len(v) for v in self.quarantine.values())
+
+    def healthy(self, items: list) -> int:
+        return sum(1 for f in items if f in self.verified)
+
+    def admit(self, file_id: str, unique_id: str) -> str | None:
+        """受け取った時点で file_unique_id が分かっている在庫を確認済みにする。
+        既存在庫と同じ画像なら、その file_id を返す（登録しない前提）"""
+        alive = {f for items in self.stock().values() for f in items}
+        if file_id in alive:
+            return file_id
+        for f, v in self.verified.items():
+            if v["u"] == unique_id and f in alive:
+                return f
+        self.verified[file_id] = {"u": unique_id, "at": time.time()}
+        return None
+
+    def take(self, items: list, count: int) -> list:
+        """確認済みを優先して count 枚を取り出し、items から削除する（それぞれの順序は保つ）"""
+        picked = [f for f in items if f in self.verified][:count]
+        if len(picked) < count:
+            chosen = set(picked)
+            picked += [f for f in items if f not in chosen][:count - len(picked)]
+        chosen = set(picked)
+        items[:] = [f for f in items if f not in chosen]
+        return picked
+
+    def _due(self, now: float) -> list[str]:
+        stale = now - self.recheck
+        due = (f for items in self.stock().values() for f in items
+               if f not in self.verified or self.verified[f]["at"] < stale)
+        return list(itertools.islice(due, self.batch))
+
+    async def check_batch(self) -> int:
+        """未確認（または古い）在庫を最大 batch 件確認する。確認できた件数を返す"""
+        due = self._due(time.time())
+        results = []
+        for file_id in due:
+            try:
+                with outbound_priority(PRIO_BACKGROUND):
+                    file = await self.get_file(file_id)
+                results.append((file_id, file.file_unique_id, None))
+            except TelegramBadRequest as e:
+                results.append((file_id, None, f"無効な file_id: {e.message}"))
+            except Exception as e:
+                self.transient_errors += 1
+                print(f"⚠️ 在庫チェック: 一時的な失敗 {file_id[:16]}…: {e}")
+        if not results:
+            return 0
+
+        # 確認中に売れた・編集された在庫があるので、反映は今の STOCK に対して行う
+        stock = self.stock()
+        owner = {f: p for p, items in stock.items() for f in items}
+        for f in [f for f in self.verified if f not in owner]:
+            self.verified.pop(f)
+        by_unique = {v["u"]: f for f, v in self.verified.items()}
+        now = time.time()
+        quarantined = []
+        for file_id, unique_id, error in results:
+            product = owner.get(file_id)
+            if product is None:
+                continue
+            if error is None:
+                other = by_unique.get(unique_id)
+                if other is None or other == file_id:
+                    self.verified[file_id] = {"u": unique_id, "at": now}
+                    by_unique[unique_id] = file_id
+                    continue
+                error = f"重複（{other[:16]}… と同じ画像）"
+            stock[product].remove(file_id)
+            self.verified.pop(file_id, None)
+            self.quarantine.setdefault(product, []).append({"file_id": file_id, "reason": error, "at": now})
+            quarantined.append((product, file_id, error))
+            print(f"🧪 在庫を隔離: {product} {file_id[:16]}… {error}")
+        self.on_change(quarantined)
+        return len(results)
+
+    def release(self, product: str | None = None) -> dict[str, list[str]]:
+        """隔離を解除して file_id を返す（商品指定なしなら全商品）。在庫に戻すかは呼び出し側で決める"""
+        products = [product] if product else list(self.quarantine)
+        return {p: [q["file_id"] for q in self.quarantine.pop(p, [])] for p in products}
+
+    async def run(self):
+        """バックグラウンドの確認ワーカー"""
+        while True:
+            try:
+                checked = await self.check_batch()
+            except Exception as e:
+                print(f"⚠️ 在庫チェックエラー: {e}")
+                checked = 0
+            self._wake.clear()
+            try:
+                await asyncio.wait_for(self._wake.wait(), STOCK_CHECK_PAUSE if checked else self.interval)
+            except asyncio.TimeoutError:
+                pass
@@ -0,0 +1,132 @@
+"""データファイルの読み書き（形式を差し替え可能）
+
+Bot しか読まない data.json / users.json / orders.json / sessions.json を
+整形なしの JSON や msgpack、gzip / zstd 圧縮で保存できるようにする。
+形式は STORE_FORMAT で指定（例: "compact", "json", "msgpack+zstd", "compact+gzip"）。
+読み込み時は先頭バイトから形式を自動判別するので、切り替え前のファイルもそのまま読める。
+ファイル名は形式に関係なく .json のまま。
+
+人が中身を見るときは整形 JSON に変換する:
+
+    python storage.py convert /app/data/data.json data_pretty.json --format json
+    python storage.py convert data_pretty.json /app/data/data.json          # STORE_FORMAT に戻す
+    python storage.py info /app/data/data.json
+"""
+import gzip
+import json
+import os
+import sys
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+STORE_FORMAT = os.getenv("STORE_FORMAT", "compact")
+
+GZIP_MAGIC = b"\x1f\x8b"
+ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+
+SERIALIZERS = ("json", "compact", "msgpack")
+COMPRESSIONS = ("gzip", "zstd")
+
+
+def parse_format(fmt: str) -> tuple[str, str | None]:
+    """'msgpack+zstd' → ('msgpack', 'zstd')。使えない形式は ValueError"""
+    serializer, _, compression = fmt.partition("+")
+    compression = compression or None
+    if serializer not in SERIALIZERS:
+        raise ValueError(f"不明な保存形式です: {serializer}（{' / '.join(SERIALIZERS)}）")
+    if compression is not None and compression not in COMPRESSIONS:
+        raise ValueError(f"不明な圧縮形式です: {compression}（{' / '.join(COMPRESSIONS)}）")
+    if serializer == "msgpack" and msgpack is None:
+        raise ValueError("msgpack が未インストールです（pip install msgpack）")
+    if compression == "zstd" and zstandard is None:
+        raise ValueError("zstandard が未インストールです（pip install zstandard）")
+    return serializer, compression
+
+
+def dumps(obj, fmt: str | None = None) -> bytes:
+    serializer, compression = parse_format(fmt or STORE_FORMAT)
+    if serializer == "msgpack":
+        raw = msgpack.packb(obj, use_bin_type=True)
+    elif serializer == "json":
+        raw = json.dumps(obj, ensure_ascii=False, indent=2).encode("utf-8")
+    else:
+        raw = json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+    if compression == "gzip":
+        return gzip.compress(raw, compresslevel=6)
+    if compression == "zstd":
+        return zstandard.ZstdCompressor(level=3).compress(raw)
+    return raw
+
+
+def detect(raw: bytes) -> str:
+    """バイト列の形式名を返す（'json' / 'msgpack'、圧縮は '+gzip' などを付ける）"""
+    if raw.startswith(GZIP_MAGIC):
+        return detect(gzip.decompress(raw)) + "+gzip"
+    if raw.startswith(ZSTD_MAGIC):
+        if zstandard is None:
+            raise ValueError("zstd 圧縮のファイルですが zstandard が未インストールです")
+        return detect(zstandard.ZstdDecompressor().decompress(raw)) + "+zstd"
+    head = raw.lstrip()[:1]
+    if head in (b"{", b"[", b'"') or head.isdigit() or not raw.strip():
+        return "json"
+    return "msgpack"
+
+
+def loads(raw: bytes):
+    if raw.startswith(GZIP_MAGIC):
+        return loads(gzip.decompress(raw))
+    if raw.startswith(ZSTD_MAGIC):
+        if zstandard is None:
+            raise ValueError("zstd 圧縮のファイルですが zstandard が未インストールです")
+        return loads(zstandard.ZstdDecompressor().decompress(raw))
+    if detect(raw) == "json":
+        return json.loads(raw.decode("utf-8"))
+    if msgpack is None:
+        raise ValueError("msgpack 形式のファイルですが msgpack が未インストールです")
+    return msgpack.unpackb(raw, raw=False, strict_map_key=False)
+
+
+def read(path: str):
+    with open(path, "rb") as f:
+        return loads(f.read())
+
+
+def write(path: str, obj, fmt: str | None = None, fsync: bool = False):
+    """一時ファイルに書いてから置き換える（途中で落ちても元のファイルは壊れない）"""
+    data = dumps(obj, fmt)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+        if fsync:
+            f.flush()
+            os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def _main(argv: list[str]) -> int:
+    if len(argv) >= 2 and argv[0] == "info":
+        with open(argv[1], "rb") as f:
+            raw = f.read()
+        print(f"{argv[1]}: {detect(raw)} / {len(raw):,} bytes")
+        return 0
+    if len(argv) >= 3 and argv[0] == "convert":
+        fmt = STORE_FORMAT
+        if "--format" in argv:
+            fmt = argv[argv.index("--format") + 1]
+        write(argv[2], read(argv[1]), fmt)
+        print(f"✅ {argv[1]} → {argv[2]}（{fmt}）")
+        return 0
+    print(__doc__)
+    return 1
+
+
+if __name__ == "__main__":
+    sys.exit(_main(sys.argv[1:]))
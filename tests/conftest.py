@@ -0,0 +1,128 @@
+import datetime
+import itertools
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+TEST_TOKEN = "123456:TEST"
+PAYPAY_TOKEN = "test-token"
+PAYPAY_SECRET = "test-secret"
+
+
+class SentLog:
+    """スタブセッションが受け取った API 呼び出し（テストで中身を確認する）"""
+
+    def __init__(self):
+        self.methods = []
+
+    def texts(self, chat_id=None) -> list[str]:
+        return [getattr(m, "text", None) or getattr(m, "caption", None) or "" for m in self.methods
+                if chat_id is None or getattr(m, "chat_id", None) == chat_id]
+
+    def clear(self):
+        self.methods.clear()
+
+
+def make_session(log: SentLog):
+    from aiogram.client.session.base import BaseSession
+    from aiogram.types import Chat, File, Message
+
+    class StubSession(BaseSession):
+        async def make_request(self, bot, method, timeout=None):
+            log.methods.append(method)
+            returning = method.__returning__
+            if returning is Message:
+                chat_id = getattr(method, "chat_id", 0)
+                chat = Chat(id=chat_id if isinstance(chat_id, int) else 0, type="private")
+                return Message(message_id=len(log.methods), date=datetime.datetime.now(), chat=chat)
+            if returning is File:
+                return File(file_id=method.file_id, file_unique_id=f"u-{method.file_id}")
+            return True
+
+        async def stream_content(self, url, headers=None, timeout=30, chunk_size=65536, raise_for_status=True):
+            yield b""
+
+        async def close(self):
+            pass
+
+    return StubSession()
+
+
+SENT = SentLog()
+
+
+@pytest.fixture
+def sent(bot_module) -> SentLog:
+    SENT.clear()
+    return SENT
+
+
+@pytest.fixture(scope="session")
+def bot_module(tmp_path_factory):
+    """一時データディレクトリと Telegram スタブで bot.py を読み込む（テスト全体で1回）"""
+    os.environ.update(
+        DATA_DIR=str(tmp_path_factory.mktemp("data")),
+        TELEGRAM_TOKEN=TEST_TOKEN,
+        STRIPE_SECRET_KEY="",
+        STRIPE_WEBHOOK_SECRET="",
+        PAYPAY_WEBHOOK_TOKEN=PAYPAY_TOKEN,
+        PAYPAY_API_KEY="test-key",
+        PAYPAY_API_SECRET=PAYPAY_SECRET,
+        PAYPAY_MERCHANT_ID="test-merchant",
+        RECORD_TRAFFIC="0",
+    )
+    os.chdir(ROOT)  # config.json を読むため
+    import bot
+
+    bot.bot = bot.make_bot(TEST_TOKEN, session=make_session(SENT))
+    bot.OUTBOUND.chat_rate = bot.OUTBOUND.chat_burst = 1e9
+    bot.OUTBOUND.global_bucket.rate = bot.OUTBOUND.global_bucket.capacity = 1e9
+    return bot
+
+
+class Updates:
+    """テスト用の update を組み立てる"""
+
+    def __init__(self, bot_module):
+        self.B = bot_module
+        self.seq = itertools.count(1)
+
+    def _user(self, uid):
+        return {"id": uid, "is_bot": False, "first_name": f"user{uid}"}
+
+    def message(self, uid, text):
+        from aiogram.types import Update
+        n = next(self.seq)
+        return Update.model_validate({"update_id": n, "message": {
+            "message_id": n, "date": 0, "chat": {"id": uid, "type": "private"}, "from": self._user(uid), "text": text,
+        }}, context={"bot": self.B.bot})
+
+    def photo(self, uid, file_id):
+        from aiogram.types import Update
+        n = next(self.seq)
+        return Update.model_validate({"update_id": n, "message": {
+            "message_id": n, "date": 0, "chat": {"id": uid, "type": "private"}, "from": self._user(uid),
+            "photo": [{"file_id": file_id, "file_unique_id": f"u-{file_id}", "width": 1, "height": 1}],
+        }}, context={"bot": self.B.bot})
+
+    def callback(self, uid, data):
+        from aiogram.types import Update
+        n = next(self.seq)
+        return Update.model_validate({"update_id": n, "callback_query": {
+            "id": str(n), "from": self._user(uid), "chat_instance": "test", "data": data,
+            "message": {"message_id": n, "date": 1, "chat": {"id": uid, "type": "private"}, "from": self._user(uid)},
+        }}, context={"bot": self.B.bot})
+
+    async def feed(self, *updates):
+        for update in updates:
+            await self.B.dp.feed_update(self.B.bot, update)
+
+
+@pytest.fixture
+def updates(bot_module):
+    return Updates(bot_module)
+
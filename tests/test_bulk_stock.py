@@ -0,0 +1,46 @@
+import asyncio
+
+
+def _start_batch(B, inflight: int) -> dict:
+    B.STOCK.setdefault("データ", [])
+    return B.set_stage(B.ADMIN_ID, "bulk_stock", type="データ", batch={"sha-bulk-1": "bulk-new-1"},
+                       dups=0, dup_stock=0, failed=0, inflight=inflight, progress=1)
+
+
+def test_bulkdone_refuses_while_images_are_in_flight(bot_module, updates, sent, monkeypatch):
+    B = bot_module
+    monkeypatch.setattr(B, "BULK_DONE_WAIT", 0)
+    state = _start_batch(B, inflight=120)
+
+    asyncio.run(updates.feed(updates.message(B.ADMIN_ID, "/bulkdone")))
+    assert any("まだ 120件 処理中" in t for t in sent.texts(B.ADMIN_ID))
+    # 確定せず、段階もバッチもそのまま
+    assert B.STATE[B.ADMIN_ID] is state and state["stage"] == "bulk_stock"
+    assert "bulk-new-1" not in B.STOCK["データ"]
+
+    # 残りの画像が届いてから確定すると、後から来た分も入る
+    state["batch"]["sha-bulk-2"] = "bulk-new-2"
+    state["inflight"] = 0
+    sent.clear()
+    asyncio.run(updates.feed(updates.message(B.ADMIN_ID, "/bulkdone")))
+    assert any("2件 追加しました" in t for t in sent.texts(B.ADMIN_ID))
+    assert B.ADMIN_ID not in B.STATE
+    assert B.STOCK["データ"][-2:] == ["bulk-new-1", "bulk-new-2"]
+
+
+def test_bulkdone_waits_for_images_that_finish_soon(bot_module, updates, sent, monkeypatch):
+    B = bot_module
+    monkeypatch.setattr(B, "BULK_DONE_WAIT", 5)
+    state = _start_batch(B, inflight=1)
+
+    async def scenario():
+        async def finish():
+            await asyncio.sleep(0.3)
+            state["batch"]["sha-bulk-3"] = "bulk-new-3"
+            state["inflight"] -= 1
+        await asyncio.gather(updates.feed(updates.message(B.ADMIN_ID, "/bulkdone")), finish())
+
+    B.STOCK["データ"] = [f for f in B.STOCK["データ"] if not f.startswith("bulk-new")]
+    asyncio.run(scenario())
+    assert not any("処理中です" in t for t in sent.texts(B.ADMIN_ID))
+    assert B.STOCK["データ"][-2:] == ["bulk-new-1", "bulk-new-3"]
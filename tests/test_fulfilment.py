@@ -0,0 +1,44 @@
+import asyncio
+
+UID = 700400
+
+
+def _crashed_after_stock_save(B, n: int) -> str:
+    """fulfil_order が data.json（在庫の減少 + アウトボックス）を書いた直後、approved を書く前に落ちた状態"""
+    order = B.ORDERS.create(UID, name="user", type="データ", count=n, price=1500 * n, code=None)
+    B.ORDERS.set_status(order["id"], "paid", channel="paypay")
+    for i in range(n):
+        B.OUTBOX.enqueue(order["id"], UID, f"crash-{order['id']}-{i}", f"✅ データ #{i+1}/{n} を送信しました！")
+    B.OUTBOX.enqueue(order["id"], UID, None, B.NOTICE)
+    return order["id"]
+
+
+def _photos(sent) -> list[str]:
+    return [m.photo for m in sent.methods if getattr(m, "chat_id", None) == UID and hasattr(m, "photo")]
+
+
+def test_restart_delivery_settles_order_left_paid(bot_module, sent):
+    B = bot_module
+    oid = _crashed_after_stock_save(B, 2)
+
+    asyncio.run(B.OUTBOX.deliver(oid))
+    assert B.ORDERS.get(oid)["status"] == "delivered"
+    assert oid not in B.pending_view(0)[0]
+    assert _photos(sent) == [f"crash-{oid}-0", f"crash-{oid}-1"]
+
+
+def test_approving_order_with_queued_items_does_not_take_stock_again(bot_module, updates, sent):
+    B = bot_module
+    B.STOCK["データ"] = [f"fresh-{i}" for i in range(5)]
+    oid = _crashed_after_stock_save(B, 2)
+
+    asyncio.run(updates.feed(updates.callback(B.ADMIN_ID, f"confirm_{oid}")))
+    assert "すでに配送待ち" in sent.texts()[-1]
+    assert B.STOCK["データ"] == [f"fresh-{i}" for i in range(5)]
+    order = B.ORDERS.get(oid)
+    assert order["status"] == "approved"
+    assert order["items"] == [f"crash-{oid}-0", f"crash-{oid}-1"]
+
+    asyncio.run(B.OUTBOX.deliver(oid))
+    assert B.ORDERS.get(oid)["status"] == "delivered"
+    assert _photos(sent) == [f"crash-{oid}-0", f"crash-{oid}-1"]
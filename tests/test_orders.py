@@ -0,0 +1,58 @@
+import asyncio
+import time
+
+import storage
+from orders import OrderStore
+
+
+def _saved(path) -> dict:
+    return {o["id"]: o for o in storage.read(path)} if path.exists() else {}
+
+
+def test_quotes_are_written_together_and_transitions_immediately(tmp_path):
+    path = tmp_path / "orders.json"
+    store = OrderStore(str(path))
+    store.save_delay = 0.05
+    writes = []
+    store.after_save = writes.append
+
+    async def scenario():
+        quotes = [store.create(1, type="データ", count=n, price=1500 * n) for n in range(1, 6)]
+        store.update(quotes[0]["id"], price=1000, code="RKTN-1")
+        assert writes == []  # 見積りはまだ書かない
+        await asyncio.sleep(0.1)
+        assert len(writes) == 1
+        assert _saved(path)[quotes[0]["id"]]["price"] == 1000
+
+        store.set_status(quotes[1]["id"], "paid")
+        assert len(writes) == 2  # 入金は即座に書く
+        assert _saved(path)[quotes[1]["id"]]["status"] == "paid"
+
+        # ループ終了でキャンセルされても溜まった変更は書かれる
+        store.update(quotes[2]["id"], price=1)
+
+    asyncio.run(scenario())
+    assert _saved(path)[store.with_status("quoted")[1]["id"]]["price"] == 1
+
+
+def test_stale_quotes_are_pruned(tmp_path):
+    path = tmp_path / "orders.json"
+    store = OrderStore(str(path))
+    old = time.time() - 72 * 3600
+    stale = store.create(1, type="データ", count=1, price=1500)
+    fresh = store.create(1, type="データ", count=2, price=3000)
+    paid = store.create(2, type="データ", count=1, price=1500)
+    store.set_status(paid["id"], "paid")
+    stale["updated"] = paid["updated"] = old
+
+    assert store.prune_quotes(ttl_hours=48) == 1
+    assert stale["id"] not in store and fresh["id"] in store and paid["id"] in store
+    assert [o["id"] for o in store.for_user(1)] == [fresh["id"]]
+    assert store.count("quoted") == 1
+    assert stale["id"] not in _saved(path)
+
+    # 読み込み時にも古い見積りは捨てる
+    reloaded = OrderStore(str(path))
+    storage.write(str(path), [stale, fresh, paid])
+    reloaded.load()
+    assert set(reloaded.orders) == {fresh["id"], paid["id"]}
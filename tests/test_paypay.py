@@ -0,0 +1,175 @@
+import asyncio
+import base64
+import hashlib
+import hmac
+
+from aiohttp import web
+from aiohttp.test_utils import TestClient, TestServer
+
+from conftest import PAYPAY_SECRET, PAYPAY_TOKEN
+from paypay import order_id_of
+
+UID = 700001
+
+
+class PayPayStandIn:
+    """PayPay OPA の /v2/codes だけを真似るローカルサーバ（署名も検証する）"""
+
+    def __init__(self):
+        self.codes: dict[str, dict] = {}  # merchantPaymentId → 作成リクエスト
+        self.deleted: list[str] = []
+        self.app = web.Application()
+        self.app.router.add_post("/v2/codes", self.create)
+        self.app.router.add_delete("/v2/codes/{code_id}", self.delete)
+
+    @staticmethod
+    def _result(code: str, data=None, status: int = 200):
+        return web.json_response({"resultInfo": {"code": code, "message": ""}, "data": data}, status=status)
+
+    def _authorized(self, request, body: str) -> bool:
+        _, _, fields = request.headers.get("Authorization", "").partition("OPA-Auth:")
+        try:
+            _key, mac, nonce, epoch, body_hash = fields.split(":")
+        except ValueError:
+            return False
+        content_type = "application/json;charset=UTF-8" if body else "empty"
+        expected_hash = base64.b64encode(hashlib.md5((content_type + body).encode()).digest()).decode() if body else "empty"
+        message = "\n".join([request.path, request.method, nonce, epoch, content_type, expected_hash])
+        expected = base64.b64encode(hmac.new(PAYPAY_SECRET.encode(), message.encode(), hashlib.sha256).digest()).decode()
+        return body_hash == expected_hash and hmac.compare_digest(mac, expected)
+
+    async def create(self, request):
+        body = await request.text()
+        if not self._authorized(request, body):
+            return self._result("UNAUTHORIZED", status=401)
+        payload = await request.json()
+        mpid = payload["merchantPaymentId"]
+        if mpid in self.codes:
+            return self._result("DUPLICATE_DYNAMIC_QR_REQUEST", status=400)
+        self.codes[mpid] = payload
+        code_id = f"code-{mpid}"
+        return self._result("SUCCESS", {"codeId": code_id, "merchantPaymentId": mpid,
+                                        "url": f"https://qr.paypay.test/{code_id}"}, status=201)
+
+    async def delete(self, request):
+        if not self._authorized(request, ""):
+            return self._result("UNAUTHORIZED", status=401)
+        self.deleted.append(request.match_info["code_id"])
+        return self._result("SUCCESS")
+
+
+def completed(merchant_payment_id: str, amount: int) -> dict:
+    return {"eventType": "PAYMENT_COMPLETED",
+            "data": {"merchantPaymentId": merchant_payment_id, "amount": {"amount": amount, "currency": "JPY"}}}
+
+
+async def _quote(B, updates, count: int = 1) -> dict:
+    """商品を選んで枚数を入力し、作られた注文を返す"""
+    B.STOCK["データ"].extend(f"paypay-stock-{len(B.STOCK['データ'])}-{i}" for i in range(count))
+    await updates.feed(updates.callback(UID, "type_データ"), updates.message(UID, str(count)))
+    return B.ORDERS.get(B.STATE[UID]["order_id"])
+
+
+def test_quote_creates_dynamic_qr_and_callbacks_reconcile(bot_module, updates, sent):
+    B = bot_module
+    stand_in = PayPayStandIn()
+
+    async def scenario():
+        async with TestServer(stand_in.app) as paypay_server, TestClient(TestServer(B.make_web_app())) as client:
+            B.PAYPAY.base_url = str(paypay_server.make_url("")).rstrip("/")
+            order = await _quote(B, updates)
+            oid = order["id"]
+
+            # 注文ID がそのまま merchantPaymentId になり、金額固定の QR がユーザーに渡る
+            assert stand_in.codes[oid]["amount"] == {"amount": order["price"], "currency": "JPY"}
+            assert any(f"https://qr.paypay.test/code-{oid}" in t for t in sent.texts(UID))
+
+            async def post(event, token=PAYPAY_TOKEN):
+                resp = await client.post(f"/paypay/callback?token={token}", json=event)
+                return resp.status, await resp.text()
+
+            assert await post(completed(oid, order["price"]), token="wrong") == (403, "forbidden")
+            assert await post(completed(oid, order["price"])) == (200, "fulfilled")
+            assert B.ORDERS.get(oid)["status"] == "delivered"
+            # 同じ通知の再送は二重配送しない
+            assert await post(completed(oid, order["price"])) == (200, "duplicate")
+            # 知らない注文ID は照合せず管理者へ知らせる
+            sent.clear()
+            assert await post(completed("NOSUCHID", 1500)) == (200, "unmatched")
+            assert any("NOSUCHID" in t for t in sent.texts(B.ADMIN_ID))
+
+    asyncio.run(scenario())
+
+
+def test_callback_after_screenshot_fulfils_pending_order(bot_module, updates, sent):
+    B = bot_module
+    stand_in = PayPayStandIn()
+
+    async def scenario():
+        async with TestServer(stand_in.app) as paypay_server, TestClient(TestServer(B.make_web_app())) as client:
+            B.PAYPAY.base_url = str(paypay_server.make_url("")).rstrip("/")
+            order = await _quote(B, updates)
+            oid = order["id"]
+            # 案内どおり『完了』→ スクショを送ると、入金通知より先に承認待ちになる
+            await updates.feed(updates.message(UID, "完了"), updates.photo(UID, "screenshot-1"))
+            assert B.ORDERS.get(oid)["status"] == "paid"
+            assert oid in B.pending_view(0)[0]
+
+            resp = await client.post(f"/paypay/callback?token={PAYPAY_TOKEN}", json=completed(oid, order["price"]))
+            assert await resp.text() == "fulfilled"
+            assert B.ORDERS.get(oid)["status"] == "delivered"
+            assert B.ORDERS.get(oid)["paid_amount"] == order["price"]
+            assert oid not in B.pending_view(0)[0]
+            resp = await client.post(f"/paypay/callback?token={PAYPAY_TOKEN}", json=completed(oid, order["price"]))
+            assert await resp.text() == "duplicate"
+
+            # 金額が違えば配送せず、承認待ちに入金額を出す（ユーザーには重ねて知らせない）
+            order = await _quote(B, updates)
+            oid = order["id"]
+            await updates.feed(updates.message(UID, "完了"), updates.photo(UID, "screenshot-2"))
+            sent.clear()
+            resp = await client.post(f"/paypay/callback?token={PAYPAY_TOKEN}", json=completed(oid, 1))
+            assert await resp.text() == "mismatch"
+            assert B.ORDERS.get(oid)["status"] == "paid"
+            assert "PayPay入金 1円" in B.pending_view(0)[0]
+            assert sent.texts(UID) == []
+            resp = await client.post(f"/paypay/callback?token={PAYPAY_TOKEN}", json=completed(oid, 1))
+            assert await resp.text() == "duplicate"
+
+    asyncio.run(scenario())
+
+
+def test_price_change_replaces_qr_with_suffixed_payment_id(bot_module, updates, sent):
+    B = bot_module
+    stand_in = PayPayStandIn()
+
+    async def scenario():
+        async with TestServer(stand_in.app) as paypay_server, TestClient(TestServer(B.make_web_app())) as client:
+            B.PAYPAY.base_url = str(paypay_server.make_url("")).rstrip("/")
+            order = await _quote(B, updates)
+            oid = order["id"]
+            B.CODES["RKTN-PAYPAY"] = {"type": "データ", "used": False}
+            await updates.feed(updates.message(UID, "RKTN-PAYPAY"))
+
+            order = B.ORDERS.get(oid)
+            assert order["paypay_payment_id"] == f"{oid}-2"
+            assert stand_in.deleted == [f"code-{oid}"]
+            assert stand_in.codes[f"{oid}-2"]["amount"]["amount"] == order["price"]
+            assert order_id_of(f"{oid}-2") == oid
+
+            resp = await client.post(f"/paypay/callback?token={PAYPAY_TOKEN}", json=completed(f"{oid}-2", order["price"]))
+            assert await resp.text() == "fulfilled"
+
+    asyncio.run(scenario())
+
+
+def test_quote_falls_back_to_static_link_when_api_fails(bot_module, updates, sent):
+    B = bot_module
+
+    async def scenario():
+        B.PAYPAY.base_url = "http://127.0.0.1:9"  # 接続できない
+        order = await _quote(B, updates)
+        assert "paypay_payment_id" not in order
+        assert any(B.LINKS["データ"]["url"] in t for t in sent.texts(UID))
+
+    asyncio.run(scenario())
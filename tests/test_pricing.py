@@ -0,0 +1,129 @@
+import asyncio
+import itertools
+import random
+
+import pytest
+
+from pricing import CODE_MAX_COUNT, Quote, QuoteTable, quote, unit_prices
+
+PRICES = (0, 1, 99, 1250, 1500, 1501, 2500, 3000, 9999)
+COUNTS = range(1, 31)
+OFFS = (0, 1, 100, 1500, 5000, 10 ** 6)
+LABELS = {"5%", "10%", "code", None}
+
+
+# ---- 変更前の計算（bot.py の handle_count_input / check_code にあった式） ----
+def legacy_bulk(base: int, count: int) -> int:
+    discount_rate = 0
+    if 10 <= count:
+        discount_rate = 0.10
+    elif 6 <= count <= 9:
+        discount_rate = 0.05
+    return int(base * count * (1 - discount_rate))
+
+
+def legacy_code(base: int, discount: int, count: int) -> int:
+    if count == 1:
+        return discount
+    if 2 <= count <= 5:
+        return discount + base * (count - 1)
+    return base * count
+
+
+def legacy_bulk_label(count: int) -> str | None:
+    return "10%" if count >= 10 else "5%" if count >= 6 else None
+
+
+def _cases():
+    grid = [(b, d, n) for b, d in itertools.product(PRICES, repeat=2) for n in COUNTS]
+    rng = random.Random(20240601)
+    grid += [(rng.randint(0, 50000), rng.randint(0, 50000), rng.randint(1, 120)) for _ in range(3000)]
+    return grid
+
+
+CASES = _cases()
+
+
+def test_case_count():
+    assert len(CASES) >= 5000
+
+
+def test_bulk_matches_legacy():
+    for base, _, count in CASES:
+        assert quote(base, base, count, "bulk") == Quote(legacy_bulk(base, count), legacy_bulk_label(count)), (base, count)
+
+
+def test_code_is_the_cheaper_of_legacy_code_and_bulk():
+    for base, discount, count in CASES:
+        q = quote(base, discount, count, "code")
+        expected = min(legacy_code(base, discount, count), legacy_bulk(base, count))
+        assert q.total == expected, (base, discount, count)
+        assert q.discount_type in LABELS
+        if q.discount_type == "code":
+            # コードを使うのは、まとめ買いより本当に安い時だけ（1〜5枚）
+            assert count <= CODE_MAX_COUNT
+            assert legacy_code(base, discount, count) < legacy_bulk(base, count)
+        elif q.discount_type is None:
+            # ラベルなし = 何も割り引かれていない
+            assert q.total == base * count
+            assert count < 6
+
+
+def test_coupon_is_legacy_coupon_after_bulk():
+    for base, _, count in CASES[:2000]:
+        for off in OFFS:
+            q = quote(base, base, count, "coupon", off=off)
+            assert q == Quote(max(0, legacy_bulk(base, count) - off), "coupon"), (base, count, off)
+            if count < 6:
+                # まとめ買いの対象外では旧計算と完全に一致
+                assert q.total == max(0, base * count - off)
+
+
+def test_table_matches_pure_functions():
+    for base, discount in itertools.product(PRICES, repeat=2):
+        links = {"X": {"price": base, "discount_price": discount}}
+        fallback = {"X": {"normal": 1500, "discount": 1250}}
+        table = QuoteTable(links, fallback, max_count=20)
+        unit_base, unit_discount = unit_prices("X", links, fallback)
+        assert unit_base == (base or 1500)
+        assert unit_discount == (discount or 1250)
+        for count in COUNTS:  # 表の範囲外（21枚以上）も同じ結果
+            for kind in ("bulk", "code"):
+                assert table.get("X", count, kind) == quote(unit_base, unit_discount, count, kind)
+            for off in OFFS:
+                assert table.get("X", count, "coupon", off=off) == quote(unit_base, unit_discount, count, "coupon", off)
+
+
+def test_code_without_discount_price_is_unlabeled():
+    # 割引価格のない商品では code でも割引にならない
+    assert QuoteTable({"x": {"price": 3000}}, {}).get("x", 2, "code") == Quote(6000, None)
+
+
+@pytest.mark.parametrize("discount, count, expected, consumed", [
+    (0, 2, "では割引になりません", False),
+    (0, 6, "まとめ買い割引（5%OFF）", False),
+    (2500, 2, "割引コードが承認されました", True),
+])
+def test_check_code_reply(bot_module, updates, sent, discount, count, expected, consumed):
+    B = bot_module
+    uid = 700100 + count + discount
+    B.LINKS["割引なし"] = {"url": "https://example.com/plain", "price": 3000, "discount_price": discount}
+    B.STOCK["割引なし"] = [f"plain-{count}-{i}" for i in range(count)]
+    B.CODES["RKTN-PLAIN1"] = {"type": "割引なし", "used": False}
+    B.PRICING.invalidate(B.LINKS)
+    try:
+        async def scenario():
+            await updates.feed(updates.callback(uid, "type_割引なし"), updates.message(uid, str(count)))
+            sent.clear()
+            await updates.feed(updates.message(uid, "RKTN-PLAIN1"))
+
+        asyncio.run(scenario())
+        [reply] = sent.texts(uid)
+        assert expected in reply
+        assert "None" not in reply
+        assert B.CODES["RKTN-PLAIN1"]["used"] is consumed
+    finally:
+        B.LINKS.pop("割引なし")
+        B.STOCK.pop("割引なし")
+        B.CODES.pop("RKTN-PLAIN1")
+        B.PRICING.invalidate(B.LINKS)
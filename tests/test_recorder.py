@@ -0,0 +1,80 @@
+import json
+
+from recorder import Redactor, TrafficRecorder
+
+PHONE = "+819012345678"
+EMAIL = "taro@example.com"
+PII = (PHONE, EMAIL, "山田 太郎", "1-2-3 Shibuya", "Room 401", "150-0002", "Shibuya-ku", "Tokyo", "taro_y")
+
+
+def checkout_completed() -> dict:
+    address = {"line1": "1-2-3 Shibuya", "line2": "Room 401", "postal_code": "150-0002",
+               "city": "Shibuya-ku", "state": "Tokyo", "country": "JP"}
+    return {
+        "id": "evt_1", "type": "checkout.session.completed",
+        "data": {"object": {
+            "id": "cs_test_1", "amount_total": 3000, "currency": "jpy", "payment_status": "paid",
+            "metadata": {"tg_uid": "700200", "order_id": "ABCD1234", "type": "データ", "count": "2"},
+            "customer_email": EMAIL,
+            "customer_details": {"email": EMAIL, "name": "山田 太郎", "phone": PHONE, "address": address,
+                                 "tax_exempt": "none", "tax_ids": []},
+            "shipping_details": {"name": "山田 太郎", "phone": PHONE, "address": address},
+            # 古い API バージョンの形（住所を直に持つ）
+            "shipping": {"phone": PHONE, **address},
+        }},
+    }
+
+
+def test_stripe_contact_details_are_redacted():
+    event = checkout_completed()
+    redacted = Redactor(salt="test").redact(event)
+    dumped = json.dumps(redacted, ensure_ascii=False)
+    for value in PII:
+        assert value not in dumped, value
+
+    session = redacted["data"]["object"]
+    assert session["customer_details"] == session["shipping_details"] == session["shipping"] == "REDACTED"
+    # 再生に必要な項目は残る
+    assert session["amount_total"] == 3000 and session["payment_status"] == "paid"
+    assert session["metadata"]["order_id"] == "ABCD1234"
+    assert session["metadata"]["tg_uid"] != "700200"
+    # 元のイベントは書き換えない
+    assert event["data"]["object"]["customer_details"]["phone"] == PHONE
+
+
+def test_loose_address_fields_are_redacted():
+    redacted = Redactor(salt="test").redact({"charge": {"billing": {"phone": PHONE, "line1": "1-2-3 Shibuya",
+                                                                    "postal_code": "150-0002"}}})
+    assert redacted == {"charge": {"billing": {"phone": "REDACTED", "line1": "REDACTED", "postal_code": "REDACTED"}}}
+
+
+def test_telegram_contact_and_shipping_are_redacted():
+    update = {"update_id": 1, "message": {
+        "message_id": 1, "date": 1, "chat": {"id": 700200, "type": "private"},
+        "from": {"id": 700200, "is_bot": False, "first_name": "太郎", "username": "taro_y"},
+        "contact": {"phone_number": PHONE, "first_name": "太郎", "user_id": 700200},
+        "successful_payment": {"currency": "JPY", "total_amount": 3000, "invoice_payload": "x",
+                               "order_info": {"name": "山田 太郎", "phone_number": PHONE, "email": EMAIL,
+                                              "shipping_address": {"street_line1": "1-2-3 Shibuya",
+                                                                   "post_code": "150-0002"}}},
+    }}
+    dumped = json.dumps(Redactor(salt="test").redact(update), ensure_ascii=False)
+    for value in PII:
+        assert value not in dumped, value
+    assert "700200" not in dumped
+
+
+def test_record_http_writes_redacted_body():
+    recorder = TrafficRecorder.__new__(TrafficRecorder)
+    recorder.redactor = Redactor(salt="test")
+    written = []
+    recorder.write = lambda kind, **fields: written.append((kind, fields))
+
+    body = json.dumps(checkout_completed(), ensure_ascii=False).encode()
+    recorder.record_http("POST", "/stripe/webhook", {"token": "secret"}, body)
+
+    [(kind, fields)] = written
+    dumped = json.dumps(fields, ensure_ascii=False)
+    assert kind == "http" and fields["authed"] and "secret" not in dumped
+    for value in PII:
+        assert value not in dumped, value
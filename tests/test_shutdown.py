@@ -0,0 +1,23 @@
+import asyncio
+
+
+def test_main_exits_and_flushes_orders_when_polling_stops(bot_module, monkeypatch):
+    B = bot_module
+    monkeypatch.setattr(B.ORDERS, "save_delay", 3600)
+    flushed = []
+    monkeypatch.setattr(B.ORDERS, "after_save", flushed.append)
+
+    async def start_polling(bot, **kwargs):
+        # SIGTERM を受けた aiogram はポーリングだけを止めて戻る
+        B.ORDERS.create(700300, type="データ", count=1, price=1500)
+        await asyncio.sleep(0.1)
+
+    async def start_web_app():
+        pass
+
+    monkeypatch.setattr(B.dp, "start_polling", start_polling)
+    monkeypatch.setattr(B, "start_web_app", start_web_app)
+
+    asyncio.run(asyncio.wait_for(B.main(), timeout=5))
+    assert flushed == [B.ORDERS_FILE]
+    assert not B.ORDERS._dirty
@@ -0,0 +1,114 @@
+import asyncio
+import time
+
+from aiogram.exceptions import TelegramBadRequest
+from aiogram.methods import GetFile
+from aiogram.types import File
+
+from stock_health import StockHealth
+
+
+class FakeTelegram:
+    """getFile の代わり。file_id ごとに結果（file_unique_id / 無効 / 一時的な失敗）を決めておく"""
+
+    def __init__(self, files: dict):
+        self.files = files
+        self.calls: list[str] = []
+
+    async def get_file(self, file_id: str) -> File:
+        self.calls.append(file_id)
+        result = self.files[file_id]
+        if result == "invalid":
+            raise TelegramBadRequest(GetFile(file_id=file_id), "Bad Request: wrong file_id")
+        if result == "timeout":
+            raise RuntimeError("network timeout")
+        return File(file_id=file_id, file_unique_id=result)
+
+
+def make_health(stock: dict, files: dict, **kw):
+    telegram = FakeTelegram(files)
+    changes = []
+    health = StockHealth(lambda: stock, telegram.get_file, changes.append, **kw)
+    return health, telegram, changes
+
+
+def test_check_batch_verifies_and_quarantines():
+    stock = {"データ": ["ok-1", "bad", "dup-a", "dup-b", "flaky"], "通話可能": ["ok-2"]}
+    files = {"ok-1": "u1", "bad": "invalid", "dup-a": "same", "dup-b": "same", "flaky": "timeout", "ok-2": "u2"}
+    health, telegram, changes = make_health(stock, files)
+
+    assert asyncio.run(health.check_batch()) == 5  # 一時的な失敗は確認済みに数えない
+
+    # 正常な在庫は確認済みになる
+    assert health.verified["ok-1"]["u"] == "u1" and health.verified["ok-2"]["u"] == "u2"
+    # 無効な file_id と、先に確認した在庫と同じ画像は隔離して STOCK から外す
+    assert stock == {"データ": ["ok-1", "dup-a", "flaky"], "通話可能": ["ok-2"]}
+    reasons = {q["file_id"]: q["reason"] for q in health.quarantine["データ"]}
+    assert set(reasons) == {"bad", "dup-b"}
+    assert "無効な file_id" in reasons["bad"] and "重複" in reasons["dup-b"]
+    assert [(p, f) for p, f, _ in changes[0]] == [("データ", "bad"), ("データ", "dup-b")]
+    # 一時的な失敗は隔離せず、次の周回で確認し直す
+    assert "flaky" not in health.verified and health.transient_errors == 1
+    telegram.calls.clear()
+    files["flaky"] = "u3"
+    assert asyncio.run(health.check_batch()) == 1
+    assert telegram.calls == ["flaky"]
+    assert health.verified["flaky"]["u"] == "u3" and stock["データ"] == ["ok-1", "dup-a", "flaky"]
+    assert health.quarantined() == 2
+
+
+def test_batch_size_and_recheck():
+    stock = {"データ": [f"f{i}" for i in range(5)]}
+    health, telegram, _ = make_health(stock, {f"f{i}": f"u{i}" for i in range(5)}, batch=2, recheck_hours=1)
+
+    asyncio.run(health.check_batch())
+    assert telegram.calls == ["f0", "f1"]
+    asyncio.run(health.check_batch())
+    asyncio.run(health.check_batch())
+    assert health.healthy(stock["データ"]) == 5
+    assert asyncio.run(health.check_batch()) == 0  # 全部確認済みなら何もしない
+
+    health.verified["f3"]["at"] = time.time() - 2 * 3600
+    telegram.calls.clear()
+    asyncio.run(health.check_batch())
+    assert telegram.calls == ["f3"]
+
+
+def test_results_for_items_sold_during_check_are_ignored():
+    stock = {"データ": ["sold", "bad"]}
+    health, _, changes = make_health(stock, {"sold": "u1", "bad": "invalid"})
+
+    async def get_file_and_sell(file_id):
+        stock["データ"].remove(file_id)  # 確認中に売れた
+        return await FakeTelegram({"sold": "u1", "bad": "invalid"}).get_file(file_id)
+
+    health.get_file = get_file_and_sell
+    asyncio.run(health.check_batch())
+    assert "sold" not in health.verified and not health.quarantine and changes == [[]]
+
+
+def test_admit_take_and_release():
+    stock = {"データ": []}
+    health, _, _ = make_health(stock, {})
+    # 在庫に加える前に呼ぶ。新しい画像なら None（確認済みとして登録）
+    for file_id, unique_id in (("a", "ua"), ("b", "ub"), ("c", "uc")):
+        assert health.admit(file_id, unique_id) is None
+        stock["データ"].append(file_id)
+    # 同じ画像（同じ file_unique_id）や同じ file_id は既存在庫を返す
+    assert health.admit("a2", "ua") == "a"
+    assert health.admit("b", "ub") == "b"
+    assert health.healthy(stock["データ"]) == 3
+
+    # 確認済みを優先して取り出す（それぞれの順序は保つ）
+    health.verified.pop("a")
+    items = list(stock["データ"])
+    assert health.take(items, 3) == ["b", "c", "a"]
+    assert items == []
+    items = ["a", "b", "c"]
+    assert health.take(items, 1) == ["b"]
+    assert items == ["a", "c"]
+
+    health.quarantine = {"データ": [{"file_id": "x", "reason": "r", "at": 0}], "通話可能": [{"file_id": "y", "reason": "r", "at": 0}]}
+    assert health.release("データ") == {"データ": ["x"]}
+    assert health.release() == {"通話可能": ["y"]}
+    assert health.quarantined() == 0
@@ -0,0 +1,196 @@
+import json
+import os
+import time
+
+from tracing import timed
+
+# =========================
+# お問い合わせチケット（ユーザー / 対応状況で索引）
+# =========================
+# /問い合わせ の内容をチケットとして残し、管理者は /inbox から返信・クローズする。
+# 保存は追記専用の JSONL（1行1イベント）なので、件数が増えても書き込みは1行分で済む:
+#   {"ev": "open",  "id": 12, "uid": ..., "name": ..., "text": ..., "ts": ...}
+#   {"ev": "msg",   "id": 12, "from": "user" | "admin", "text": ..., "ts": ...}
+#   {"ev": "close", "id": 12, "ts": ...}
+#   {"ev": "reopen","id": 12, "ts": ...}
+#   {"ev": "ticket", ...}   … 圧縮時に書き出すチケット丸ごと
+#   {"ev": "seq",   "id": 40, "ts": ...}  … 圧縮時に書き出す採番済みの最大ID（IDを使い回さない）
+# 起動時にイベントを先頭から適用して索引を作り、古いクローズ済みチケットがあれば圧縮する。
+# 同じユーザーの未対応チケットがある間の問い合わせは、そのチケットに追記する。
+
+TICKET_STATUSES = ("open", "closed")
+
+# クローズ済みチケットを保持する日数
+TICKET_RETENTION_DAYS = int(os.getenv("TICKET_RETENTION_DAYS", "90"))
+
+
+class TicketStore:
+    def __init__(self, path: str):
+        self.path = path
+        self.tickets: dict[int, dict] = {}
+        # 索引は「挿入順を保つ集合」として dict[id, None] を使う。
+        # open は最後にやり取りがあった順（新しい発言で末尾へ移す）
+        self.by_user: dict[int, dict[int, None]] = {}
+        self.by_status: dict[str, dict[int, None]] = {s: {} for s in TICKET_STATUSES}
+        self.last_id = 0
+
+    def __contains__(self, ticket_id) -> bool:
+        return ticket_id in self.tickets
+
+    def __len__(self) -> int:
+        return len(self.tickets)
+
+    def get(self, ticket_id: int) -> dict | None:
+        return self.tickets.get(ticket_id)
+
+    def count(self, status: str) -> int:
+        return len(self.by_status[status])
+
+    def open_for(self, uid: int) -> dict | None:
+        """ユーザーの未対応チケット（あれば1件）"""
+        for tid in reversed(self.by_user.get(uid, {})):
+            if tid in self.by_status["open"]:
+                return self.tickets[tid]
+        return None
+
+    def page(self, status: str, page: int, size: int) -> tuple[list[dict], int]:
+        """新しい順の1ページ分と総ページ数。索引の末尾から必要な分だけ取り出す"""
+        ids = self.by_status[status]
+        pages = max(1, -(-len(ids) // size))
+        page = min(max(page, 0), pages - 1)
+        found = []
+        for i, tid in enumerate(reversed(ids)):
+            if i >= (page + 1) * size:
+                break
+            if i >= page * size:
+                found.append(self.tickets[tid])
+        return found, pages
+
+    # ---- イベントの適用（読み込み時・書き込み時で共通） ----
+    def _touch(self, ticket: dict, ts: float):
+        ticket["updated"] = ts
+        index = self.by_status[ticket["status"]]
+        index.pop(ticket["id"], None)
+        index[ticket["id"]] = None
+
+    def _apply(self, ev: dict):
+        kind, tid, ts = ev["ev"], ev["id"], ev["ts"]
+        if kind == "seq":
+            self.last_id = max(self.last_id, tid)
+            return
+        if kind in ("open", "ticket"):
+            if kind == "open":
+                ticket = {"id": tid, "uid": ev["uid"], "name": ev.get("name", ""), "status": "open",
+                          "created": ts, "updated": ts, "messages": [{"from": "user", "text": ev["text"], "ts": ts}]}
+            else:
+                ticket = {k: v for k, v in ev.items() if k not in ("ev", "ts")}
+            self.tickets[tid] = ticket
+            self.by_user.setdefault(ticket["uid"], {})[tid] = None
+            self.by_status[ticket["status"]][tid] = None
+            self.last_id = max(self.last_id, tid)
+            return
+        ticket = self.tickets.get(tid)
+        if ticket is None:
+            return  # 圧縮で消えたチケットへのイベント
+        if kind == "msg":
+            ticket["messages"].append({"from": ev["from"], "text": ev["text"], "ts": ts})
+            if ev["from"] == "user":
+                self._touch(ticket, ts)
+            else:
+                ticket["updated"] = ts
+        elif kind in ("close", "reopen"):
+            self.by_status[ticket["status"]].pop(tid, None)
+            ticket["status"] = "closed" if kind == "close" else "open"
+            self._touch(ticket, ts)
+
+    @timed("persist")
+    def _append(self, ev: dict):
+        try:
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(json.dumps(ev, ensure_ascii=False) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+        except Exception as e:
+            print(f"⚠️ チケット保存失敗: {e}")
+
+    def _emit(self, ev: dict) -> dict:
+        ev["ts"] = time.time()
+        self._apply(ev)
+        self._append(ev)
+        return self.tickets[ev["id"]]
+
+    # ---- 操作 ----
+    def submit(self, uid: int, name: str, text: str) -> tuple[dict, bool]:
+        """問い合わせを受け付ける。(チケット, 新規か)"""
+        ticket = self.open_for(uid)
+        if ticket is not None:
+            return self._emit({"ev": "msg", "id": ticket["id"], "from": "user", "text": text}), False
+        return self._emit({"ev": "open", "id": self.last_id + 1, "uid": uid, "name": name, "text": text}), True
+
+    def reply(self, ticket_id: int, text: str) -> dict:
+        return self._emit({"ev": "msg", "id": ticket_id, "from": "admin", "text": text})
+
+    def close(self, ticket_id: int) -> dict:
+        if self.tickets[ticket_id]["status"] == "closed":
+            return self.tickets[ticket_id]
+        return self._emit({"ev": "close", "id": ticket_id})
+
+    def reopen(self, ticket_id: int) -> dict:
+        if self.tickets[ticket_id]["status"] == "open":
+            return self.tickets[ticket_id]
+        return self._emit({"ev": "reopen", "id": ticket_id})
+
+    # ---- 読み込み / 圧縮 ----
+    def load(self):
+        self.tickets.clear()
+        self.by_user.clear()
+        for index in self.by_status.values():
+            index.clear()
+        self.last_id = 0
+        if not os.path.exists(self.path):
+            return
+        events = 0
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                for line in f:
+                    if not line.strip():
+                        continue
+                    try:
+                        self._apply(json.loads(line))
+                    except (ValueError, KeyError) as e:
+                        print(f"⚠️ チケットログの不正な行を無視: {e}")  # 書き込み途中で落ちた最終行など
+                        continue
+                    events += 1
+            with open(self.path, "rb+") as f:
+                if f.seek(0, os.SEEK_END) and (f.seek(-1, os.SEEK_END), f.read(1))[1] != b"\n":
+                    f.write(b"\n")  # 途中で切れた行の後ろに追記がつながらないようにする
+        except Exception as e:
+            print(f"⚠️ チケットデータ読み込み失敗: {e}")
+            return
+        cutoff = time.time() - TICKET_RETENTION_DAYS * 86400
+        expired = [tid for tid in self.by_status["closed"] if self.tickets[tid]["updated"] < cutoff]
+        if expired or events > 2 * len(self.tickets) + 1000:
+            self.compact(expired)
+
+    def compact(self, drop=()):
+        """残すチケットを1行ずつ書き直す（drop は捨てるチケットID）"""
+        for tid in drop:
+            ticket = self.tickets.pop(tid)
+            self.by_status[ticket["status"]].pop(tid, None)
+            self.by_user.get(ticket["uid"], {}).pop(tid, None)
+            if not self.by_user.get(ticket["uid"]):
+                self.by_user.pop(ticket["uid"], None)
+        tmp = self.path + ".tmp"
+        try:
+            with open(tmp, "w", encoding="utf-8") as f:
+                f.write(json.dumps({"ev": "seq", "id": self.last_id, "ts": time.time()}) + "\n")
+                # 索引の順序（open は最終発言順）を保つため、索引順に書く
+                for status in TICKET_STATUSES:
+                    for tid in self.by_status[status]:
+                        ticket = self.tickets[tid]
+                        f.write(json.dumps({"ev": "ticket", **ticket, "ts": ticket["updated"]}, ensure_ascii=False) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp, self.path)
+        except Exception as e:
+            print(f"⚠️ チケットログ圧縮失敗: {e}")
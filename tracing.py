@@ -0,0 +1,169 @@
+import contextvars
+import functools
+import json
+import logging
+import os
+import random
+import time
+from contextlib import contextmanager
+from logging.handlers import RotatingFileHandler
+
+from aiogram import BaseMiddleware
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+
+# =========================
+# update単位のトレース（時間の内訳を記録）
+# =========================
+# 1 update（または1 Webhookリクエスト）の処理時間を
+#   network  : Telegram / Stripe などへのAPI待ち
+#   persist  : JSON保存・バックアップなどのディスク書き込み
+#   cpu      : 上記以外（Python処理 + イベントループ待ち）
+# に分けて記録する。内訳は contextvar 経由で各所の span() が加算していく。
+
+TRACE_SAMPLE_RATE = float(os.getenv("TRACE_SAMPLE_RATE", "0.05"))
+SLOW_UPDATE_MS = float(os.getenv("SLOW_UPDATE_MS", "1500"))
+
+_CURRENT: contextvars.ContextVar[dict | None] = contextvars.ContextVar("esim_trace", default=None)
+
+
+def rotating_jsonl_logger(name: str, path: str, max_bytes: int = 5_000_000, backups: int = 3) -> logging.Logger:
+    """1行1JSONで書き出すローテーション付きロガーを作る"""
+    logger = logging.getLogger(name)
+    if not logger.handlers:
+        handler = RotatingFileHandler(path, maxBytes=max_bytes, backupCount=backups, encoding="utf-8")
+        handler.setFormatter(logging.Formatter("%(message)s"))
+        logger.addHandler(handler)
+        logger.setLevel(logging.INFO)
+        logger.propagate = False
+    return logger
+
+
+class Tracer:
+    """トレースのサンプリング・遅延検知・ファイル出力を担当"""
+
+    def __init__(self, path: str, sample_rate: float = TRACE_SAMPLE_RATE, slow_ms: float = SLOW_UPDATE_MS):
+        self.sample_rate = sample_rate
+        self.slow_ms = slow_ms
+        self.logger = rotating_jsonl_logger("esim.trace", path)
+
+    def begin(self, kind: str, name: str) -> tuple[dict, contextvars.Token]:
+        trace = {"kind": kind, "name": name, "start": time.perf_counter(), "network": 0.0, "persist": 0.0}
+        return trace, _CURRENT.set(trace)
+
+    def end(self, trace: dict, token: contextvars.Token, error: str | None = None):
+        _CURRENT.reset(token)
+        total = time.perf_counter() - trace.pop("start")
+        entry = {"ts": round(time.time(), 3), "kind": trace.pop("kind"), "name": trace.pop("name")}
+        handler = trace.pop("handler", None)
+        if handler:
+            entry["handler"] = handler
+        entry["total_ms"] = round(total * 1000, 2)
+        accounted = 0.0
+        for key, seconds in trace.items():
+            entry[f"{key}_ms"] = round(seconds * 1000, 2)
+            accounted += seconds
+        entry["cpu_ms"] = round(max(0.0, total - accounted) * 1000, 2)
+        if error:
+            entry["error"] = error
+
+        slow = entry["total_ms"] >= self.slow_ms
+        if slow:
+            entry["slow"] = True
+            breakdown = " / ".join(f"{k[:-3]}={v}ms" for k, v in entry.items() if k.endswith("_ms") and k != "total_ms")
+            print(f"🐢 遅延検知 {entry['kind']}:{entry.get('handler') or entry['name']} {entry['total_ms']}ms ({breakdown})")
+        if slow or random.random() < self.sample_rate:
+            self.logger.info(json.dumps(entry, ensure_ascii=False))
+
+
+@contextmanager
+def span(kind: str):
+    """現在のトレースに kind の所要時間を加算する（トレース外では何もしない）"""
+    trace = _CURRENT.get()
+    if trace is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        trace[kind] = trace.get(kind, 0.0) + (time.perf_counter() - start)
+
+
+def timed(kind: str):
+    """同期関数を span(kind) で包むデコレータ（save_data など用）"""
+    def deco(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with span(kind):
+                return fn(*args, **kwargs)
+        return wrapper
+    return deco
+
+
+def describe_update(update) -> str:
+    if update.message:
+        text = update.message.text or ""
+        if text.startswith("/"):
+            return "message:" + text.split(maxsplit=1)[0]
+        return "message:photo" if update.message.photo else "message"
+    if update.callback_query:
+        data = update.callback_query.data or ""
+        return "callback:" + data.split("_", 1)[0]
+    return update.event_type
+
+
+class UpdateTraceMiddleware(BaseMiddleware):
+    """dp.update の outer middleware。update 全体の所要時間を計測"""
+
+    def __init__(self, tracer: Tracer):
+        self.tracer = tracer
+
+    async def __call__(self, handler, event, data):
+        trace, token = self.tracer.begin("update", describe_update(event))
+        error = None
+        try:
+            return await handler(event, data)
+        except Exception as e:
+            error = repr(e)
+            raise
+        finally:
+            self.tracer.end(trace, token, error)
+
+
+class HandlerNameMiddleware(BaseMiddleware):
+    """inner middleware。実際に選ばれたハンドラ名をトレースに記録"""
+
+    async def __call__(self, handler, event, data):
+        trace = _CURRENT.get()
+        handler_obj = data.get("handler")
+        if trace is not None and handler_obj is not None:
+            trace["handler"] = getattr(handler_obj.callback, "__name__", str(handler_obj.callback))
+        return await handler(event, data)
+
+
+class TraceRequestMiddleware(BaseRequestMiddleware):
+    """Bot セッションの request middleware。Telegram API 待ちを network に計上"""
+
+    async def __call__(self, make_request, bot, method):
+        with span("network"):
+            return await make_request(bot, method)
+
+
+def aiohttp_trace_middleware(tracer: Tracer):
+    """aiohttp 用の middleware を返す（Webhook の所要時間を計測）"""
+    from aiohttp import web
+
+    @web.middleware
+    async def middleware(request, handler):
+        trace, token = tracer.begin("http", f"{request.method} {request.path}")
+        trace["handler"] = getattr(handler, "__name__", None)
+        error = None
+        try:
+            return await handler(request)
+        except Exception as e:
+            error = repr(e)
+            raise
+        finally:
+            tracer.end(trace, token, error)
+
+    return middleware
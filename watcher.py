@@ -0,0 +1,77 @@
+import asyncio
+import os
+
+import storage
+
+# =========================
+# 設定・データファイルの監視（再起動なしで再読み込み）
+# =========================
+# config.json や data.json が外部で書き換えられたら（手動編集・手動復元など）
+# mtime / サイズの変化をポーリングで検知し、
+#   1. イベントループの外（スレッド）で読み込み・パース
+#   2. validate() で中身を検証（失敗したら今の値のまま）
+#   3. apply() でメモリ上の値をまとめて差し替え
+# の順に反映する。Bot 自身の保存は mark() で記録し、再読み込みしない。
+
+RELOAD_INTERVAL = float(os.getenv("RELOAD_INTERVAL", "2"))
+
+
+def _signature(path: str):
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return (st.st_mtime_ns, st.st_size)
+
+
+class FileWatcher:
+    def __init__(self, interval: float = RELOAD_INTERVAL, on_error=None):
+        self.interval = interval
+        self.on_error = on_error  # on_error(path, message): 検証失敗の通知（コルーチン）
+        self.watches: dict[str, dict] = {}
+        self.reloads = 0
+
+    def watch(self, path: str, apply, validate=None, parse=storage.read):
+        """path の変更時に parse → validate → apply を行う（apply は同期/非同期どちらでも可）"""
+        self.watches[path] = {"apply": apply, "validate": validate, "parse": parse, "sig": _signature(path)}
+
+    def mark(self, path: str):
+        """自分で書き込んだ直後に呼ぶ（その変更では再読み込みしない）"""
+        w = self.watches.get(path)
+        if w is not None:
+            w["sig"] = _signature(path)
+
+    async def check(self, path: str) -> bool:
+        w = self.watches[path]
+        sig = _signature(path)
+        if sig is None or sig == w["sig"]:
+            return False
+        w["sig"] = sig
+        name = os.path.basename(path)
+        try:
+            value = await asyncio.to_thread(w["parse"], path)
+            if w["validate"] is not None:
+                w["validate"](value)
+        except Exception as e:
+            print(f"⚠️ {name} の再読み込みを中止（現在の内容を維持）: {e}")
+            if self.on_error is not None:
+                await self.on_error(path, str(e))
+            return False
+        # 読み込み中に Bot 自身が保存していたら、そちらを優先する
+        if _signature(path) != sig:
+            return False
+        result = w["apply"](value)
+        if asyncio.iscoroutine(result):
+            await result
+        self.reloads += 1
+        print(f"🔄 {name} を再読み込みしました")
+        return True
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            for path in list(self.watches):
+                try:
+                    await self.check(path)
+                except Exception as e:
+                    print(f"⚠️ ファイル監視エラー {path}: {e}")